@@ -3,7 +3,9 @@ from spire.core import Component
 from spire.mesh import MeshServer
 
 import lattice.server.models
+import lattice.server.storage
 from lattice.server import resources
+from lattice.server.streaming import ComponentStream
 
 bundle = Bundle('lattice',
     mount(resources.Component, 'lattice.server.controllers.component.ComponentController'),
@@ -16,3 +18,5 @@ class Lattice(Component):
     api = MeshServer.deploy(
         bundles=[bundle],
         path='/api')
+
+    stream = ComponentStream.deploy(path='/stream/component')
@@ -0,0 +1,90 @@
+import fcntl
+import os
+import tempfile
+from contextlib import contextmanager
+from time import sleep, time
+
+from lattice.server.models import Change
+
+MAXIMUM_WAIT = 10
+MAXIMUM_WAITERS = 1
+POLL_INTERVAL = 0.5
+
+class ChangeFeed(object):
+    """Records a change for every write to the resources of a controller,
+    deletes included, and serves the ``changes`` request, which waits for
+    changes past ``since``; the id of a deleted resource is reported like any
+    other and is simply gone when fetched.
+
+    The server's workers are synchronous, so a waiting request holds a whole
+    worker process until a change arrives or its timeout passes. At most
+    ``MAXIMUM_WAITERS`` requests wait at once, across all of the server's
+    processes, and none for longer than ``MAXIMUM_WAIT`` seconds; any other
+    request with nothing to return responds at once, and its client simply
+    polls again. Controllers list this mixin before ``ModelController``, so
+    that it sees deletes."""
+
+    def changes(self, request, response, subject, data):
+        resource = self.resource.name
+        since = data.get('since') or 0
+        limit = data.get('limit') or 1000
+        timeout = min(data.get('timeout') or 0, MAXIMUM_WAIT)
+
+        session = self.schema.session
+        changes = self._query_changes(resource, since, limit)
+        if not changes and timeout > 0:
+            with acquire_waiting_slot() as acquired:
+                deadline = time() + timeout
+                while acquired and not changes:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        break
+
+                    # end the transaction, so that the next poll sees what
+                    # other requests commit in the meantime
+                    session.rollback()
+                    sleep(min(POLL_INTERVAL, remaining))
+                    changes = self._query_changes(resource, since, limit)
+
+        ids = []
+        for seq, id in changes:
+            if id not in ids:
+                ids.append(id)
+
+        response({'seq': changes[-1][0] if changes else since, 'ids': ids})
+
+    def delete(self, request, response, subject, data):
+        self._record_change(subject)
+        return super(ChangeFeed, self).delete(request, response, subject, data)
+
+    def _query_changes(self, resource, since, limit):
+        return (self.schema.session.query(Change.seq, Change.subject)
+            .filter(Change.resource==resource, Change.seq > since)
+            .order_by(Change.seq).limit(limit).all())
+
+    def _record_change(self, model):
+        self.schema.session.add(Change(resource=self.resource.name, subject=model.id))
+
+@contextmanager
+def acquire_waiting_slot():
+    """Yields whether one of the ``MAXIMUM_WAITERS`` slots for waiting requests
+    was free, holding it until the block ends. The slots are locks on files
+    named for the server's master process, so that all its workers share them."""
+
+    for slot in range(MAXIMUM_WAITERS):
+        filename = os.path.join(tempfile.gettempdir(), 'lattice-changes-%d.%d'
+            % (os.getppid(), slot))
+        openfile = open(filename, 'a')
+        try:
+            fcntl.flock(openfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            openfile.close()
+            continue
+
+        try:
+            yield True
+        finally:
+            openfile.close()
+        return
+
+    yield False
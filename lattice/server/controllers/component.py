@@ -1,18 +1,26 @@
 from spire.mesh import ModelController
 from spire.schema import SchemaDependency
 
+from lattice.server.controllers.changes import ChangeFeed
+from lattice.server.controllers.search import Searchable
+from lattice.server.controllers.transactions import WriteTransactions
 from lattice.server.resources import Component as ComponentResource
 from lattice.server.models import Build, Component, ComponentRepository
+from lattice.server.search import COMPONENTS
 
-class ComponentController(ModelController):
+class ComponentController(WriteTransactions, Searchable, ChangeFeed, ModelController):
     resource = ComponentResource
     version = (1, 0)
 
     model = Component
     mapping = 'id name version status description timestamp'
     schema = SchemaDependency('lattice')
+    search_index = COMPONENTS
 
     def _annotate_model(self, model, data):
+        self._record_change(model)
+        self._index_model(model, name=model.name, description=model.description)
+
         repository = data.get('repository')
         if repository:
             model.repository = ComponentRepository.polymorphic_create(repository)
@@ -1,10 +1,11 @@
 from spire.mesh import ModelController
 from spire.schema import SchemaDependency
 
+from lattice.server.controllers.transactions import WriteTransactions
 from lattice.server.resources import Product as ProductResource
 from lattice.server.models import Product
 
-class ProductController(ModelController):
+class ProductController(WriteTransactions, ModelController):
     resource = ProductResource
     version = (1, 0)
 
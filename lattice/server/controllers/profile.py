@@ -1,10 +1,16 @@
+from mesh.exceptions import OperationError
 from spire.mesh import ModelController
 from spire.schema import SchemaDependency
+from sqlalchemy.orm import joinedload, subqueryload
 
+from lattice.server.controllers.changes import ChangeFeed
+from lattice.server.controllers.transactions import WriteTransactions
+from lattice.server.diff import PROFILES
 from lattice.server.resources import Profile as ProfileResource
-from lattice.server.models import Profile, ProfileComponent
+from lattice.server.models import Component, ComponentDependencies, Profile, ProfileComponent
+from lattice.util import prioritize
 
-class ProfileController(ModelController):
+class ProfileController(WriteTransactions, ChangeFeed, ModelController):
     resource = ProfileResource
     version = (1, 0)
 
@@ -12,7 +18,15 @@ class ProfileController(ModelController):
     mapping = 'id product_id version'
     schema = SchemaDependency('lattice')
 
+    def diff(self, request, response, subject, data):
+        session = self.schema.session
+        if not session.query(Profile).get(data['target']):
+            raise OperationError(token='unknown-profile')
+        response(PROFILES.diff(session, subject.id, data['target']))
+
     def _annotate_model(self, model, data):
+        self._record_change(model)
+
         components = data.get('components')
         if components:
             self.schema.session.query(ProfileComponent).filter(ProfileComponent.profile_id==model.id).delete()
@@ -35,3 +49,44 @@ class ProfileController(ModelController):
 
         if data and 'include' in data and 'sequence' in data['include']:
             print model.collate_components()
+        if data and 'include' in data and 'resolved' in data['include']:
+            resource['resolved'] = self._resolve_components(model)
+
+    def _resolve_components(self, model):
+        """Expands the components of ``model``, with their repositories, builds
+        and dependencies, into the order they must be built in. The queries are
+        batched, so their number doesn't grow with the size of the profile."""
+
+        ids = [component.component_id for component in model.components]
+        if not ids:
+            return []
+
+        session = self.schema.session
+        query = (session.query(Component).filter(Component.id.in_(ids))
+            .options(joinedload(Component.repository), subqueryload(Component.builds)))
+        components = dict((component.id, component) for component in query)
+
+        dependencies = dict((id, []) for id in components)
+        query = (session.query(ComponentDependencies)
+            .filter(ComponentDependencies.c.component_id.in_(components.keys())))
+        for component_id, dependency_id in query:
+            dependencies[component_id].append(dependency_id)
+
+        graph = dict((id, set(d for d in dependencies[id] if d in components))
+            for id in components)
+        order = prioritize(graph, {}, [id for id in ids if id in components])[0]
+
+        resolved = []
+        for id in order:
+            component = components[id]
+            entry = {'id': component.id, 'name': component.name,
+                'version': component.version, 'status': component.status,
+                'description': component.description}
+            if component.repository:
+                entry['repository'] = component.repository.extract_dict(
+                    exclude=['id', 'component_id'])
+            entry['builds'] = dict((build.name, build.extract_dict(
+                exclude=['id', 'component_id', 'name'])) for build in component.builds)
+            entry['dependencies'] = sorted(dependencies[id])
+            resolved.append(entry)
+        return resolved
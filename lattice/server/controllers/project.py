@@ -1,18 +1,24 @@
 from spire.mesh import ModelController
 from spire.schema import SchemaDependency
 
+from lattice.server.controllers.search import Searchable
+from lattice.server.controllers.transactions import WriteTransactions
 from lattice.server.resources import Project as ProjectResource
 from lattice.server.models import *
+from lattice.server.search import PROJECTS
 
-class ProjectController(ModelController):
+class ProjectController(WriteTransactions, Searchable, ModelController):
     resource = ProjectResource
     version = (1, 0)
 
     model = Project
     mapping = 'id status description'
     schema = SchemaDependency('lattice')
+    search_index = PROJECTS
 
     def _annotate_model(self, model, data):
+        self._index_model(model, name=model.id, description=model.description)
+
         repository = data.get('repository')
         if repository:
             model.repository = ProjectRepository.polymorphic_create(repository)
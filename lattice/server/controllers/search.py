@@ -0,0 +1,30 @@
+class Searchable(object):
+    """Serves the ``search`` request from the ``search_index`` of a controller,
+    which controllers keep current by calling ``_index_model`` on writes.
+    Controllers list this mixin before ``ModelController`` and any other mixin
+    which touches the session on writes, so that the index exists before a
+    write takes the database's write lock; deletes remove the resource from the
+    index."""
+
+    search_index = None
+
+    def create(self, request, response, subject, data):
+        self.search_index.prepare(self.schema.session.bind)
+        return super(Searchable, self).create(request, response, subject, data)
+
+    def delete(self, request, response, subject, data):
+        self.search_index.prepare(self.schema.session.bind)
+        self.search_index.remove(self.schema.session, subject.id)
+        return super(Searchable, self).delete(request, response, subject, data)
+
+    def search(self, request, response, subject, data):
+        ids = self.search_index.search(self.schema.session, data['query'],
+            data.get('limit') or 20)
+        response({'ids': ids})
+
+    def update(self, request, response, subject, data):
+        self.search_index.prepare(self.schema.session.bind)
+        return super(Searchable, self).update(request, response, subject, data)
+
+    def _index_model(self, model, **values):
+        self.search_index.update(self.schema.session, model.id, values)
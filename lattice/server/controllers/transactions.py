@@ -0,0 +1,18 @@
+from lattice.server.storage import immediate_transaction
+
+class WriteTransactions(object):
+    """Runs the create, update and delete requests of a controller in
+    transactions which take the write lock when they begin, leaving every other
+    request to read without one."""
+
+    def create(self, request, response, subject, data):
+        with immediate_transaction(self.schema.session):
+            return super(WriteTransactions, self).create(request, response, subject, data)
+
+    def delete(self, request, response, subject, data):
+        with immediate_transaction(self.schema.session):
+            return super(WriteTransactions, self).delete(request, response, subject, data)
+
+    def update(self, request, response, subject, data):
+        with immediate_transaction(self.schema.session):
+            return super(WriteTransactions, self).update(request, response, subject, data)
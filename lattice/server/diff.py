@@ -0,0 +1,104 @@
+"""Comparison of two profiles, and of what an upgrade from one to the other
+affects.
+
+Components are compared by name: those only in the target were added, those
+only in the source removed, and those in both under different ids changed. The
+dependents affected are the components of the target which depend, directly or
+transitively, on a component whose id is in only one of the profiles. Each part
+is one set operation or recursive query in the database, so no profile is loaded
+into memory to be compared.
+
+Results are cached per pair of profiles under the sequence number of the latest
+change, so that any write to a component or profile invalidates them."""
+
+from threading import Lock
+
+from sqlalchemy import text
+
+CACHE_SIZE = 256
+
+MEMBERS = ('SELECT c.id, c.name, c.version FROM profile_component pc'
+    ' JOIN component c ON c.id = pc.component_id WHERE pc.profile_id = :%s')
+
+ADDED = ('SELECT t.name FROM (%s) t EXCEPT SELECT s.name FROM (%s) s'
+    % (MEMBERS % 'target', MEMBERS % 'source'))
+
+REMOVED = ('SELECT s.name FROM (%s) s EXCEPT SELECT t.name FROM (%s) t'
+    % (MEMBERS % 'source', MEMBERS % 'target'))
+
+CHANGED = ('SELECT s.name, s.id, t.id FROM (%s) s JOIN (%s) t ON t.name = s.name'
+    ' WHERE t.id <> s.id' % (MEMBERS % 'source', MEMBERS % 'target'))
+
+AFFECTED = """
+WITH RECURSIVE
+  target(id) AS (SELECT component_id FROM profile_component WHERE profile_id = :target),
+  source(id) AS (SELECT component_id FROM profile_component WHERE profile_id = :source),
+  altered(id) AS (
+    SELECT a.id FROM (SELECT id FROM target EXCEPT SELECT id FROM source) a
+    UNION
+    SELECT r.id FROM (SELECT id FROM source EXCEPT SELECT id FROM target) r),
+  dependent(id) AS (
+    SELECT d.component_id FROM component_dependency d JOIN altered a ON a.id = d.dependency_id
+    UNION
+    SELECT d.component_id FROM component_dependency d JOIN dependent p ON p.id = d.dependency_id)
+SELECT id FROM dependent INTERSECT SELECT id FROM target EXCEPT SELECT id FROM altered"""
+
+class ProfileDiff(object):
+    """Computes and caches the differences between pairs of profiles."""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.cache = {}
+        self.guard = Lock()
+        self.order = []
+        self.size = size
+
+    def diff(self, session, source, target):
+        """Returns the components added, removed and changed from the profile
+        ``source`` to the profile ``target``, and the components of ``target``
+        affected through their dependencies."""
+
+        seq = session.execute(text('SELECT max(seq) FROM change')).scalar() or 0
+        key = (source, target)
+
+        with self.guard:
+            cached = self.cache.get(key)
+            if cached and cached[0] == seq:
+                self.order.remove(key)
+                self.order.append(key)
+                return cached[1]
+
+        parameters = {'source': source, 'target': target}
+        names = lambda sql: sorted(row[0] for row in session.execute(text(sql), parameters))
+
+        # added and removed components are reported by the id they have in
+        # the profile they belong to
+        added, removed = names(ADDED), names(REMOVED)
+        ids = self._get_ids(session, target, added)
+        ids.update(self._get_ids(session, source, removed))
+
+        result = {
+            'added': [ids[name] for name in added],
+            'removed': [ids[name] for name in removed],
+            'changed': [{'name': name, 'from': previous, 'to': current} for name, previous, current
+                in sorted(session.execute(text(CHANGED), parameters))],
+            'affected': names(AFFECTED),
+        }
+
+        with self.guard:
+            if key in self.cache:
+                self.order.remove(key)
+            elif len(self.order) >= self.size:
+                del self.cache[self.order.pop(0)]
+            self.cache[key] = (seq, result)
+            self.order.append(key)
+        return result
+
+    def _get_ids(self, session, profile, names):
+        if not names:
+            return {}
+
+        wanted = set(names)
+        rows = session.execute(text(MEMBERS % 'profile'), {'profile': profile})
+        return dict((name, id) for id, name, version in rows if name in wanted)
+
+PROFILES = ProfileDiff()
@@ -163,3 +163,15 @@ class ProfileComponent(Model):
     component_id = ForeignKey('component.id', nullable=False, primary_key=True)
 
     component = relationship('Component')
+
+class Change(Model):
+    """A write to a component or profile, numbered by ``seq`` in the order the
+    writes were made."""
+
+    class meta:
+        schema = schema
+        tablename = 'change'
+
+    seq = Integer(nullable=False, primary_key=True)
+    resource = Enumeration('component profile', nullable=False)
+    subject = Token(segments=2, nullable=False)
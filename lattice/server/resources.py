@@ -1,6 +1,31 @@
 from mesh.standard import *
 from scheme import *
 
+Changes = {
+    'since': Integer(minimum=0, default=0, description='sequence number of the last'
+        ' change seen; only later changes are returned'),
+    'limit': Integer(minimum=1, default=1000),
+    'timeout': Integer(minimum=0, maximum=10, default=5, description='seconds to'
+        ' wait for a change when there are none yet; the server may respond sooner'
+        ' with no changes when too many requests are already waiting'),
+}
+
+ChangesResponse = Response({
+    'seq': Integer(nonnull=True, description='sequence number of the last change'
+        ' returned, to pass as since in the next request'),
+    'ids': Sequence(Token(segments=2, nonnull=True)),
+})
+
+Search = {
+    'query': Text(nonempty=True, description='words to search for, each matching'
+        ' as a prefix'),
+    'limit': Integer(minimum=1, maximum=1000, default=20),
+}
+
+SearchResponse = Response({
+    'ids': Sequence(Token(nonnull=True), description='matching ids, best first'),
+})
+
 class Project(Resource):
     """A project."""
 
@@ -22,6 +47,12 @@ class Project(Resource):
             },
             polymorphic_on=Enumeration('git svn', name='type', nonnull=True, required=True))
 
+    class search:
+        endpoint = ('SEARCH', 'project')
+        title = 'Searching projects by id and description'
+        schema = Search
+        responses = {OK: SearchResponse}
+
 Build = Structure(
     structure={
         'command': {
@@ -64,6 +95,18 @@ class Component(Resource):
         dependencies = Sequence(Token(segments=2, nonnull=True), unique=True)
         builds = Map(Build, nonnull=True)
 
+    class changes:
+        endpoint = ('CHANGES', 'component')
+        title = 'Waiting for changes to components'
+        schema = Changes
+        responses = {OK: ChangesResponse}
+
+    class search:
+        endpoint = ('SEARCH', 'component')
+        title = 'Searching components by name and description'
+        schema = Search
+        responses = {OK: SearchResponse}
+
 class Product(Resource):
     """A product stack."""
 
@@ -92,3 +135,34 @@ class Profile(Resource):
             'id': Token(segments=2, nonempty=True),
         }))
         sequence = Sequence(Text(), deferred=True)
+        resolved = Sequence(Structure(Component.mirror_schema(), nonnull=True),
+            deferred=True, readonly=True)
+
+    class changes:
+        endpoint = ('CHANGES', 'profile')
+        title = 'Waiting for changes to profiles'
+        schema = Changes
+        responses = {OK: ChangesResponse}
+
+    class diff:
+        endpoint = ('DIFF', 'profile/id')
+        specific = True
+        title = 'Comparing a profile with another'
+        schema = {
+            'target': Token(segments=2, nonempty=True, description='id of the profile'
+                ' to compare this profile with'),
+        }
+        responses = {
+            OK: Response({
+                'added': Sequence(Token(segments=2, nonnull=True)),
+                'removed': Sequence(Token(segments=2, nonnull=True)),
+                'changed': Sequence(Structure({
+                    'name': Token(segments=1, nonnull=True),
+                    'from': Token(segments=2, nonnull=True),
+                    'to': Token(segments=2, nonnull=True),
+                })),
+                'affected': Sequence(Token(segments=2, nonnull=True), description='components'
+                    ' of the target which transitively depend on one that was added,'
+                    ' removed or changed'),
+            }),
+        }
@@ -0,0 +1,183 @@
+"""Ranked full text and prefix search over registry resources.
+
+Each searchable resource has an index in an sqlite full text table, fts5 where
+sqlite has it and fts4 otherwise, kept current as resources are written. The
+index is built from the resource's table the first time it is needed, on a
+connection of its own and in a transaction which is committed at once, so that
+no request rolling back can lose it. Resources are removed from the index as they
+are deleted. Every word of a query matches the start of a word. Databases without full text search fall back to ``LIKE`` scans of the
+resource's table, which match the same way, only slower and splitting words
+at spaces alone."""
+
+import re
+from hashlib import sha1
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from lattice.server.storage import immediate_transaction
+
+TOKEN_EXPR = re.compile(r'\w+', re.UNICODE)
+
+class SearchIndex(object):
+    """A full text index named ``name`` over the ``columns`` of ``table``, each
+    given as ``(name, expression)``, with ``weights`` ranking matches in each;
+    the first column is the one matched as a prefix when full text search is
+    unavailable."""
+
+    def __init__(self, name, table, columns, weights):
+        self.columns = columns
+        self.mode = None
+        self.name = name
+        self.table = table
+        self.weights = weights
+
+    def search(self, session, query, limit=20):
+        """Returns the ids of the resources matching ``query``, best first."""
+
+        tokens = TOKEN_EXPR.findall(query.lower())
+        if not tokens:
+            return []
+
+        mode = self._prepare(session)
+        if mode == 'like':
+            return self._search_table(session, tokens, limit)
+
+        expression = ' '.join('%s*' % token for token in tokens)
+        if mode == 'fts5':
+            order = 's.rank'
+        else:
+            order = '(s.%s LIKE :prefix) DESC, length(s.%s)' % (self.columns[0][0],
+                self.columns[0][0])
+
+        sql = ('SELECT s.id FROM %s s JOIN %s t ON t.id = s.id WHERE %s MATCH :query'
+            ' ORDER BY %s LIMIT :limit' % (self.name, self.table, self.name, order))
+        rows = session.execute(text(sql), {'query': expression, 'limit': limit,
+            'prefix': tokens[0] + '%'})
+        return [row[0] for row in rows]
+
+    def prepare(self, engine):
+        """Creates and populates the index, unless it already exists, in a
+        transaction of its own on ``engine``. Requests which write call this
+        before taking the write lock, which the transaction would wait on."""
+
+        if self.mode:
+            return self.mode
+
+        if engine.dialect.name != 'sqlite':
+            self.mode = 'like'
+            return self.mode
+
+        # the write lock is taken up front, so that no other process can create
+        # the index between the check and the creation
+        connection = engine.connect()
+        try:
+            with immediate_transaction(), connection.begin():
+                row = connection.execute(text("SELECT sql FROM sqlite_master"
+                    " WHERE name = :name"), {'name': self.name}).fetchone()
+                if row:
+                    mode = 'fts5' if 'fts5' in row[0].lower() else 'fts4'
+                else:
+                    mode = self._create(connection)
+        finally:
+            connection.close()
+
+        # only cached once committed
+        self.mode = mode
+        return self.mode
+
+    def remove(self, session, id):
+        """Removes the resource ``id`` from the index."""
+
+        if self._prepare(session) != 'like':
+            session.execute(text('DELETE FROM %s WHERE rowid = :rowid' % self.name),
+                {'rowid': _get_rowid(id)})
+
+    def update(self, session, id, values):
+        """Indexes the resource ``id`` with ``values``, a map of column to text,
+        replacing whatever was indexed for it before."""
+
+        if self._prepare(session) == 'like':
+            return
+
+        rowid = _get_rowid(id)
+        session.execute(text('DELETE FROM %s WHERE rowid = :rowid' % self.name),
+            {'rowid': rowid})
+
+        names = [name for name, expression in self.columns]
+        parameters = dict((name, values.get(name) or '') for name in names)
+        parameters.update(rowid=rowid, id=id)
+        session.execute(text('INSERT INTO %s (rowid, id, %s) VALUES (:rowid, :id, %s)'
+            % (self.name, ', '.join(names), ', '.join(':%s' % n for n in names))),
+            parameters)
+
+    def _create(self, connection):
+        names = [name for name, expression in self.columns]
+        statements = [
+            ('fts5', "CREATE VIRTUAL TABLE %s USING fts5(id UNINDEXED, %s,"
+                " prefix='2 3')" % (self.name, ', '.join(names))),
+            ('fts4', 'CREATE VIRTUAL TABLE %s USING fts4(id, %s, notindexed=id,'
+                ' prefix="2,3")' % (self.name, ', '.join(names))),
+        ]
+
+        for mode, statement in statements:
+            try:
+                connection.execute(text(statement))
+            except OperationalError, exception:
+                # only a missing module means the mode is unavailable; anything
+                # else, such as a busy database, is raised rather than cached
+                if 'no such module' in str(exception):
+                    continue
+                raise
+
+            if mode == 'fts5':
+                # rank by bm25 with the weights of the columns, the id excluded
+                connection.execute(text("INSERT INTO %s (%s, rank) VALUES ('rank', 'bm25(0.0, %s)')"
+                    % (self.name, self.name, ', '.join('%.1f' % w for w in self.weights))))
+            self._populate(connection)
+            return mode
+        return 'like'
+
+    def _populate(self, connection):
+        rows = connection.execute(text('SELECT id, %s FROM %s' % (', '.join(expression
+            for name, expression in self.columns), self.table)))
+
+        names = [name for name, expression in self.columns]
+        batch = []
+        for row in rows.fetchall():
+            entry = dict((name, value or '') for name, value in zip(names, row[1:]))
+            entry.update(rowid=_get_rowid(row[0]), id=row[0])
+            batch.append(entry)
+
+        if batch:
+            connection.execute(text('INSERT INTO %s (rowid, id, %s) VALUES (:rowid, :id, %s)'
+                % (self.name, ', '.join(names), ', '.join(':%s' % n for n in names))),
+                batch)
+
+    def _prepare(self, session):
+        return self.mode or self.prepare(session.bind)
+
+    def _search_table(self, session, tokens, limit):
+        prefix, expressions = self.columns[0][1], [e for n, e in self.columns]
+        clauses, parameters = [], {'limit': limit}
+        for i, token in enumerate(tokens):
+            parameters['token%d' % i] = token + '%'
+            parameters['word%d' % i] = '% ' + token + '%'
+            clauses.append('(%s)' % ' OR '.join('lower(%s) LIKE :token%d OR lower(%s)'
+                ' LIKE :word%d' % (e, i, e, i) for e in expressions))
+
+        parameters['prefix'] = tokens[0] + '%'
+        sql = ('SELECT id FROM %s WHERE %s ORDER BY (lower(%s) LIKE :prefix) DESC,'
+            ' length(%s) LIMIT :limit' % (self.table, ' AND '.join(clauses), prefix, prefix))
+        return [row[0] for row in session.execute(text(sql), parameters)]
+
+def _get_rowid(id):
+    """Derives a stable rowid for ``id``, so that its entry is replaced through
+    the rowid index rather than by scanning the unindexed id column."""
+
+    return int(sha1(id.encode('utf8')).hexdigest()[:15], 16)
+
+COMPONENTS = SearchIndex('component_search', 'component',
+    [('name', 'name'), ('description', 'description')], [10.0, 1.0])
+PROJECTS = SearchIndex('project_search', 'project',
+    [('name', 'id'), ('description', 'description')], [10.0, 1.0])
@@ -0,0 +1,70 @@
+"""Connection settings for sqlite databases, under which several uwsgi workers
+write to the same file.
+
+Every connection journals to a write-ahead log, so that readers never block
+writers or each other, and waits up to ``BUSY_TIMEOUT`` milliseconds for a lock
+rather than failing with "database is locked".
+
+Transactions which will write begin with ``BEGIN IMMEDIATE``, taking the write
+lock up front: a transaction which reads and then writes, as the delete and
+reinsert of builds and profile components does, otherwise fails at once when
+another worker wrote in between, since sqlite cannot wait out that conflict.
+Every other transaction begins deferred, so reads take no lock at all."""
+
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+BUSY_TIMEOUT = 30000
+CACHE_SIZE = -16384
+
+_state = threading.local()
+
+@event.listens_for(Engine, 'do_connect')
+def connect(dialect, record, cargs, cparams):
+    """Opens and configures the connections of sqlite engines, whichever of the
+    sqlite3 and pysqlite2 modules the dialect uses."""
+
+    if dialect.name != 'sqlite':
+        return
+
+    connection = dialect.connect(*cargs, **cparams)
+
+    # pysqlite begins transactions itself, lazily and deferred; leave that to
+    # the begin listener below
+    connection.isolation_level = None
+
+    cursor = connection.cursor()
+    try:
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout=%d' % BUSY_TIMEOUT)
+        cursor.execute('PRAGMA cache_size=%d' % CACHE_SIZE)
+    finally:
+        cursor.close()
+    return connection
+
+@event.listens_for(Engine, 'begin')
+def begin_transaction(connection):
+    if connection.dialect.name == 'sqlite':
+        if getattr(_state, 'immediate', False):
+            connection.execute('BEGIN IMMEDIATE')
+        else:
+            connection.execute('BEGIN')
+
+@contextmanager
+def immediate_transaction(session=None):
+    """Begins the transactions of the body with ``BEGIN IMMEDIATE``. A
+    transaction ``session`` already began can only have read, so it is ended
+    first; whatever it loaded is reloaded under the write lock."""
+
+    if session is not None:
+        session.rollback()
+    previous = getattr(_state, 'immediate', False)
+    _state.immediate = True
+    try:
+        yield
+    finally:
+        _state.immediate = previous
@@ -0,0 +1,159 @@
+import json
+from urlparse import parse_qs
+
+from spire.schema import SchemaDependency
+from spire.wsgi.util import Mount
+from sqlalchemy.orm import Session, joinedload
+
+from lattice.server.models import Build, Component, ComponentDependencies
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+BATCH_SIZE = 500
+NDJSON = 'application/x-ndjson'
+MSGPACK = 'application/x-msgpack'
+
+class ComponentStream(Mount):
+    """Streams the components of the registry, one record at a time.
+
+    Components are read in batches, keyed on their ids, and each batch is
+    written out before the next is read, so that a listing of any size is
+    served in constant memory and clients can process it as it arrives. The
+    records are newline delimited json or, if the client accepts it and msgpack
+    is installed, a sequence of msgpack objects. ``status`` and ``name`` filter
+    the components; ``include=dependencies`` adds their dependencies.
+
+    The response is read after ``dispatch`` has returned, when the request's
+    session may already have been closed or handed to another request, so the
+    stream reads through a session of its own, closed when the stream ends."""
+
+    schema = SchemaDependency('lattice')
+
+    def dispatch(self, environ, start_response):
+        if environ['REQUEST_METHOD'] != 'GET':
+            start_response('405 Method Not Allowed', [('Allow', 'GET')])
+            return []
+
+        mimetype = negotiate_format(environ.get('HTTP_ACCEPT'))
+        if not mimetype:
+            start_response('406 Not Acceptable', [('Content-Type', 'text/plain')])
+            return ['acceptable formats: %s\n' % ', '.join(get_formats())]
+
+        parameters = parse_qs(environ.get('QUERY_STRING') or '')
+        include = set()
+        for value in parameters.get('include', []):
+            include.update(value.split(','))
+
+        encode = _encode_msgpack if mimetype == MSGPACK else _encode_ndjson
+        start_response('200 OK', [('Content-Type', mimetype)])
+        return self._stream(self.schema.session.bind, parameters, include, encode)
+
+    def _iterate_batches(self, session, parameters, include):
+        """Yields the records of the requested components a batch at a time.
+        Each batch is read in full, with its builds and dependencies, and the
+        transaction ended before the batch is yielded, so that a slow client
+        never holds the database while writers wait."""
+
+        last = None
+        while True:
+            query = session.query(Component).options(joinedload(Component.repository))
+            for attr in ('name', 'status'):
+                if attr in parameters:
+                    query = query.filter(getattr(Component, attr).in_(parameters[attr]))
+            if last is not None:
+                query = query.filter(Component.id > last)
+
+            batch = query.order_by(Component.id).limit(BATCH_SIZE).all()
+            if not batch:
+                session.rollback()
+                return
+
+            last = batch[-1].id
+            records = self._read_batch(session, batch, include)
+
+            session.rollback()
+            session.expunge_all()
+            yield records
+
+    def _read_batch(self, session, batch, include):
+        ids = [component.id for component in batch]
+
+        builds = dict((id, {}) for id in ids)
+        for build in session.query(Build).filter(Build.component_id.in_(ids)):
+            builds[build.component_id][build.name] = build.extract_dict(
+                exclude=['id', 'component_id', 'name'])
+
+        dependencies = None
+        if 'dependencies' in include:
+            dependencies = dict((id, []) for id in ids)
+            query = (session.query(ComponentDependencies)
+                .filter(ComponentDependencies.c.component_id.in_(ids)))
+            for component_id, dependency_id in query:
+                dependencies[component_id].append(dependency_id)
+
+        records = []
+        for component in batch:
+            record = {'id': component.id, 'name': component.name,
+                'version': component.version, 'status': component.status,
+                'description': component.description, 'builds': builds[component.id]}
+            if component.timestamp:
+                record['timestamp'] = component.timestamp.isoformat()
+            if component.repository:
+                record['repository'] = component.repository.extract_dict(
+                    exclude=['id', 'component_id'])
+            if dependencies is not None:
+                record['dependencies'] = sorted(dependencies[component.id])
+            records.append(record)
+        return records
+
+    def _stream(self, engine, parameters, include, encode):
+        session = Session(bind=engine)
+        try:
+            for records in self._iterate_batches(session, parameters, include):
+                yield ''.join(encode(record) for record in records)
+        finally:
+            session.close()
+
+def get_formats():
+    formats = [NDJSON]
+    if msgpack:
+        formats.append(MSGPACK)
+    return formats
+
+def negotiate_format(accept):
+    """Returns the format to respond with for the ``Accept`` header ``accept``,
+    or ``None`` if none of the available formats is acceptable."""
+
+    if not accept:
+        return NDJSON
+
+    candidates = []
+    for index, item in enumerate(accept.split(',')):
+        tokens = [token.strip() for token in item.split(';')]
+        quality = 1.0
+        for token in tokens[1:]:
+            if token.startswith('q='):
+                try:
+                    quality = float(token[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            candidates.append((-quality, index, tokens[0].lower()))
+
+    formats = get_formats()
+    for quality, index, mimetype in sorted(candidates):
+        if mimetype in ('*/*', 'application/*'):
+            return NDJSON
+        if mimetype == 'application/msgpack':
+            mimetype = MSGPACK
+        if mimetype in formats:
+            return mimetype
+
+def _encode_msgpack(record):
+    return msgpack.packb(record)
+
+def _encode_ndjson(record):
+    return json.dumps(record, separators=(',', ':')) + '\n'
@@ -0,0 +1,337 @@
+import errno
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+from distutils.spawn import find_executable
+from hashlib import sha1
+
+from bake.path import path
+
+BLOCK_SIZE = 1048576
+DECOMPRESSORS = ('lbzip2', 'pbzip2')
+DIGEST_SUFFIX = '.sha1'
+LINK_ERRORS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP)
+
+class ArtifactError(Exception):
+    """An artifact which does not match its digest."""
+
+def link_or_copy(source, target):
+    """Places a copy of ``source`` at ``target``, hardlinking instead of copying
+    when both are on the same filesystem. ``target`` is replaced atomically."""
+
+    source, target = path(source), path(target)
+    if target.isdir():
+        target = target / source.basename()
+    if target.exists() and target.samefile(source):
+        return target
+
+    partial = _get_partial_path(target)
+    _discard(partial)
+    try:
+        os.link(source, partial)
+    except OSError as exception:
+        if exception.errno not in LINK_ERRORS:
+            raise
+        shutil.copy2(source, partial)
+
+    os.rename(partial, target)
+    return target
+
+def extract_artifact(source, destination, copies=(), digest=None):
+    """Extracts the bzipped tarball ``source`` into ``destination`` with a single
+    sequential read of ``source``.
+
+    Each of ``copies`` receives a copy of the tarball: copies on the same
+    filesystem as ``source`` are hardlinked, the rest are written from the same
+    read which feeds the decompressor.
+
+    The read is hashed and compared with ``digest``, or the digest in the
+    sidecar of ``source`` if none is given; on a mismatch no copy is made and
+    ``ArtifactError`` is raised, leaving ``remove_extracted`` to clear whatever
+    was extracted."""
+
+    source = path(source)
+    device = _get_device(source)
+    digest = digest or read_digest(source)
+
+    targets, links = [], []
+    for copy in copies:
+        copy = path(copy)
+        if _get_device(copy) == device:
+            links.append(copy)
+        else:
+            targets.append(copy)
+
+    reader = TeeReader(open(source, 'rb'), targets)
+    try:
+        try:
+            decompressor = _find_decompressor()
+            if decompressor:
+                _extract_with_tar(reader, destination, decompressor)
+            else:
+                openfile = tarfile.open(fileobj=reader, mode='r|bz2')
+                try:
+                    openfile.extractall(str(destination))
+                finally:
+                    openfile.close()
+        except Exception:
+            # a corrupt artifact usually fails to extract; report it as such
+            error = sys.exc_info()
+            if digest:
+                reader.drain()
+                if reader.hash.hexdigest() != digest:
+                    raise ArtifactError('%s does not match its digest' % source.basename())
+            raise error[0], error[1], error[2]
+
+        reader.drain()
+        if digest and reader.hash.hexdigest() != digest:
+            raise ArtifactError('%s does not match its digest' % source.basename())
+    except:
+        reader.close(discard=True)
+        raise
+    else:
+        reader.close()
+
+    for copy in links:
+        copy = link_or_copy(source, copy)
+        if digest:
+            write_digest(copy, digest)
+
+def get_digest_path(filename):
+    return path('%s%s' % (filename, DIGEST_SUFFIX))
+
+def hash_file(filename):
+    hash = sha1()
+    openfile = open(filename, 'rb')
+    try:
+        while True:
+            data = openfile.read(BLOCK_SIZE)
+            if not data:
+                return hash.hexdigest()
+            hash.update(data)
+    finally:
+        openfile.close()
+
+def read_digest(filename):
+    """Returns the digest recorded in the sidecar of ``filename``, or ``None`` if
+    it has none."""
+
+    try:
+        return get_digest_path(filename).bytes().strip() or None
+    except (IOError, OSError):
+        return None
+
+def remove_extracted(source, destination):
+    """Removes from ``destination`` the files which extracting the tarball
+    ``source`` placed there, as far as ``source`` can be read, along with the
+    directories this leaves empty."""
+
+    try:
+        openfile = tarfile.open(str(source), 'r|bz2')
+    except (EnvironmentError, EOFError, tarfile.TarError):
+        return
+    remove_members(openfile, destination)
+
+def remove_members(openfile, destination):
+    """Removes from ``destination`` the members of the open tar stream
+    ``openfile``, as far as it can be read, along with the directories this
+    leaves empty; ``openfile`` is closed."""
+
+    destination = path(destination)
+    directories = set()
+    try:
+        try:
+            for info in openfile:
+                name = os.path.normpath(info.name).lstrip('/')
+                if name in ('', '.') or name.startswith('..'):
+                    continue
+
+                target = destination / name
+                if info.isdir():
+                    directories.add(target)
+                else:
+                    _discard(target)
+        finally:
+            openfile.close()
+    except (EnvironmentError, EOFError, tarfile.TarError):
+        pass
+
+    for directory in sorted(directories, reverse=True):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+
+def verify_artifact(filename):
+    """Hashes ``filename`` and compares it with the digest in its sidecar,
+    returning ``None`` if it has no sidecar to compare against."""
+
+    digest = read_digest(filename)
+    if not digest:
+        return None
+    return hash_file(filename) == digest
+
+def write_digest(filename, digest):
+    sidecar = get_digest_path(filename)
+    partial = _get_partial_path(sidecar)
+    partial.write_bytes(digest + '\n')
+    os.rename(partial, sidecar)
+
+class ArtifactStream(object):
+    """A single artifact write placed into one or more destinations.
+
+    The artifact is written once, to the partial file of the first destination
+    exposed as ``path``; once the write completes, destinations sharing its
+    filesystem are hardlinked to it and the rest are copied from the single
+    read which hashes it. All destinations are replaced atomically, so a failed
+    write never leaves a truncated artifact behind, and each gets a sidecar
+    holding the digest, written before the destination itself."""
+
+    def __init__(self, *targets):
+        self.digest = None
+        self.directory = None
+        self.path = None
+        self.size = 0
+
+        self.primary = []
+        self.links = []
+
+        devices = {}
+        for target in targets:
+            if not target:
+                continue
+            target = path(target).abspath()
+            device = _get_device(target)
+            if device in devices:
+                self.links.append((devices[device], target))
+            else:
+                devices[device] = target
+                self.primary.append(target)
+
+    def __enter__(self):
+        if self.primary:
+            self.path = str(_get_partial_path(self.primary[0]))
+        else:
+            self.directory = path(tempfile.mkdtemp(prefix='lattice'))
+            self.path = str(self.directory / 'artifact')
+
+        _discard(self.path)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        try:
+            if type is None:
+                self._place()
+        finally:
+            if self.directory:
+                self.directory.rmtree_p()
+            for target in self.primary:
+                _discard(_get_partial_path(target))
+        return False
+
+    def _place(self):
+        reader = TeeReader(open(self.path, 'rb'), self.primary[1:])
+        try:
+            reader.drain()
+        except:
+            reader.close(discard=True)
+            raise
+        else:
+            reader.close()
+
+        self.digest = reader.hash.hexdigest()
+        self.size = reader.size
+        if not self.primary:
+            return
+
+        target = self.primary[0]
+        write_digest(target, self.digest)
+        os.rename(self.path, target)
+        for source, target in self.links:
+            write_digest(target, self.digest)
+            link_or_copy(source, target)
+
+class TeeReader(object):
+    """A readable file which copies everything read from it into ``targets``,
+    hashing it on the way; each target gets a sidecar holding the digest."""
+
+    def __init__(self, source, targets=()):
+        self.hash = sha1()
+        self.source = source
+        self.size = 0
+        self.targets = [path(t) for t in targets]
+        self.openfiles = [open(_get_partial_path(t), 'wb') for t in self.targets]
+
+    def close(self, discard=False):
+        self.source.close()
+        for openfile in self.openfiles:
+            openfile.close()
+
+        for target in self.targets:
+            partial = _get_partial_path(target)
+            if discard:
+                _discard(partial)
+            else:
+                write_digest(target, self.hash.hexdigest())
+                os.rename(partial, target)
+
+    def drain(self):
+        while self.read(BLOCK_SIZE):
+            pass
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        if data:
+            self._consume(data)
+        return data
+
+    def _consume(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        for openfile in self.openfiles:
+            openfile.write(data)
+
+def _discard(filename):
+    try:
+        os.unlink(filename)
+    except OSError:
+        pass
+
+def _extract_with_tar(reader, destination, decompressor):
+    errors = tempfile.TemporaryFile()
+    process = subprocess.Popen(['tar', '-x', '--use-compress-program', decompressor,
+        '-C', str(destination), '-f', '-'], stdin=subprocess.PIPE, stderr=errors)
+
+    try:
+        while True:
+            data = reader.read(BLOCK_SIZE)
+            if not data:
+                break
+            process.stdin.write(data)
+    except IOError as exception:
+        if exception.errno != errno.EPIPE:
+            raise
+    finally:
+        process.stdin.close()
+
+    if process.wait() != 0:
+        errors.seek(0)
+        raise RuntimeError(errors.read())
+
+def _find_decompressor():
+    for candidate in DECOMPRESSORS:
+        executable = find_executable(candidate)
+        if executable:
+            return executable
+
+def _get_device(filename):
+    filename = path(filename)
+    if not filename.exists():
+        filename = filename.parent
+    return os.stat(filename).st_dev
+
+def _get_partial_path(filename):
+    return path('%s.partial' % filename)
@@ -0,0 +1,293 @@
+import json
+import os
+import random
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from timeit import default_timer
+
+from bake.path import path
+
+SHAPES = ('chain', 'wide', 'layered', 'random')
+
+def generate_graph(size, shape='layered', seed=0):
+    """Generates a dependency graph of ``size`` components named ``c0000`` onwards,
+    as a map of component name to the list of names it depends on. The graph is
+    always acyclic and depends only on ``size``, ``shape`` and ``seed``."""
+
+    generator = random.Random(seed)
+    names = ['c%04d' % i for i in range(size)]
+
+    graph = {}
+    for i, name in enumerate(names):
+        if i == 0:
+            dependencies = []
+        elif shape == 'chain':
+            dependencies = [names[i - 1]]
+        elif shape == 'wide':
+            dependencies = [names[0]]
+        elif shape == 'layered':
+            width = max(1, int(size ** 0.5))
+            layer = i // width
+            if layer == 0:
+                dependencies = []
+            else:
+                previous = names[(layer - 1) * width:layer * width]
+                dependencies = generator.sample(previous, min(len(previous), 3))
+        elif shape == 'random':
+            dependencies = generator.sample(names[:i], min(i, generator.randint(0, 4)))
+        else:
+            raise ValueError(shape)
+        graph[name] = sorted(dependencies)
+    return graph
+
+def generate_profile(graph, url, command=None):
+    """Generates a profile of trivial ``command`` builds for ``graph``, with every
+    component checked out from the git repository at ``url``."""
+
+    components = []
+    for name in sorted(graph):
+        components.append({
+            'name': name,
+            'version': 'HEAD',
+            'dependencies': list(graph[name]),
+            'repository': {'type': 'git', 'url': url},
+            'builds': {'default': {'command': command or
+                'mkdir -p "$BUILDPATH/%s" && echo %s > "$BUILDPATH/%s/file"'
+                    % (name, name, name)}},
+        })
+    return {'name': 'benchmark', 'version': '1.0.0', 'components': components}
+
+def generate_specification(size, version='1.0.0'):
+    lines = ['components:']
+    for i in range(size):
+        lines.extend([
+            '  - name: c%04d' % i,
+            '    version: %s' % version,
+            '    description: synthetic component %d' % i,
+            '    dependencies: [%s]' % ', '.join('c%04d' % d for d in range(max(0, i - 2), i)),
+            '    builds:',
+            '      default:',
+            '        command: make install',
+        ])
+    return '\n'.join(lines) + '\n'
+
+def generate_repository(root, tags, components=5):
+    """Creates a local git repository at ``root`` with ``tags`` tagged commits,
+    each carrying a lattice.yaml describing ``components`` components."""
+
+    root = path(root)
+    root.makedirs_p()
+
+    def git(*tokens):
+        subprocess.check_call(['git'] + list(tokens), cwd=str(root),
+            stdout=open('/dev/null', 'w'))
+
+    git('init', '-q')
+    git('config', 'user.email', 'benchmark@lattice')
+    git('config', 'user.name', 'benchmark')
+
+    for i in range(max(tags, 1)):
+        version = '1.0.%d' % i
+        (root / 'lattice.yaml').write_bytes(generate_specification(components, version))
+        git('add', 'lattice.yaml')
+        git('commit', '-q', '-m', 'release %s' % version)
+        if i < tags:
+            git('tag', 'v%s' % version)
+    return root
+
+def generate_tree(root, files, size=4096, seed=0):
+    generator = random.Random(seed)
+    root = path(root)
+    for i in range(files):
+        directory = root / ('d%02d' % (i % 16))
+        directory.makedirs_p()
+        content = ''.join(chr(generator.randint(32, 126)) for _ in range(64))
+        (directory / ('f%05d' % i)).write_bytes(content * (size // 64))
+    return root
+
+def run_interpreter(statement):
+    """Runs ``statement`` in a fresh interpreter, so that nothing already imported
+    by this process is reused."""
+
+    search = [os.path.abspath(p) for p in sys.path if p]
+    environ = dict(os.environ, PYTHONPATH=os.pathsep.join(search))
+    subprocess.check_call([sys.executable, '-c', statement], env=environ)
+
+def write_tarball(source, filename):
+    openfile = tarfile.open(filename, 'w:bz2')
+    try:
+        openfile.add(str(source), '.')
+    finally:
+        openfile.close()
+
+class Benchmark(object):
+    """A single timed hot path. ``setup`` is called before each iteration and its
+    return value passed to ``function``; only ``function`` is timed."""
+
+    def __init__(self, name, function, setup=None, teardown=None):
+        self.function = function
+        self.name = name
+        self.setup = setup
+        self.teardown = teardown
+
+    def run(self, iterations):
+        timings = []
+        for i in range(iterations):
+            state = self.setup() if self.setup else None
+            try:
+                start = default_timer()
+                self.function(state)
+                timings.append(default_timer() - start)
+            finally:
+                if self.teardown:
+                    self.teardown(state)
+
+        timings.sort()
+        return {'minimum': timings[0], 'median': timings[len(timings) // 2],
+            'iterations': iterations}
+
+class BenchmarkSuite(object):
+    def __init__(self, benchmarks=None):
+        self.benchmarks = benchmarks or []
+
+    def add(self, name, function, setup=None, teardown=None):
+        self.benchmarks.append(Benchmark(name, function, setup, teardown))
+
+    def run(self, iterations=5, only=None, report=None):
+        results = {}
+        for benchmark in self.benchmarks:
+            if only and benchmark.name not in only:
+                continue
+            results[benchmark.name] = result = benchmark.run(iterations)
+            if report:
+                report(benchmark.name, result)
+        return results
+
+def compare_results(results, baseline, tolerance):
+    """Compares the minimum timing of each result with ``baseline``, returning a
+    list of ``(name, baseline, current)`` for every benchmark which is slower
+    than its baseline by more than ``tolerance``."""
+
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        expected = baseline.get(name)
+        if expected and result['minimum'] > expected['minimum'] * (1 + tolerance):
+            regressions.append((name, expected['minimum'], result['minimum']))
+    return regressions
+
+def load_baseline(filename):
+    filename = path(filename)
+    if filename.exists():
+        return json.loads(filename.bytes())
+    else:
+        return {}
+
+def save_baseline(filename, results):
+    path(filename).write_bytes(json.dumps(results, indent=2, sort_keys=True) + '\n')
+
+def temporary_directory():
+    return path(tempfile.mkdtemp(prefix='lattice-benchmark'))
+
+def create_storage(url, components, builds):
+    """Creates a registry database at ``url`` holding ``components`` components
+    of ``builds`` builds each, for ``run_storage_worker`` to load."""
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from lattice.server.models import CommandBuild, Component, schema
+    import lattice.server.storage
+
+    engine = create_engine(url)
+    schema.metadata.create_all(engine)
+
+    session = sessionmaker(bind=engine)()
+    try:
+        for i in range(components):
+            component = Component(id='c%05d:1.0' % i, name='c%05d' % i, version='1.0')
+            for j in range(builds):
+                component.builds.append(CommandBuild(name='b%d' % j, command='make'))
+            session.add(component)
+        session.commit()
+    finally:
+        session.close()
+        engine.dispose()
+
+def run_storage_worker(url, role, duration, components, builds, results, seed=0):
+    """Writes to or reads from the registry database at ``url`` for ``duration``
+    seconds, as registry requests would, and puts the number of operations, the
+    number which failed and their sorted latencies on ``results``.
+
+    A write is an update of a component replacing all of its builds, made by
+    the component controller's own write path: its transaction, change feed and
+    search index. A read fetches a component with its builds, as a ``get``
+    request does."""
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.exc import OperationalError
+    from sqlalchemy.orm import sessionmaker
+    from lattice.server.models import Component
+
+    engine = create_engine(url)
+    session = sessionmaker(bind=engine)()
+    controller = _construct_storage_controller(session)
+    generator = random.Random(seed)
+
+    operations, failures, latencies = 0, 0, []
+    try:
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            id = 'c%05d:1.0' % generator.randrange(components)
+            start = default_timer()
+            try:
+                if role == 'write':
+                    controller.update(None, lambda response: None,
+                        session.query(Component).get(id), {'description': 'written %d'
+                        % operations, 'builds': dict(('b%d' % j, {'strategy': 'command',
+                        'command': 'make %d' % operations}) for j in range(builds))})
+                else:
+                    component = session.query(Component).get(id)
+                    for build in component.builds:
+                        build.extract_dict()
+                    session.rollback()
+            except OperationalError:
+                session.rollback()
+                failures += 1
+            else:
+                latencies.append(default_timer() - start)
+            operations += 1
+    finally:
+        session.close()
+        engine.dispose()
+
+    latencies.sort()
+    results.put({'role': role, 'operations': operations, 'failures': failures,
+        'latencies': latencies})
+
+def _construct_storage_controller(session):
+    """Constructs the write path of ``ComponentController`` (its transactions,
+    change feed, search index and annotation of builds) over ``session``, with
+    ``ModelController`` stood in for by the little an update needs of it."""
+
+    from lattice.server.controllers.changes import ChangeFeed
+    from lattice.server.controllers.component import ComponentController
+    from lattice.server.controllers.search import Searchable
+    from lattice.server.controllers.transactions import WriteTransactions
+
+    class ModelUpdates(object):
+        def update(self, request, response, subject, data):
+            subject.description = data['description']
+            self._annotate_model(subject, data)
+            self.schema.session.commit()
+            response({'id': subject.id})
+
+    class StorageController(WriteTransactions, Searchable, ChangeFeed, ModelUpdates):
+        resource = ComponentController.resource
+        search_index = ComponentController.search_index
+        _annotate_model = ComponentController.__dict__['_annotate_model']
+
+    controller = StorageController()
+    controller.schema = type('Schema', (object,), {'session': session})()
+    return controller
@@ -0,0 +1,77 @@
+import os
+import subprocess
+
+from bake.path import path
+
+MASQUERADE_DIRECTORIES = ('/usr/lib/ccache', '/usr/lib64/ccache', '/usr/local/lib/ccache')
+
+class CompilerCache(object):
+    """A ccache directory shared by the components of a profile.
+
+    Components build in uniquely named source directories, so the source
+    directory is made the base directory of each build; ccache then rewrites
+    paths beneath it as relative paths, and doesn't hash the working directory,
+    so a component hits the cache no matter which directory it was built in."""
+
+    def __init__(self, directory):
+        self.directory = path(directory).abspath()
+
+    def get_environ(self, basedir=None, environ=None):
+        environ = dict(environ or {})
+        environ['CCACHE_DIR'] = str(self.directory)
+        environ['CCACHE_NOHASHDIR'] = '1'
+        if basedir:
+            environ['CCACHE_BASEDIR'] = str(basedir)
+
+        for directory in MASQUERADE_DIRECTORIES:
+            if os.path.isdir(directory):
+                search = environ.get('PATH') or os.environ.get('PATH', '')
+                if directory not in search.split(os.pathsep):
+                    environ['PATH'] = os.pathsep.join([directory, search])
+                break
+        return environ
+
+    def get_statistics(self):
+        """Returns the hit and miss counters of the cache, or ``None`` if they
+        cannot be read (ccache isn't installed, or predates ``--print-stats``)."""
+
+        environ = dict(os.environ, CCACHE_DIR=str(self.directory))
+        devnull = open(os.devnull, 'w')
+        try:
+            process = subprocess.Popen(['ccache', '--print-stats'], env=environ,
+                stdout=subprocess.PIPE, stderr=devnull)
+            output = process.communicate()[0]
+        except OSError:
+            return None
+        finally:
+            devnull.close()
+
+        if process.returncode != 0:
+            return None
+
+        counters = {}
+        for line in output.splitlines():
+            tokens = line.split('\t')
+            if len(tokens) == 2 and tokens[1].isdigit():
+                counters[tokens[0]] = int(tokens[1])
+
+        return {
+            'hits': counters.get('direct_cache_hit', 0)
+                + counters.get('preprocessed_cache_hit', 0),
+            'misses': counters.get('cache_miss', 0),
+        }
+
+def format_hit_rate(before, after):
+    """Describes the cache activity between two samples of ``get_statistics``,
+    or returns ``None`` if nothing was compiled."""
+
+    if not (before and after):
+        return None
+
+    hits = after['hits'] - before['hits']
+    misses = after['misses'] - before['misses']
+    if hits + misses <= 0:
+        return None
+
+    return '%d hits, %d misses (%.0f%% hit rate)' % (hits, misses,
+        100.0 * hits / (hits + misses))
@@ -0,0 +1,470 @@
+import base64
+import bz2
+import json
+import os
+import subprocess
+import tarfile
+import zlib
+from hashlib import sha1
+
+from bake.path import path
+
+from lattice.support.artifact import (ArtifactError, hash_file, read_digest, remove_members,
+    write_digest)
+
+ANCHOR = '\n'
+BLOCK_SIZE = 1048576
+BOUNDARY_MASK = 0xfff
+HEADER_SIZE = 512
+MAXIMUM_GROUP = 4 * 1048576
+MINIMUM_CHUNK = 262144
+WINDOW_SIZE = 48
+EMPTY_TYPES = ('1', '2', '3', '4', '5', '6')
+METADATA_TYPES = ('L', 'K', 'x', 'g')
+
+class ChunkStore(object):
+    """A deduplicating store of component artifacts.
+
+    Artifacts are kept as the chunks of their uncompressed tar stream, plus a
+    small manifest per artifact. Chunk boundaries follow tar members: the data
+    of small members is grouped into chunks which end wherever a member's
+    content says so, and large members are split into chunks of their own at
+    boundaries defined by their content, so a member which is unchanged between
+    two versions of a component lands in the same chunks, and an edit to a
+    large member changes only the chunks around it. Member headers, which carry
+    mtimes, live in the manifest.
+
+    Tarballs are rebuilt from the tar stream rather than stored, so a rebuilt
+    tarball is byte-identical to the one added only when both were compressed
+    alike, as by the bz2 module at its default level. The manifest records the
+    digest of the tarball added and of its tar stream; the stream is verified
+    whenever it is rebuilt, and the rebuilt tarball gets a sidecar of its own.
+
+    A store may have an ``upstream`` store, typically on shared storage; chunks
+    and manifests are published to it and fetched from it only when they are
+    missing locally.
+
+    Every chunk read is checked against its identifier, the sha1 of its data.
+    A chunk which is missing or corrupt fails the read with ``ArtifactError``,
+    and a corrupt one is dropped, so that the next artifact to contain it stores
+    it afresh."""
+
+    def __init__(self, directory, upstream=None):
+        self.directory = path(directory)
+        self.upstream = upstream
+
+    def add(self, filename, name=None):
+        """Adds the bzipped tarball ``filename`` to the store, returning the
+        number of chunks in it and the number and size of those which are new."""
+
+        name = name or path(filename).basename()
+        manifest = {'chunks': [], 'members': []}
+        summary = {'chunks': 0, 'new_chunks': 0, 'new_bytes': 0}
+
+        def add_chunk(data):
+            identifier = sha1(data).hexdigest()
+            written = self._write_chunk(identifier, data)
+            manifest['chunks'].append([identifier, len(data)])
+            summary['chunks'] += 1
+            if written:
+                summary['new_chunks'] += 1
+                summary['new_bytes'] += written
+
+        reader = _DecompressingReader(open(filename, 'rb'))
+        try:
+            group, size = [], 0
+            for header, length in _iterate_members(reader):
+                manifest['members'].append([base64.b64encode(header), length])
+                if length > BLOCK_SIZE:
+                    if group:
+                        add_chunk(''.join(group))
+                        group, size = [], 0
+                    _split_member(reader, length, add_chunk)
+                elif length:
+                    data = reader.read_exactly(length)
+                    group.append(data)
+                    size += length
+                    if size >= MAXIMUM_GROUP or ord(sha1(data).digest()[0]) & 0x0f == 0:
+                        add_chunk(''.join(group))
+                        group, size = [], 0
+
+            if group:
+                add_chunk(''.join(group))
+            manifest['trailer'] = reader.drain()
+            manifest['stream'] = reader.hash.hexdigest()
+        finally:
+            reader.close()
+
+        manifest['digest'] = read_digest(filename) or hash_file(filename)
+
+        self._write_manifest(name, manifest)
+        return summary
+
+    def extract(self, name, destination, tarball=None):
+        """Unpacks the artifact ``name`` into ``destination`` straight from its
+        chunks, rebuilding its bzipped tarball at ``tarball`` from the same pass
+        if requested."""
+
+        manifest = self._read_manifest(name)
+        process = subprocess.Popen(['tar', '-x', '-f', '-', '-C', str(destination)],
+            stdin=subprocess.PIPE)
+
+        writer = None
+        if tarball:
+            writer = _CompressingWriter(tarball)
+
+        try:
+            for data in self._iterate_stream(manifest):
+                process.stdin.write(data)
+                if writer:
+                    writer.write(data)
+        except:
+            process.kill()
+            process.wait()
+            if writer:
+                writer.close(discard=True)
+            raise
+
+        process.stdin.close()
+        if process.wait() != 0:
+            if writer:
+                writer.close(discard=True)
+            raise RuntimeError('extracting %s failed' % name)
+        if writer:
+            writer.close()
+
+    def remove_extracted(self, name, destination):
+        """Removes from ``destination`` the files which extracting the artifact
+        ``name`` placed there, along with the directories this leaves empty."""
+
+        manifest = self._read_manifest(name)
+        stream = _StreamReader(self._iterate_skeleton(manifest))
+        remove_members(tarfile.open(fileobj=stream, mode='r|'), destination)
+
+    def has(self, name):
+        if self._get_manifest_path(name).exists():
+            return True
+        return self.upstream is not None and self.upstream.has(name)
+
+    def restore(self, name, tarball):
+        """Rebuilds the bzipped tarball of the artifact ``name`` at ``tarball``."""
+
+        writer = _CompressingWriter(tarball)
+        try:
+            for data in self._iterate_stream(self._read_manifest(name)):
+                writer.write(data)
+        except:
+            writer.close(discard=True)
+            raise
+        writer.close()
+
+    def _get_chunk_path(self, identifier):
+        return self.directory / 'chunks' / identifier[:2] / identifier
+
+    def _get_manifest_path(self, name):
+        return self.directory / 'manifests' / ('%s.manifest' % name)
+
+    def _discard_chunk(self, identifier):
+        _discard(self._get_chunk_path(identifier))
+        if self.upstream is not None:
+            self.upstream._discard_chunk(identifier)
+
+    def _iterate_skeleton(self, manifest):
+        """Yields the tar stream of ``manifest`` with the data of every member
+        zeroed, which lists its members without reading any chunk."""
+
+        for header, length in manifest['members']:
+            yield base64.b64decode(header)
+            while length > 0:
+                size = min(length, BLOCK_SIZE)
+                yield '\0' * size
+                length -= size
+
+        yield '\0' * manifest['trailer']
+
+    def _iterate_stream(self, manifest):
+        """Yields the tar stream of ``manifest``, raising ``ArtifactError`` at its
+        end if it does not match the stream which was added."""
+
+        chunks = iter(manifest['chunks'])
+        buffered, offset = '', 0
+        hash = sha1()
+
+        for header, length in manifest['members']:
+            header = base64.b64decode(header)
+            hash.update(header)
+            yield header
+            while length > 0:
+                if offset == len(buffered):
+                    buffered, offset = self._read_chunk(chunks.next()[0]), 0
+                data = buffered[offset:offset + length]
+                offset += len(data)
+                length -= len(data)
+                hash.update(data)
+                yield data
+
+        trailer = manifest['trailer']
+        while trailer > 0:
+            size = min(trailer, BLOCK_SIZE)
+            hash.update('\0' * size)
+            yield '\0' * size
+            trailer -= size
+
+        if manifest.get('stream') and hash.hexdigest() != manifest['stream']:
+            raise ArtifactError('the tar stream rebuilt from the store does not match'
+                ' its digest')
+
+    def _read_chunk(self, identifier):
+        content = self._read_compressed(self._get_chunk_path(identifier),
+            lambda store: store._get_chunk_path(identifier))
+        try:
+            data = zlib.decompress(content)
+        except zlib.error:
+            data = None
+
+        if data is None or sha1(data).hexdigest() != identifier:
+            self._discard_chunk(identifier)
+            raise ArtifactError('chunk %s does not match its digest' % identifier)
+        return data
+
+    def _read_compressed(self, filename, locate):
+        """Reads ``filename``, fetching it from the upstream store into this one
+        first if it isn't here yet."""
+
+        if not filename.exists():
+            if self.upstream is None:
+                raise ArtifactError('%s is missing from the store' % filename.basename())
+            content = self.upstream._read_compressed(locate(self.upstream), locate)
+            _write_atomically(filename, content)
+            return content
+        return filename.bytes()
+
+    def _read_manifest(self, name):
+        return json.loads(zlib.decompress(self._read_compressed(self._get_manifest_path(name),
+            lambda store: store._get_manifest_path(name))))
+
+    def _write_chunk(self, identifier, data, content=None):
+        written = 0
+        filename = self._get_chunk_path(identifier)
+        if not filename.exists():
+            content = content or zlib.compress(data, 6)
+            _write_atomically(filename, content)
+            written = len(content)
+
+        if self.upstream is not None:
+            self.upstream._write_chunk(identifier, data, content)
+        return written
+
+    def _write_manifest(self, name, manifest):
+        content = zlib.compress(json.dumps(manifest, separators=(',', ':')), 9)
+        _write_atomically(self._get_manifest_path(name), content)
+        if self.upstream is not None:
+            self.upstream._write_manifest(name, manifest)
+
+class _CompressingWriter(object):
+    def __init__(self, filename):
+        self.compressor = bz2.BZ2Compressor(9)
+        self.filename = path(filename)
+        self.hash = sha1()
+        self.partial = path('%s.partial' % self.filename)
+        self.openfile = open(self.partial, 'wb')
+
+    def close(self, discard=False):
+        if not discard:
+            self._write(self.compressor.flush())
+        self.openfile.close()
+        if discard:
+            self.partial.unlink()
+        else:
+            write_digest(self.filename, self.hash.hexdigest())
+            os.rename(self.partial, self.filename)
+
+    def write(self, data):
+        self._write(self.compressor.compress(data))
+
+    def _write(self, data):
+        self.hash.update(data)
+        self.openfile.write(data)
+
+class _StreamReader(object):
+    """A readable file over the pieces yielded by ``iterable``."""
+
+    def __init__(self, iterable):
+        self.buffered = ''
+        self.iterator = iter(iterable)
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffered) < size:
+            try:
+                self.buffered += self.iterator.next()
+            except StopIteration:
+                break
+
+        if size < 0:
+            size = len(self.buffered)
+        data, self.buffered = self.buffered[:size], self.buffered[size:]
+        return data
+
+class _DecompressingReader(object):
+    def __init__(self, openfile):
+        self.buffered = ''
+        self.decompressor = bz2.BZ2Decompressor()
+        self.ended = False
+        self.hash = sha1()
+        self.offset = 0
+        self.openfile = openfile
+        self.pending = ''
+
+    def close(self):
+        self.openfile.close()
+
+    def drain(self):
+        """Consumes the rest of the stream, returning its length."""
+
+        length = len(self.buffered) - self.offset
+        self.buffered, self.offset = '', 0
+        while True:
+            data = self._decompress()
+            if data is None:
+                return length
+            length += len(data)
+
+    def read_exactly(self, size):
+        available = len(self.buffered) - self.offset
+        if available >= size:
+            data = self.buffered[self.offset:self.offset + size]
+            self.offset += size
+            return data
+
+        pieces = [self.buffered[self.offset:]]
+        self.buffered, self.offset = '', 0
+        while available < size:
+            data = self._decompress()
+            if data is None:
+                raise EOFError('truncated tar stream')
+            pieces.append(data)
+            available += len(data)
+
+        data = ''.join(pieces)
+        self.buffered, self.offset = data, size
+        return data[:size]
+
+    def unread(self, data):
+        self.buffered = data + self.buffered[self.offset:]
+        self.offset = 0
+
+    def _decompress(self):
+        """Returns the next piece of the decompressed stream, which may consist of
+        several concatenated bzip2 streams, or ``None`` at its end."""
+
+        while True:
+            if self.pending:
+                compressed, self.pending = self.pending, ''
+            else:
+                compressed = self.openfile.read(BLOCK_SIZE)
+            if not compressed:
+                return None
+
+            try:
+                try:
+                    data = self.decompressor.decompress(compressed)
+                except EOFError:
+                    self.decompressor = bz2.BZ2Decompressor()
+                    self.ended = True
+                    data = self.decompressor.decompress(compressed)
+            except IOError:
+                # like bzip2, ignore garbage following a complete stream, such as
+                # the padding tar writes after a compressed archive sent to a pipe
+                if self.ended:
+                    return None
+                raise
+
+            self.ended = False
+            if self.decompressor.unused_data:
+                self.pending = self.decompressor.unused_data
+                self.decompressor = bz2.BZ2Decompressor()
+                self.ended = True
+            if data:
+                self.hash.update(data)
+                return data
+
+def _iterate_members(reader):
+    """Yields the raw header, including any extended headers, and the length of
+    the padded data of each member of the tar stream read by ``reader``; the
+    caller consumes the data before resuming the iteration."""
+
+    while True:
+        header = ''
+        while True:
+            block = reader.read_exactly(HEADER_SIZE)
+            if block == '\0' * HEADER_SIZE and not header:
+                reader.unread(block)
+                return
+
+            length = _get_padded_size(block)
+            typeflag = block[156]
+            if typeflag in METADATA_TYPES:
+                header += block + reader.read_exactly(length)
+            else:
+                header += block
+                if typeflag in EMPTY_TYPES:
+                    length = 0
+                break
+
+        yield header, length
+
+def _find_boundary(data):
+    """Returns the offset at which the chunk starting ``data`` ends. A boundary
+    follows an anchor byte whose preceding window hashes to zero under the
+    boundary mask, at least ``MINIMUM_CHUNK`` bytes in; anchors are found with
+    ``str.find`` and only their windows hashed, which keeps the boundaries
+    defined by content alone at a fraction of the cost of a bytewise rolling
+    hash."""
+
+    position = MINIMUM_CHUNK
+    while True:
+        position = data.find(ANCHOR, position, MAXIMUM_GROUP)
+        if position < 0:
+            return min(len(data), MAXIMUM_GROUP)
+
+        position += 1
+        window = buffer(data, position - WINDOW_SIZE, WINDOW_SIZE)
+        if zlib.crc32(window) & BOUNDARY_MASK == 0:
+            return position
+
+def _discard(filename):
+    try:
+        os.unlink(filename)
+    except OSError:
+        pass
+
+def _get_padded_size(header):
+    field = header[124:136]
+    if ord(field[0]) & 0x80:
+        size = 0
+        for character in field[1:]:
+            size = (size << 8) + ord(character)
+    else:
+        size = int(field.strip('\0 ') or '0', 8)
+    return (size + HEADER_SIZE - 1) // HEADER_SIZE * HEADER_SIZE
+
+def _split_member(reader, length, add_chunk):
+    """Reads the ``length`` bytes of a large member from ``reader`` and passes
+    them to ``add_chunk`` in chunks bounded by their content."""
+
+    pending = ''
+    while length > 0 or pending:
+        if length > 0 and len(pending) < MAXIMUM_GROUP:
+            data = reader.read_exactly(min(length, MAXIMUM_GROUP - len(pending)))
+            pending += data
+            length -= len(data)
+
+        boundary = _find_boundary(pending)
+        add_chunk(pending[:boundary])
+        pending = pending[boundary:]
+
+def _write_atomically(filename, content):
+    filename.parent.makedirs_p()
+    partial = path('%s.%d.partial' % (filename, os.getpid()))
+    partial.write_bytes(content)
+    os.rename(partial, filename)
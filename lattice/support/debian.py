@@ -0,0 +1,529 @@
+import fcntl
+import gzip
+import json
+import os
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from cStringIO import StringIO
+from hashlib import md5, sha1, sha256
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from bake.path import path
+
+from lattice.support.artifact import ArtifactError
+
+AR_MAGIC = '!<arch>\n'
+BLOCK_SIZE = 1048576
+
+class DebianPackage(object):
+    """A debian binary package, written in-process from a component tarball.
+
+    The ``ar`` archive, ``control.tar.gz`` and ``data.tar.gz`` are written
+    directly, with every member owned by root, so neither an extracted work
+    directory nor fakeroot and dpkg-deb are needed."""
+
+    def __init__(self, control, scripts=None, timestamp=None):
+        self.control = control.rstrip('\n') + '\n'
+        self.scripts = scripts or {}
+        self.timestamp = int(timestamp or time.time())
+
+    def write(self, filename, tarball, digest=None):
+        """Writes the package to ``filename`` from ``tarball``, which must match
+        the sha1 ``digest`` if one is given; it is hashed as it is read."""
+
+        filename = path(filename)
+        partial = path('%s.partial' % filename)
+
+        data = tempfile.TemporaryFile()
+        try:
+            md5sums = self._write_data(tarball, data, digest)
+            control = self._write_control(md5sums)
+
+            openfile = open(partial, 'wb')
+            try:
+                openfile.write(AR_MAGIC)
+                self._write_member(openfile, 'debian-binary', StringIO('2.0\n'), 4)
+                self._write_member(openfile, 'control.tar.gz', control, len(control.getvalue()))
+
+                data.seek(0, 2)
+                size = data.tell()
+                data.seek(0)
+                self._write_member(openfile, 'data.tar.gz', data, size)
+            finally:
+                openfile.close()
+        except:
+            if partial.exists():
+                partial.unlink()
+            raise
+        finally:
+            data.close()
+
+        os.rename(partial, filename)
+        return filename
+
+    def _add_directory(self, archive, name, directories):
+        if name in directories:
+            return
+
+        parent = name.rstrip('/').rsplit('/', 1)[0] + '/'
+        if parent != name:
+            self._add_directory(archive, parent, directories)
+
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0755
+        info.mtime = self.timestamp
+        self._set_ownership(info)
+
+        archive.addfile(info)
+        directories.add(name)
+
+    def _normalize_name(self, name):
+        name = name.lstrip('/')
+        while name.startswith('./'):
+            name = name[2:]
+        if name == '.':
+            name = ''
+        return './' + name
+
+    def _set_ownership(self, info):
+        info.uid = info.gid = 0
+        info.uname = info.gname = 'root'
+
+    def _write_control(self, md5sums):
+        content = StringIO()
+        archive = tarfile.open(fileobj=content, mode='w:gz')
+        try:
+            self._add_directory(archive, './', set())
+            members = [('control', self.control, 0644)]
+            if md5sums:
+                members.append(('md5sums', ''.join('%s  %s\n' % (digest, name)
+                    for name, digest in md5sums), 0644))
+            for name, script in sorted(self.scripts.iteritems()):
+                members.append((name, script, 0755))
+
+            for name, text, mode in members:
+                info = tarfile.TarInfo('./' + name)
+                info.size = len(text)
+                info.mode = mode
+                info.mtime = self.timestamp
+                self._set_ownership(info)
+                archive.addfile(info, StringIO(text))
+        finally:
+            archive.close()
+
+        content.seek(0)
+        return content
+
+    def _write_data(self, tarball, fileobj, digest=None):
+        """Copies the members of ``tarball`` into a gzipped data archive, owned by
+        root and rooted at ``./``, and returns the md5 digest of every file."""
+
+        md5sums = []
+        directories = set()
+
+        raw = HashingReader(open(tarball, 'rb'), sha1)
+        source = tarfile.open(fileobj=raw, mode='r|bz2')
+        try:
+            archive = tarfile.open(fileobj=fileobj, mode='w:gz', compresslevel=6)
+            try:
+                self._add_directory(archive, './', directories)
+                for info in source:
+                    name = self._normalize_name(info.name)
+                    if info.isdir():
+                        name = name.rstrip('/') + '/'
+                        if name in directories:
+                            continue
+                        directories.add(name)
+
+                    parent = name.rstrip('/').rsplit('/', 1)[0] + '/'
+                    self._add_directory(archive, parent, directories)
+
+                    info.name = name
+                    if info.islnk():
+                        info.linkname = self._normalize_name(info.linkname)
+                    self._set_ownership(info)
+
+                    if info.isreg():
+                        reader = HashingReader(source.extractfile(info))
+                        archive.addfile(info, reader)
+                        md5sums.append((name[2:], reader.hexdigest()))
+                    else:
+                        archive.addfile(info)
+            finally:
+                archive.close()
+            raw.drain()
+        finally:
+            source.close()
+            raw.source.close()
+
+        if digest and raw.hexdigest() != digest:
+            raise ArtifactError('%s does not match its digest' % path(tarball).basename())
+        return md5sums
+
+    def _write_member(self, openfile, name, content, size):
+        openfile.write('%-16s%-12d%-6d%-6d%-8o%-10d`\n' % (name, self.timestamp, 0, 0,
+            0100644, size))
+
+        while True:
+            data = content.read(BLOCK_SIZE)
+            if not data:
+                break
+            openfile.write(data)
+
+        if size % 2:
+            openfile.write('\n')
+
+class HashingReader(object):
+    def __init__(self, source, algorithm=md5):
+        self.hash = algorithm()
+        self.source = source
+
+    def drain(self):
+        while self.read(BLOCK_SIZE):
+            pass
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.hash.update(data)
+        return data
+
+class PackagePool(object):
+    """A pool of threads on which packages are written concurrently.
+
+    While a pool is entered as a context manager it is available as
+    ``PackagePool.current``; leaving the context waits for every package, even
+    when leaving on an error, and raises the first error encountered. A failed
+    package is also raised by the next ``submit`` or ``check``, so that a build
+    stops as soon as it has lost a package rather than at the end. Packages
+    added to an index through ``index`` update it as they are written, but its
+    ``Release`` is written only once, as the pool is left."""
+
+    current = None
+
+    def __init__(self, workers=None):
+        self.batches = {}
+        self.checked = 0
+        self.guard = threading.Lock()
+        self.pool = ThreadPool(workers or cpu_count())
+        self.results = []
+
+    def __enter__(self):
+        PackagePool.current = self
+        return self
+
+    def __exit__(self, type, value, traceback):
+        PackagePool.current = None
+        self.pool.close()
+        self.pool.join()
+        for index, batch in self.batches.itervalues():
+            batch.__exit__(None, None, None)
+        if type is not None:
+            return False
+
+        for result in self.results:
+            result.get()
+
+    def check(self):
+        """Raises the error of the first package to have failed, if any has."""
+
+        while self.checked < len(self.results) and self.results[self.checked].ready():
+            self.results[self.checked].get()
+            self.checked += 1
+        for result in self.results[self.checked:]:
+            if result.ready() and not result.successful():
+                result.get()
+
+    def index(self, directory):
+        """Returns the index of ``directory`` shared by the packages of the pool."""
+
+        directory = path(directory).abspath()
+        with self.guard:
+            if directory not in self.batches:
+                index = PackageIndex(directory)
+                batch = self.batches[directory] = (index, index.batch())
+                batch[1].__enter__()
+            return self.batches[directory][0]
+
+    def mark(self):
+        return len(self.results)
+
+    def submit(self, function, *args):
+        self.check()
+        self.results.append(self.pool.apply_async(function, args))
+        self.check()
+
+    def succeeded(self, start, end):
+        """Whether every package submitted between the marks ``start`` and ``end``
+        has been written."""
+
+        for result in self.results[start:end]:
+            if not (result.ready() and result.successful()):
+                return False
+        return True
+
+class PackageIndex(object):
+    """An apt repository index (``Packages``, ``Packages.gz`` and ``Release``) of
+    the debs in a flat directory, maintained incrementally.
+
+    The size, mtime, digests and stanza of every indexed deb are kept in an
+    append-only state file, so a deb is only read when it is new or has
+    changed; new stanzas are appended to ``Packages`` and, as a new gzip
+    member, to ``Packages.gz``. Only removals and replacements rewrite them.
+    An index keeps the state it has read, and reads only what other writers
+    have appended since. ``Release`` hashes the whole of the ``Packages``
+    files, so within a ``batch`` it is written once, at the end."""
+
+    LOCKFILE = '.packages.lock'
+    STATEFILE = '.packages.state'
+
+    def __init__(self, directory):
+        self.deferred = 0
+        self.directory = path(directory)
+        self.entries = None
+        self.guard = threading.Lock()
+        self.inode = None
+        self.offset = 0
+        self.stale = False
+
+    def add(self, filenames):
+        """Indexes ``filenames``, all of which must be in the indexed directory."""
+
+        with self._lock():
+            entries = self._load_state()
+            return self._update(entries, [path(f).basename() for f in filenames])
+
+    @contextmanager
+    def batch(self):
+        """Defers writing ``Release`` until the end of the block, so that any
+        number of adds within it are hashed into it once."""
+
+        with self.guard:
+            self.deferred += 1
+        try:
+            yield self
+        finally:
+            with self._lock():
+                self.deferred -= 1
+                if not self.deferred and self.stale:
+                    self._write_release()
+
+    def update(self):
+        """Brings the index in line with the directory, returning the number of
+        debs indexed and the number removed from the index."""
+
+        with self._lock():
+            entries = self._load_state()
+            filenames = [f.basename() for f in self.directory.files('*.deb')]
+
+            removed = set(entries) - set(filenames)
+            for filename in removed:
+                del entries[filename]
+
+            return self._update(entries, filenames, bool(removed)), len(removed)
+
+    def _construct_entry(self, filename):
+        filepath = self.directory / filename
+        stat = os.stat(filepath)
+
+        hashes = (md5(), sha1(), sha256())
+        openfile = open(filepath, 'rb')
+        try:
+            while True:
+                data = openfile.read(BLOCK_SIZE)
+                if not data:
+                    break
+                for hash in hashes:
+                    hash.update(data)
+        finally:
+            openfile.close()
+
+        stanza = [read_control_file(filepath).rstrip('\n')]
+        stanza.append('Filename: ./%s' % filename)
+        stanza.append('Size: %d' % stat.st_size)
+        for field, hash in zip(('MD5sum', 'SHA1', 'SHA256'), hashes):
+            stanza.append('%s: %s' % (field, hash.hexdigest()))
+
+        return {'filename': filename, 'size': stat.st_size, 'mtime': stat.st_mtime,
+            'stanza': '\n'.join(stanza) + '\n'}
+
+    def _load_state(self):
+        """Returns the indexed entries, reading only what was appended to the
+        state file since it was last read, unless it was rewritten since."""
+
+        try:
+            stat = os.stat(self.directory / self.STATEFILE)
+        except OSError:
+            self.entries, self.inode, self.offset = {}, None, 0
+            return self.entries
+
+        if self.entries is None or stat.st_ino != self.inode or stat.st_size < self.offset:
+            self.entries, self.offset = {}, 0
+        self.inode = stat.st_ino
+
+        if stat.st_size > self.offset:
+            openfile = open(self.directory / self.STATEFILE, 'rb')
+            try:
+                openfile.seek(self.offset)
+                content = openfile.read(stat.st_size - self.offset)
+            finally:
+                openfile.close()
+
+            content = content[:content.rfind('\n') + 1]
+            self.offset += len(content)
+            for line in content.split('\n'):
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry.get('removed'):
+                    self.entries.pop(entry['filename'], None)
+                else:
+                    self.entries[entry['filename']] = entry
+        return self.entries
+
+    @contextmanager
+    def _lock(self):
+        with self.guard:
+            openfile = open(self.directory / self.LOCKFILE, 'a')
+            try:
+                fcntl.flock(openfile.fileno(), fcntl.LOCK_EX)
+                yield
+            except:
+                self.entries = None
+                raise
+            finally:
+                openfile.close()
+
+    def _mark_state(self):
+        stat = os.stat(self.directory / self.STATEFILE)
+        self.inode, self.offset = stat.st_ino, stat.st_size
+
+    def _update(self, entries, filenames, rewrite=False):
+        added = []
+        for filename in filenames:
+            entry = entries.get(filename)
+            if entry:
+                stat = os.stat(self.directory / filename)
+                if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                    continue
+                rewrite = True
+
+            entries[filename] = entry = self._construct_entry(filename)
+            added.append(entry)
+
+        if not (added or rewrite) and (self.directory / 'Release').exists():
+            return 0
+
+        if rewrite or not (self.directory / 'Packages').exists():
+            self._write_packages(sorted(entries.itervalues(), key=lambda e: e['filename']))
+            self._write_state(entries.itervalues())
+        else:
+            self._append_packages(added)
+            openfile = open(self.directory / self.STATEFILE, 'ab')
+            try:
+                for entry in added:
+                    openfile.write(json.dumps(entry) + '\n')
+            finally:
+                openfile.close()
+        self._mark_state()
+
+        if self.deferred:
+            self.stale = True
+        else:
+            self._write_release()
+        return len(added)
+
+    def _append_packages(self, entries):
+        content = ''.join('\n' + entry['stanza'] for entry in entries)
+
+        openfile = open(self.directory / 'Packages', 'ab')
+        try:
+            openfile.write(content)
+        finally:
+            openfile.close()
+
+        openfile = gzip.open(self.directory / 'Packages.gz', 'ab')
+        try:
+            openfile.write(content)
+        finally:
+            openfile.close()
+
+    def _write_packages(self, entries):
+        content = '\n'.join(entry['stanza'] for entry in entries)
+        self._write_atomically('Packages', content)
+
+        partial = self.directory / 'Packages.gz.partial'
+        openfile = gzip.open(partial, 'wb')
+        try:
+            openfile.write(content)
+        finally:
+            openfile.close()
+        os.rename(partial, self.directory / 'Packages.gz')
+
+    def _write_release(self):
+        files = []
+        for filename in ('Packages', 'Packages.gz'):
+            content = (self.directory / filename).bytes()
+            files.append((filename, len(content), md5(content).hexdigest(),
+                sha1(content).hexdigest(), sha256(content).hexdigest()))
+
+        release = ['Date: %s' % time.strftime('%a, %d %b %Y %H:%M:%S UTC', time.gmtime())]
+        for i, field in enumerate(('MD5Sum', 'SHA1', 'SHA256')):
+            release.append('%s:' % field)
+            for file in files:
+                release.append(' %s %16d %s' % (file[2 + i], file[1], file[0]))
+
+        self._write_atomically('Release', '\n'.join(release) + '\n')
+        self.stale = False
+
+    def _write_atomically(self, filename, content):
+        partial = self.directory / ('%s.partial' % filename)
+        partial.write_bytes(content)
+        os.rename(partial, self.directory / filename)
+
+    def _write_state(self, entries):
+        self._write_atomically(self.STATEFILE, ''.join(json.dumps(entry) + '\n'
+            for entry in entries))
+
+def read_control_file(filename):
+    """Reads the control file of the deb ``filename`` from its control archive."""
+
+    openfile = open(filename, 'rb')
+    try:
+        if openfile.read(len(AR_MAGIC)) != AR_MAGIC:
+            raise ValueError('%s is not a deb' % filename)
+
+        while True:
+            header = openfile.read(60)
+            if len(header) < 60:
+                raise ValueError('%s has no control archive' % filename)
+
+            name, size = header[:16].strip().rstrip('/'), int(header[48:58])
+            if name.startswith('control.tar'):
+                content = StringIO(openfile.read(size))
+                break
+            openfile.seek(size + (size % 2), 1)
+    finally:
+        openfile.close()
+
+    try:
+        archive = tarfile.open(fileobj=content, mode='r:*')
+    except tarfile.ReadError:
+        return subprocess.check_output(['dpkg-deb', '--field', str(filename)])
+
+    try:
+        for info in archive:
+            if info.name in ('./control', 'control'):
+                return archive.extractfile(info).read()
+    finally:
+        archive.close()
+
+    raise ValueError('%s has no control file' % filename)
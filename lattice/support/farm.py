@@ -0,0 +1,284 @@
+import json
+import threading
+import time
+import urllib2
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+PENDING = 'pending'
+LEASED = 'leased'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+class BuildQueue(object):
+    """The components of a profile build, handed out to workers as their
+    dependencies complete.
+
+    A claimed component is leased to its worker, which must renew the lease
+    while it builds; a component whose lease expires, because its worker died or
+    lost contact, goes back to the queue for another worker to take."""
+
+    def __init__(self, components, lease=300, starting_commits=None, timestamp=None):
+        self.components = components
+        self.lease = lease
+        self.lock = threading.Lock()
+        self.starting_commits = starting_commits or {}
+        self.timestamp = timestamp
+
+        self.built = set()
+        self.finished = threading.Event()
+        self.results = {}
+
+        names = set(component['name'] for component in components)
+        self.dependencies = {}
+        for component in components:
+            dependencies = list(component.get('dependencies') or [])
+            dependencies.extend(component.get('ephemeral-dependencies') or [])
+            self.dependencies[component['name']] = [d for d in dependencies if d in names]
+
+        self.leases = {}
+        self.states = dict((name, PENDING) for name in names)
+        self._check_finished()
+
+    @property
+    def failures(self):
+        return [(name, self.results[name]['error']) for name, state
+            in sorted(self.states.iteritems()) if state == FAILED]
+
+    @property
+    def unbuilt(self):
+        return sorted(name for name, state in self.states.iteritems() if state == PENDING)
+
+    def claim(self, worker):
+        with self.lock:
+            self._expire_leases()
+            if self.finished.is_set():
+                return {'status': 'finished'}
+
+            for component in self.components:
+                name = component['name']
+                if self.states[name] != PENDING:
+                    continue
+                if all(self.states[d] == COMPLETED for d in self.dependencies[name]):
+                    self.states[name] = LEASED
+                    self.leases[name] = (worker, time.time() + self.lease)
+                    return {'status': 'ready', 'component': component,
+                        'built': sorted(self.built.intersection(self.dependencies[name])),
+                        'dependencies': self._collect_artifacts(name),
+                        'starting_commit': self.starting_commits.get(name),
+                        'lease': self.lease, 'timestamp': self.timestamp}
+
+            return {'status': 'wait'}
+
+    def complete(self, worker, name, result):
+        with self.lock:
+            if not self._holds_lease(worker, name):
+                return {'status': 'lost'}
+
+            del self.leases[name]
+            self.states[name] = COMPLETED
+            self.results[name] = result
+            if result.get('built'):
+                self.built.add(name)
+
+            self._check_finished()
+            return {'status': 'ok'}
+
+    def fail(self, worker, name, error):
+        with self.lock:
+            if not self._holds_lease(worker, name):
+                return {'status': 'lost'}
+
+            del self.leases[name]
+            self.states[name] = FAILED
+            self.results[name] = {'error': error}
+
+            self._check_finished()
+            return {'status': 'ok'}
+
+    def renew(self, worker, name):
+        with self.lock:
+            if not self._holds_lease(worker, name):
+                return {'status': 'lost'}
+
+            self.leases[name] = (worker, time.time() + self.lease)
+            return {'status': 'ok'}
+
+    def summarize(self):
+        with self.lock:
+            counts = {}
+            for state in self.states.itervalues():
+                counts[state] = counts.get(state, 0) + 1
+            return {'states': counts, 'finished': self.finished.is_set(),
+                'leases': dict((name, lease[0]) for name, lease in self.leases.iteritems())}
+
+    def _check_finished(self):
+        """Finishes the queue once every component has completed or, after a
+        failure, once nothing which could still be built remains."""
+
+        if LEASED in self.states.itervalues():
+            return
+
+        for name, state in self.states.iteritems():
+            if state == PENDING and not any(self.states[d] == FAILED
+                    for d in self._collect_dependencies(name)):
+                return
+
+        self.finished.set()
+
+    def _collect_artifacts(self, name):
+        artifacts = []
+        for dependency in self._collect_dependencies(name):
+            result = self.results.get(dependency)
+            if result and result.get('artifacts'):
+                artifacts.append({'name': dependency, 'artifacts': result['artifacts']})
+        return artifacts
+
+    def _collect_dependencies(self, name):
+        """Returns the transitive dependencies of ``name``, each following its own
+        dependencies."""
+
+        collected = []
+        def collect(node):
+            for dependency in self.dependencies[node]:
+                if dependency not in collected:
+                    collect(dependency)
+                    collected.append(dependency)
+
+        collect(name)
+        return collected
+
+    def _expire_leases(self):
+        now = time.time()
+        for name, (worker, expiry) in self.leases.items():
+            if expiry < now:
+                del self.leases[name]
+                self.states[name] = PENDING
+
+    def _holds_lease(self, worker, name):
+        lease = self.leases.get(name)
+        return lease is not None and lease[0] == worker
+
+class Coordinator(ThreadingMixIn, HTTPServer):
+    """Serves a ``BuildQueue`` to workers as json posted to ``/claim``,
+    ``/renew``, ``/complete`` and ``/fail``; ``/status`` summarizes the queue."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, queue, address):
+        HTTPServer.__init__(self, address, CoordinatorHandler)
+        self.queue = queue
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def serve_until_finished(self, linger=5, interval=0.5):
+        """Serves the queue until it finishes, then lingers for ``linger`` seconds
+        so that polling workers learn the build is over."""
+
+        thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': interval})
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while not self.queue.finished.wait(interval):
+                pass
+            time.sleep(linger)
+        finally:
+            self.shutdown()
+            self.server_close()
+
+class CoordinatorHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/status':
+            self._respond(200, self.server.queue.summarize())
+        else:
+            self._respond(404, {'error': 'not found'})
+
+    def do_POST(self):
+        queue = self.server.queue
+        try:
+            length = int(self.headers.getheader('content-length') or 0)
+            data = json.loads(self.rfile.read(length) or '{}')
+            worker = data['worker']
+
+            if self.path == '/claim':
+                response = queue.claim(worker)
+            elif self.path == '/renew':
+                response = queue.renew(worker, data['name'])
+            elif self.path == '/complete':
+                response = queue.complete(worker, data['name'], data['result'])
+            elif self.path == '/fail':
+                response = queue.fail(worker, data['name'], data.get('error') or '')
+            else:
+                return self._respond(404, {'error': 'not found'})
+        except (KeyError, ValueError), exception:
+            return self._respond(400, {'error': str(exception)})
+
+        self._respond(200, response)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, code, content):
+        body = json.dumps(content)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class FarmClient(object):
+    def __init__(self, url, worker, timeout=60):
+        self.timeout = timeout
+        self.url = url.rstrip('/')
+        self.worker = worker
+
+    def claim(self):
+        return self._post('/claim')
+
+    def complete(self, name, result):
+        return self._post('/complete', name=name, result=result)
+
+    def fail(self, name, error):
+        return self._post('/fail', name=name, error=error)
+
+    def renew(self, name):
+        return self._post('/renew', name=name)
+
+    def _post(self, endpoint, **data):
+        data['worker'] = self.worker
+        request = urllib2.Request(self.url + endpoint, json.dumps(data),
+            {'Content-Type': 'application/json'})
+        return json.loads(urllib2.urlopen(request, timeout=self.timeout).read())
+
+class LeaseRenewal(object):
+    """Renews the lease on a component in the background while it is built."""
+
+    def __init__(self, client, name, interval):
+        self.client = client
+        self.interval = interval
+        self.lost = False
+        self.name = name
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if self.client.renew(self.name).get('status') == 'lost':
+                    self.lost = True
+                    return
+            except Exception:
+                pass
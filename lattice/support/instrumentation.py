@@ -0,0 +1,104 @@
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+from bake.path import path
+
+BLOCK_SIZE = 512
+
+class Instrumentation(object):
+    """Records wall time, cpu time, memory and disk io for the phases of a build.
+
+    Cpu time and io include child processes, since nearly all of the work in a
+    build is done by git, the build commands and tar. The kernel keeps only a
+    lifetime high-water mark of resident memory, for this process and for its
+    largest child, so memory is recorded as that mark at the end of each phase,
+    ``max_rss``, and how far the phase raised it, ``max_rss_increase``; a phase
+    which used less memory than an earlier one shows no increase."""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.epoch = time.time()
+        self.phases = []
+
+    @contextmanager
+    def measure(self, phase, component=None):
+        if not self.enabled:
+            yield
+            return
+
+        start = _sample()
+        try:
+            yield
+        finally:
+            end = _sample()
+            self.phases.append({
+                'phase': phase,
+                'component': component,
+                'start': start['wall'] - self.epoch,
+                'wall': end['wall'] - start['wall'],
+                'cpu': end['cpu'] - start['cpu'],
+                'max_rss': end['max_rss'],
+                'max_rss_increase': end['max_rss'] - start['max_rss'],
+                'read_bytes': end['read_bytes'] - start['read_bytes'],
+                'written_bytes': end['written_bytes'] - start['written_bytes'],
+            })
+
+    def dump(self, filename, **metadata):
+        report = dict(metadata)
+        report['phases'] = self.phases
+        report['components'] = self.summarize()
+        path(filename).write_bytes(json.dumps(report, indent=2, sort_keys=True) + '\n')
+
+    def dump_trace(self, filename):
+        """Writes the recorded phases in the chrome trace event format, suitable
+        for chrome://tracing and similar viewers."""
+
+        pid = os.getpid()
+        events = []
+        for phase in self.phases:
+            events.append({
+                'name': phase['phase'],
+                'cat': phase['component'] or 'profile',
+                'ph': 'X',
+                'ts': int(phase['start'] * 1000000),
+                'dur': int(phase['wall'] * 1000000),
+                'pid': pid,
+                'tid': 0,
+                'args': {
+                    'component': phase['component'],
+                    'cpu': phase['cpu'],
+                    'max_rss': phase['max_rss'],
+                    'max_rss_increase': phase['max_rss_increase'],
+                    'read_bytes': phase['read_bytes'],
+                    'written_bytes': phase['written_bytes'],
+                },
+            })
+
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        path(filename).write_bytes(json.dumps(trace) + '\n')
+
+    def summarize(self):
+        summary = {}
+        for phase in self.phases:
+            component = summary.setdefault(phase['component'] or '', {})
+            totals = component.setdefault(phase['phase'], {'wall': 0.0, 'cpu': 0.0,
+                'read_bytes': 0, 'written_bytes': 0, 'max_rss': 0, 'max_rss_increase': 0})
+
+            for key in ('wall', 'cpu', 'read_bytes', 'written_bytes', 'max_rss_increase'):
+                totals[key] += phase[key]
+            totals['max_rss'] = max(totals['max_rss'], phase['max_rss'])
+        return summary
+
+def _sample():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'wall': time.time(),
+        'cpu': own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+        'max_rss': max(own.ru_maxrss, children.ru_maxrss) * 1024,
+        'read_bytes': (own.ru_inblock + children.ru_inblock) * BLOCK_SIZE,
+        'written_bytes': (own.ru_oublock + children.ru_oublock) * BLOCK_SIZE,
+    }
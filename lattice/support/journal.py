@@ -0,0 +1,45 @@
+import json
+import os
+
+from bake.path import path
+
+class BuildJournal(object):
+    """The checkpoint journal of a profile build.
+
+    Each completed component is appended as a single line of json and flushed
+    to disk before the next component starts, so the journal survives whatever
+    brings the build down."""
+
+    FILENAME = '.lattice-journal'
+
+    def __init__(self, filename):
+        self.filename = path(filename)
+
+    def load(self):
+        if not self.filename.exists():
+            return []
+
+        entries = []
+        for line in self.filename.bytes().split('\n'):
+            if not line.strip():
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                break
+        return entries
+
+    def record(self, entry):
+        openfile = open(self.filename, 'ab')
+        try:
+            openfile.write(json.dumps(entry, sort_keys=True, default=str) + '\n')
+            openfile.flush()
+            os.fsync(openfile.fileno())
+        finally:
+            openfile.close()
+
+    def rewrite(self, entries):
+        partial = path('%s.partial' % self.filename)
+        content = [json.dumps(entry, sort_keys=True, default=str) for entry in entries]
+        partial.write_bytes(''.join(line + '\n' for line in content))
+        os.rename(partial, self.filename)
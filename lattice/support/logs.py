@@ -0,0 +1,122 @@
+import os
+import subprocess
+from collections import deque
+
+from bake.path import path
+
+CHUNK_SIZE = 65536
+MAXIMUM_LINE = 4096
+
+class LogFile(object):
+    """A log file which rotates once it grows past ``maximum`` bytes, keeping
+    ``backups`` rotated files, and which remembers only the last ``tail`` lines
+    written to it, so that arbitrarily verbose output is written in constant
+    memory."""
+
+    def __init__(self, filename, maximum=64 * 1048576, backups=2, tail=200):
+        self.backups = backups
+        self.filename = path(filename)
+        self.lines = deque(maxlen=tail)
+        self.maximum = maximum
+        self.partial = ''
+
+        self.filename.parent.makedirs_p()
+        self.openfile = open(self.filename, 'wb')
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        if self.partial:
+            self.lines.append(self.partial)
+            self.partial = ''
+        self.openfile.close()
+
+    def get_tail(self):
+        lines = list(self.lines)
+        if self.partial:
+            lines.append(self.partial)
+        return '\n'.join(lines)
+
+    def write(self, data):
+        if self.size + len(data) > self.maximum and self.size:
+            self._rotate()
+
+        self.openfile.write(data)
+        self.size += len(data)
+
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()[-MAXIMUM_LINE:]
+        self.lines.extend(line[-MAXIMUM_LINE:] for line in lines[-self.lines.maxlen:])
+
+    def _rotate(self):
+        self.openfile.close()
+        for i in range(self.backups, 0, -1):
+            source = path('%s.%d' % (self.filename, i - 1)) if i > 1 else self.filename
+            if source.exists():
+                os.rename(source, '%s.%d' % (self.filename, i))
+
+        self.openfile = open(self.filename, 'wb')
+        self.size = 0
+
+class CommitLog(object):
+    """The commit log of a profile build, written to ``filename`` as it is
+    populated rather than held in memory.
+
+    Entries are separated as ``'\\n'.join(entries)`` would separate them. A
+    resumed build reopens the log at ``offset``, the end of the last entry
+    written by a completed component, discarding whatever follows it."""
+
+    def __init__(self, filename, offset=0):
+        self.filename = path(filename)
+        if offset and self.filename.exists():
+            self.openfile = open(self.filename, 'r+b')
+            self.openfile.truncate(min(offset, self.filename.getsize()))
+            self.openfile.seek(0, 2)
+        else:
+            self.openfile = open(self.filename, 'wb')
+
+    def append(self, entry):
+        self.write(entry + '\n')
+
+    def close(self):
+        self.openfile.close()
+
+    def tell(self):
+        return self.openfile.tell()
+
+    def write(self, data):
+        self.openfile.write(data)
+
+def stream_process(tokens, sink, cwd=None, environ=None, shell=False, merge_output=True):
+    """Runs a process, passing its output to ``sink`` in fixed size chunks as it
+    is produced; stderr is merged into it or, if ``merge_output`` is false,
+    discarded. Returns the exit code and the number of bytes written."""
+
+    devnull = open(os.devnull, 'r+b')
+    try:
+        process = subprocess.Popen(tokens, cwd=cwd, env=environ, shell=shell, stdin=devnull,
+            stdout=subprocess.PIPE, stderr=(subprocess.STDOUT if merge_output else devnull),
+            close_fds=True)
+    finally:
+        devnull.close()
+
+    written = 0
+    try:
+        while True:
+            data = os.read(process.stdout.fileno(), CHUNK_SIZE)
+            if not data:
+                break
+            sink(data)
+            written += len(data)
+    except:
+        process.kill()
+        process.wait()
+        raise
+    finally:
+        process.stdout.close()
+    return process.wait(), written
@@ -0,0 +1,92 @@
+import json
+import urllib
+import urllib2
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CHUNK_SIZE = 65536
+PROFILE_PATH = '/api/lattice/1.0/profile/%s'
+STREAM_PATH = '/stream/component'
+
+class RegistryError(Exception):
+    """An error reported by, or reaching, a lattice registry."""
+
+def fetch_profile(url, profile_id, timeout=60):
+    """Fetches the profile ``profile_id`` from the registry at ``url`` in a single
+    request, with its components resolved into build order, and returns it in
+    the form ``lattice.profile.build`` reads from a profile file."""
+
+    query = urllib.urlencode({'include': '[resolved]'})
+    request = urllib2.Request('%s%s?%s' % (url.rstrip('/'),
+        PROFILE_PATH % urllib.quote(profile_id, safe=''), query),
+        headers={'Accept': 'application/json'})
+
+    try:
+        response = json.loads(urllib2.urlopen(request, timeout=timeout).read())
+    except urllib2.HTTPError, exception:
+        raise RegistryError('cannot fetch profile %s: %s %s' % (profile_id,
+            exception.code, exception.msg))
+    except (urllib2.URLError, ValueError), exception:
+        raise RegistryError('cannot fetch profile %s: %s' % (profile_id, exception))
+
+    names = dict((c['id'], c['name']) for c in response.get('resolved') or [])
+    components = []
+    for component in response.get('resolved') or []:
+        builds = {}
+        for name, build in (component.get('builds') or {}).iteritems():
+            builds[name] = dict((k, v) for k, v in build.iteritems() if k != 'strategy')
+
+        entry = {'name': component['name'], 'version': component['version'],
+            'builds': builds}
+        if component.get('repository'):
+            entry['repository'] = component['repository']
+        if component.get('description'):
+            entry['description'] = component['description']
+
+        dependencies = [names[d] for d in component.get('dependencies') or [] if d in names]
+        if dependencies:
+            entry['dependencies'] = dependencies
+        components.append(entry)
+
+    return {'name': response['product_id'], 'version': response['version'],
+        'components': components}
+
+def iterate_components(url, include=(), timeout=60, **filters):
+    """Yields the components of the registry at ``url`` as they arrive from its
+    component stream, in msgpack if it is installed and json otherwise.
+    ``filters`` map ``name`` or ``status`` to a value or list of values."""
+
+    query = [('include', ','.join(include))] if include else []
+    for attr, values in sorted(filters.iteritems()):
+        if isinstance(values, basestring):
+            values = [values]
+        query.extend((attr, value) for value in values)
+
+    accept = 'application/x-ndjson'
+    if msgpack:
+        accept = 'application/x-msgpack, application/x-ndjson;q=0.5'
+
+    request = urllib2.Request('%s%s?%s' % (url.rstrip('/'), STREAM_PATH,
+        urllib.urlencode(query)), headers={'Accept': accept})
+
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except (urllib2.URLError, ValueError), exception:
+        raise RegistryError('cannot stream components: %s' % exception)
+
+    try:
+        if response.info().gettype() == 'application/x-msgpack':
+            unpacker = msgpack.Unpacker()
+            for data in iter(lambda: response.read(CHUNK_SIZE), ''):
+                unpacker.feed(data)
+                for record in unpacker:
+                    yield record
+        else:
+            for line in response:
+                if line.strip():
+                    yield json.loads(line)
+    finally:
+        response.close()
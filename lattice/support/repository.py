@@ -1,21 +1,27 @@
 import os
+import re
 from collections import defaultdict
 from hashlib import sha1
+from xml.etree import ElementTree
 
 from bake.path import path
 from bake.process import Process
 
+from lattice.support.logs import stream_process
 from lattice.support.specification import Specification
 from lattice.support.versioning import VersionToken
 
+HASH_EXPR = re.compile(r'^[0-9a-f]{40}$')
+
 class Repository(object):
     implementations = {}
 
-    def __init__(self, root, runtime=None, cachedir=None, lfile=None):
+    def __init__(self, root, runtime=None, cachedir=None, lfile=None, shallow=False):
         self.cachedir = cachedir
         self.lfile = lfile or Specification.DEFAULT_FILENAME
         self.root = root
         self.runtime = runtime
+        self.shallow = shallow
 
     def checkout(self, metadata):
         raise NotImplementedError()
@@ -31,10 +37,28 @@ class Repository(object):
     def instantiate(cls, name, *args, **params):
         return cls.implementations[name](*args, **params)
 
+    def resolve(self, metadata):
+        """Resolves the hash and, where possible, the version which a checkout of
+        ``metadata`` would have, without checking anything out. The version is
+        ``None`` when it cannot be known in advance."""
+
+        raise NotImplementedError()
+
+    def stream_commit_log(self, sink, starting_commit=None):
+        """Writes the commit log since ``starting_commit`` to ``sink``, returning
+        the number of bytes written."""
+
+        commits = self.get_commit_log(starting_commit)
+        if commits:
+            sink.write(commits)
+            return len(commits)
+        return 0
+
     def _construct_cache_path(self, *values):
         return self.cachedir / sha1(':'.join([value or '' for value in values])).hexdigest()
 
 class GitRepository(Repository):
+    MAXIMUM_DEEPENING = 4096
     SUPPORTED_SYMBOLS = ['HEAD']
 
     def checkout(self, metadata):
@@ -51,11 +75,14 @@ class GitRepository(Repository):
                 return
             else:
                 root = cached
-                
-        self._run_command(['clone', url, root], False, True)
-        if revision and revision != 'HEAD':
-            self._run_command(['checkout', '--detach', '-q', revision],
-                passthrough=True, root=root)
+
+        if self.shallow:
+            self._checkout_shallow(url, revision, root)
+        else:
+            self._run_command(['clone', url, root], False, True)
+            if revision and revision != 'HEAD':
+                self._run_command(['checkout', '--detach', '-q', revision],
+                    passthrough=True, root=root)
 
         if cached:
             cached.symlink(self.root)
@@ -76,15 +103,16 @@ class GitRepository(Repository):
             return specification.get_component(name)
 
     def get_commit_log(self, starting_commit=None):
-        tokens = ['log']
-        if starting_commit:
-            tokens.append('%s..' % starting_commit)
-
-        process = self._run_command(tokens, passive=True)
+        process = self._run_command(self._prepare_commit_log(starting_commit), passive=True)
         if process.returncode == 0:
             return process.stdout
 
     def get_current_version(self, unknown_version='0.0.0'):
+        # describe and the commit count depend on the whole history, and on
+        # every branch and tag, so a shallow clone fetches all of it first
+        if self.shallow:
+            self._fetch_history()
+
         process = self._run_command(['describe', '--tags'], passive=True)
         if process.returncode == 0:
             version = process.stdout.strip()
@@ -97,6 +125,7 @@ class GitRepository(Repository):
             else:
                 return version
 
+        self._deepen_history()
         process = self._run_command(['rev-list', '--all', '--count'])
         return '%s+%s' % (unknown_version, process.stdout.strip())
 
@@ -109,9 +138,83 @@ class GitRepository(Repository):
         fingerprint = root / '.git'
         return fingerprint.exists() and fingerprint.isdir()
 
+    def resolve(self, metadata):
+        url = metadata['url']
+        revision = metadata.get('revision') or 'HEAD'
+        tags = self._get_remote_tags(url)
+
+        if revision in tags:
+            commit = tags[revision]
+        else:
+            process = self._run_command(['ls-remote', url, revision], False, passive=True)
+            commits = [line.split('\t')[0] for line in process.stdout.strip().split('\n') if line]
+            if process.returncode == 0 and commits:
+                commit = commits[0]
+            elif HASH_EXPR.match(revision):
+                commit = revision
+            else:
+                return None, None
+
+        for tag, tagged in tags.iteritems():
+            if tagged == commit:
+                return commit, (tag[1:] if tag.startswith('v') else tag)
+        return commit, None
+
+    def stream_commit_log(self, sink, starting_commit=None):
+        """Streams ``git log`` to ``sink`` through a fixed size buffer, so long
+        histories are never held in memory."""
+
+        tokens = ['git'] + self._prepare_commit_log(starting_commit)
+        returncode, written = stream_process(tokens, sink.write, cwd=self.root,
+            merge_output=False)
+        return written if returncode == 0 else 0
+
+    def _checkout_shallow(self, url, revision, root):
+        """Clones only the requested revision, without its history or the blobs
+        of other revisions; history is fetched later, and only as far back as is
+        needed, by ``_deepen_history``."""
+
+        self._run_command(['clone', '--depth', '1', '--filter=blob:none', '--no-checkout',
+            url, root], False, True)
+
+        process = self._run_command(['fetch', '--depth', '1', 'origin', revision or 'HEAD'],
+            passthrough=True, root=root, passive=True)
+        if process.returncode == 0:
+            revision = 'FETCH_HEAD'
+        else:
+            self._run_command(['fetch', '--unshallow', 'origin'], passthrough=True, root=root)
+
+        self._run_command(['checkout', '--detach', '-q', revision or 'HEAD'],
+            passthrough=True, root=root)
+
     def _clean_repo(self):
         self._run_command(['clean', '-dx'], passthrough=True)
 
+    def _deepen_history(self, satisfied=None):
+        """Deepens a shallow clone until ``satisfied`` returns true, doubling
+        the depth fetched each time, or unshallows it entirely when no condition
+        is given or the history gets too deep."""
+
+        depth = 16
+        while self._is_shallow():
+            if satisfied and satisfied():
+                return
+            if not satisfied or depth > self.MAXIMUM_DEEPENING:
+                self._run_command(['fetch', '-q', '--unshallow', 'origin'])
+                return
+            self._run_command(['fetch', '-q', '--deepen=%d' % depth, 'origin'])
+            depth *= 2
+
+    def _fetch_history(self):
+        """Fetches the complete history of every branch and tag into a shallow
+        clone, so that it describes its revision exactly as a full clone would.
+        Blobs are still fetched only as they are needed."""
+
+        tokens = ['fetch', '-q', '--tags']
+        if self._is_shallow():
+            tokens.append('--unshallow')
+        self._run_command(tokens + ['origin', '+refs/heads/*:refs/remotes/origin/*'])
+
     def _get_file(self, filename, commit=None):
         filename = '%s:%s' % (commit or 'HEAD', filename)
         try:
@@ -124,6 +227,24 @@ class GitRepository(Repository):
         if candidate:
             return Specification(version=commit).parse(candidate)
 
+    def _get_remote_tags(self, remote='origin'):
+        process = self._run_command(['ls-remote', '--tags', remote], remote == 'origin',
+            passive=True)
+        if process.returncode != 0:
+            return {}
+
+        tags = {}
+        for line in process.stdout.strip().split('\n'):
+            if '\t' not in line:
+                continue
+            commit, ref = line.split('\t', 1)
+            tag = ref.replace('refs/tags/', '', 1)
+            if tag.endswith('^{}'):
+                tags[tag[:-3]] = commit
+            else:
+                tags.setdefault(tag, commit)
+        return tags
+
     def _get_tags(self):
         tags = self._run_command(['tag']).stdout.strip()
         if tags:
@@ -131,6 +252,19 @@ class GitRepository(Repository):
         else:
             return []
 
+    def _is_shallow(self):
+        return (path(self.root) / '.git' / 'shallow').exists()
+
+    def _prepare_commit_log(self, starting_commit=None):
+        tokens = ['log']
+        if starting_commit:
+            tokens.append('%s..' % starting_commit)
+            self._deepen_history(lambda: self._run_command(['merge-base', '--is-ancestor',
+                starting_commit, 'HEAD'], passive=True).returncode == 0)
+        else:
+            self._deepen_history()
+        return tokens
+
     def _run_command(self, tokens, cwd=True, passthrough=False, root=None, passive=False):
         process = Process(['git'] + tokens)
         if passthrough and self.runtime and self.runtime.verbose:
@@ -149,21 +283,38 @@ Repository.implementations['git'] = GitRepository
 class SubversionRepository(Repository):
     SUPPORTED_SYMBOLS = ['HEAD']
 
+    revision = None
+    url = None
+
     def checkout(self, metadata):
-        url = metadata['url']
+        """Checks out the component at a pinned revision, which is the last
+        revision in which its url changed. Unless a working copy is requested
+        with ``working-copy``, the tree is exported, and cached checkouts are keyed
+        by url and revision."""
+
+        self.url = metadata['url']
+        self.revision = self._get_revision(self.url, metadata.get('revision'))
+        if not self.revision:
+            raise RuntimeError('cannot resolve revision of %s' % self.url)
+
+        target = '%s@%s' % (self.url, self.revision)
 
         cached = None
         root = self.root
 
         if self.cachedir:
-            cached = self._construct_cache_path(url)
+            cached = self._construct_cache_path(target)
             if cached.exists():
                 cached.symlink(root)
                 return
             else:
                 root = cached
 
-        self._run_command(['co', url, root], False, True)
+        if metadata.get('working-copy'):
+            self._run_command(['co', '-q', '-r', self.revision, target, root], False, True)
+        else:
+            self._run_command(['export', '-q', '-r', self.revision, target, root], False, True)
+
         if cached:
             cached.symlink(self.root)
 
@@ -171,11 +322,38 @@ class SubversionRepository(Repository):
     def is_repository(cls, root):
         fingerprint = root / '.svn'
         return fingerprint.exists() and fingerprint.isdir()
-    
+
     def get_commit_log(self, starting_commit=None):
-        return ''
+        revision = self.get_current_hash()
+        if not revision:
+            return ''
+
+        try:
+            starting_commit = int(starting_commit or 0)
+        except ValueError:
+            starting_commit = 0
+
+        if starting_commit >= int(revision):
+            return ''
+
+        target = '%s@%s' % (self.url, revision) if self.url else '.'
+        process = self._run_command(['log', '--xml', '-r', '%s:%d' % (revision,
+            starting_commit + 1), target], passive=True)
+        if process.returncode != 0:
+            return ''
+
+        commits = []
+        for entry in ElementTree.fromstring(process.stdout).findall('logentry'):
+            message = (entry.findtext('msg') or '').strip()
+            commits.append('r%s | %s | %s\n\n%s\n' % (entry.get('revision'),
+                entry.findtext('author') or '', entry.findtext('date') or '',
+                '\n'.join('    %s' % line for line in message.split('\n'))))
+        return '\n'.join(commits)
 
     def get_current_version(self, unknown_version='0.0.0'):
+        if self.revision:
+            return self.revision
+
         process = self._run_command(['.'], cmd='svnversion')
         if process.returncode == 0:
             version = process.stdout.strip()
@@ -189,16 +367,38 @@ class SubversionRepository(Repository):
                 return version
 
     def get_current_hash(self):
-        return ''
+        if not self.revision:
+            self.revision = self._get_revision('.')
+        return self.revision or ''
 
-    def _run_command(self, tokens, cwd=True, passthrough=False, root=None, cmd='svn'):
+    def resolve(self, metadata):
+        revision = self._get_revision(metadata['url'], metadata.get('revision'))
+        return revision, revision
+
+    def _get_revision(self, target, revision=None):
+        tokens = ['info', '--xml']
+        if revision and revision != 'HEAD':
+            tokens.extend(['-r', revision])
+            target = '%s@%s' % (target, revision)
+
+        process = self._run_command(tokens + [target], cwd=(target == '.'), passive=True)
+        if process.returncode != 0:
+            return None
+
+        commit = ElementTree.fromstring(process.stdout).find('entry/commit')
+        if commit is not None:
+            return commit.get('revision')
+
+    def _run_command(self, tokens, cwd=True, passthrough=False, root=None, cmd='svn',
+            passive=False):
         process = Process([cmd] + tokens)
         if passthrough and self.runtime and self.runtime.verbose:
             process.merge_output = True
             process.passthrough = True
 
         root = root or self.root
-        if process(runtime=self.runtime, cwd=root if cwd else None) == 0:
+        returncode = process(runtime=self.runtime, cwd=root if cwd else None)
+        if passive or returncode == 0:
             return process
         else:
             raise RuntimeError(process.stderr or '')
@@ -0,0 +1,323 @@
+import json
+import mmap
+import os
+import struct
+import time
+
+from bake.path import path
+
+from lattice.support.versioning import VERSION_EXPR
+from lattice.util import prioritize
+
+MAGIC = 'LATSNAP\0'
+FORMAT = 1
+
+HEADER = struct.Struct('<8sIIQd')
+SECTION = struct.Struct('<QQ')
+SECTIONS = ('strings', 'components', 'dependencies', 'dependents', 'names', 'profiles',
+    'members')
+
+COMPONENT = struct.Struct('<12I')
+PROFILE = struct.Struct('<8I')
+INDEX = struct.Struct('<I')
+
+class SnapshotError(Exception):
+    """A snapshot file which cannot be read."""
+
+class Snapshot(object):
+    """A read-only snapshot of the registry, memory mapped from a file written by
+    ``write_snapshot``.
+
+    Components and profiles are fixed size records sorted by id, found by binary
+    search; their strings and json metadata live in a string table. Each
+    component points into arrays of its dependencies and dependents, and each
+    profile into an array of its components in build order, so nothing beyond
+    the records a lookup touches is ever read or decoded."""
+
+    def __init__(self, filename):
+        self.filename = path(filename)
+        openfile = open(self.filename, 'rb')
+        try:
+            if os.fstat(openfile.fileno()).st_size < HEADER.size + SECTION.size * len(SECTIONS):
+                raise SnapshotError('%s is not a snapshot' % filename)
+            self.map = mmap.mmap(openfile.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            openfile.close()
+
+        magic, format, flags, self.seq, self.timestamp = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or format != FORMAT:
+            self.map.close()
+            raise SnapshotError('%s is not a version %d snapshot' % (filename, FORMAT))
+
+        self.sections = {}
+        for i, name in enumerate(SECTIONS):
+            self.sections[name] = SECTION.unpack_from(self.map, HEADER.size + i * SECTION.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.map.close()
+
+    def get_component(self, id):
+        """Returns the component ``id`` with its metadata and the ids of its
+        dependencies, or ``None`` if there is no such component."""
+
+        index = self._find('components', COMPONENT, id)
+        if index is not None:
+            return self._read_component(index)
+
+    def get_dependencies(self, id, transitive=False):
+        return self._traverse(id, 8, transitive)
+
+    def get_dependents(self, id, transitive=False):
+        return self._traverse(id, 10, transitive)
+
+    def get_profile(self, id):
+        """Returns the profile ``id`` in the form ``lattice.profile.build`` reads
+        from a profile file, or ``None`` if there is no such profile."""
+
+        index = self._find('profiles', PROFILE, id)
+        if index is None:
+            return None
+
+        record = self._read_record('profiles', PROFILE, index)
+        members = [self._read_component(i)
+            for i in self._read_indexes('members', record[6], record[7])]
+
+        names = dict((member['id'], member['name']) for member in members)
+        components = []
+        for member in members:
+            entry = {'name': member['name'], 'version': member['version'],
+                'builds': member.get('builds') or {}}
+            for key in ('description', 'repository'):
+                if member.get(key):
+                    entry[key] = member[key]
+
+            dependencies = [names[d] for d in member['dependencies'] if d in names]
+            if dependencies:
+                entry['dependencies'] = dependencies
+            components.append(entry)
+
+        return {'name': self._read_string(record[2], record[3]),
+            'version': self._read_string(record[4], record[5]), 'components': components}
+
+    def get_versions(self, name):
+        """Returns the ids of the components named ``name``, oldest version first."""
+
+        offset, count = self.sections['names']
+        name = name.encode('utf8')
+
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self._read_name(middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+
+        ids = []
+        while low < count and self._read_name(low) == name:
+            record = self._read_record('components', COMPONENT, self._read_index('names', low))
+            ids.append(self._read_string(record[0], record[1]))
+            low += 1
+        return ids
+
+    def iterate_components(self):
+        for index in range(self.sections['components'][1]):
+            yield self._read_component(index)
+
+    def iterate_profiles(self):
+        for index in range(self.sections['profiles'][1]):
+            record = self._read_record('profiles', PROFILE, index)
+            members = self._read_indexes('members', record[6], record[7])
+            yield {'id': self._read_string(record[0], record[1]),
+                'product_id': self._read_string(record[2], record[3]),
+                'version': self._read_string(record[4], record[5]),
+                'components': [self._read_id(i) for i in members]}
+
+    def _find(self, section, structure, id):
+        id = id.encode('utf8')
+        low, high = 0, self.sections[section][1]
+        while low < high:
+            middle = (low + high) // 2
+            record = self._read_record(section, structure, middle)
+            candidate = self._read_bytes(record[0], record[1])
+            if candidate == id:
+                return middle
+            elif candidate < id:
+                low = middle + 1
+            else:
+                high = middle
+
+    def _read_bytes(self, offset, length):
+        start = self.sections['strings'][0] + offset
+        return self.map[start:start + length]
+
+    def _read_component(self, index):
+        record = self._read_record('components', COMPONENT, index)
+        component = json.loads(self._read_string(record[6], record[7]))
+        component.update(id=self._read_string(record[0], record[1]),
+            name=self._read_string(record[2], record[3]),
+            version=self._read_string(record[4], record[5]))
+        component['dependencies'] = [self._read_id(i)
+            for i in self._read_indexes('dependencies', record[8], record[9])]
+        return component
+
+    def _read_id(self, index):
+        record = self._read_record('components', COMPONENT, index)
+        return self._read_string(record[0], record[1])
+
+    def _read_index(self, section, position):
+        return INDEX.unpack_from(self.map, self.sections[section][0] + position * INDEX.size)[0]
+
+    def _read_indexes(self, section, start, count):
+        return [self._read_index(section, start + i) for i in range(count)]
+
+    def _read_name(self, position):
+        record = self._read_record('components', COMPONENT, self._read_index('names', position))
+        return self._read_bytes(record[2], record[3])
+
+    def _read_record(self, section, structure, index):
+        return structure.unpack_from(self.map, self.sections[section][0] + index * structure.size)
+
+    def _read_string(self, offset, length):
+        return self._read_bytes(offset, length).decode('utf8')
+
+    def _traverse(self, id, field, transitive):
+        index = self._find('components', COMPONENT, id)
+        if index is None:
+            return None
+
+        section = 'dependencies' if field == 8 else 'dependents'
+        seen, pending, ids = set([index]), [index], []
+        while pending:
+            record = self._read_record('components', COMPONENT, pending.pop(0))
+            for neighbour in self._read_indexes(section, record[field], record[field + 1]):
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    ids.append(self._read_id(neighbour))
+                    if transitive:
+                        pending.append(neighbour)
+        return ids
+
+def read_snapshot(filename):
+    """Reads a whole snapshot back into the ``components`` and ``profiles`` maps
+    ``write_snapshot`` takes, with its ``seq``."""
+
+    with Snapshot(filename) as snapshot:
+        components = {}
+        for component in snapshot.iterate_components():
+            components[component['id']] = component
+
+        profiles = {}
+        for profile in snapshot.iterate_profiles():
+            profiles[profile['id']] = profile
+        return components, profiles, snapshot.seq
+
+def write_snapshot(filename, components, profiles, seq):
+    """Writes a snapshot of ``components``, a map of id to component with its
+    ``name``, ``version``, ``dependencies`` and other metadata, and of
+    ``profiles``, a map of id to profile with its ``product_id``, ``version`` and
+    component ids, taken at the change sequence number ``seq``. The file is
+    replaced atomically and left read-only."""
+
+    strings, offsets = [], {}
+    size = [0]
+    def add_string(value):
+        value = value.encode('utf8') if isinstance(value, unicode) else str(value)
+        if value not in offsets:
+            offsets[value] = size[0]
+            strings.append(value)
+            size[0] += len(value)
+        return offsets[value], len(value)
+
+    ids = sorted(components)
+    positions = dict((id, i) for i, id in enumerate(ids))
+
+    dependencies, dependents = [], []
+    reverse = dict((id, []) for id in ids)
+    for id in ids:
+        for dependency in components[id].get('dependencies') or ():
+            if dependency in reverse:
+                reverse[dependency].append(id)
+
+    records = []
+    for id in ids:
+        component = components[id]
+        forward = sorted(positions[d] for d in component.get('dependencies') or ()
+            if d in positions)
+        backward = sorted(positions[d] for d in reverse[id])
+
+        metadata = dict((k, v) for k, v in component.iteritems()
+            if k not in ('id', 'name', 'version', 'dependencies'))
+        fields = (add_string(id) + add_string(component['name'])
+            + add_string(component['version'])
+            + add_string(json.dumps(metadata, sort_keys=True, separators=(',', ':')))
+            + (len(dependencies), len(forward)) + (len(dependents), len(backward)))
+        dependencies.extend(forward)
+        dependents.extend(backward)
+        records.append(COMPONENT.pack(*fields))
+
+    names = sorted(range(len(ids)), key=lambda i: (components[ids[i]]['name'].encode('utf8'),
+        _get_version_key(components[ids[i]]['version'])))
+
+    members, profile_records = [], []
+    for id in sorted(profiles):
+        profile = profiles[id]
+        order = _order_components([c for c in profile['components'] if c in positions],
+            components)
+        fields = (add_string(id) + add_string(profile['product_id'])
+            + add_string(profile['version']) + (len(members), len(order)))
+        members.extend(positions[c] for c in order)
+        profile_records.append(PROFILE.pack(*fields))
+
+    sections = [
+        ''.join(strings),
+        ''.join(records),
+        ''.join(INDEX.pack(i) for i in dependencies),
+        ''.join(INDEX.pack(i) for i in dependents),
+        ''.join(INDEX.pack(i) for i in names),
+        ''.join(profile_records),
+        ''.join(INDEX.pack(i) for i in members),
+    ]
+    counts = [len(sections[0]), len(records), len(dependencies), len(dependents),
+        len(names), len(profile_records), len(members)]
+
+    filename = path(filename)
+    partial = path('%s.partial' % filename)
+    if partial.exists():
+        partial.unlink()
+
+    openfile = open(partial, 'wb')
+    try:
+        openfile.write(HEADER.pack(MAGIC, FORMAT, 0, seq, time.time()))
+        offset = HEADER.size + SECTION.size * len(sections)
+        for content, count in zip(sections, counts):
+            openfile.write(SECTION.pack(offset, count))
+            offset += len(content)
+        for content in sections:
+            openfile.write(content)
+    finally:
+        openfile.close()
+
+    os.chmod(partial, 0444)
+    os.rename(partial, filename)
+
+def _get_version_key(version):
+    match = VERSION_EXPR.match(version)
+    if match:
+        return (0, tuple(int(g) if g and g.isdigit() else g for g in match.groups()))
+    return (1, version)
+
+def _order_components(ids, components):
+    """Orders the components of a profile so that each follows its dependencies
+    within the profile."""
+
+    members = set(ids)
+    graph = dict((id, set(d for d in components[id].get('dependencies') or ()
+        if d in members)) for id in ids)
+    return prioritize(graph, {}, ids)[0]
@@ -16,6 +16,7 @@ Schema = Structure({
             'command': Text(nonnull=True),
             'script': Text(nonnull=True),
             'task': Text(nonnull=True),
+            'parameters': Map(Field(nonnull=True), nonnull=True),
             'pre-install': Text(nonnull=True),
             'post-install': Text(nonnull=True),
         }, nonnull=True), nonnull=True),
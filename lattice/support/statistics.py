@@ -0,0 +1,52 @@
+import json
+import os
+
+from bake.path import path
+
+class BuildStatistics(object):
+    """Historical build durations of components, kept in a small json file.
+
+    Each duration is an exponentially weighted average of the recorded builds,
+    so estimates follow a component as its build gets faster or slower."""
+
+    def __init__(self, filename, weight=0.5):
+        self.durations = {}
+        self.filename = path(filename)
+        self.weight = weight
+
+        if self.filename.exists():
+            content = json.loads(self.filename.bytes())
+            self.durations = content.get('durations', {})
+
+    def estimate(self, name, default=None):
+        return self.durations.get(name, default)
+
+    def estimate_all(self, names):
+        """Returns an estimate for each of ``names``; components without history
+        are estimated at the average duration of those with it."""
+
+        known = [self.durations[name] for name in names if name in self.durations]
+        default = (sum(known) / len(known)) if known else 0.0
+        return dict((name, self.durations.get(name, default)) for name in names)
+
+    def record(self, name, duration):
+        previous = self.durations.get(name)
+        if previous is None:
+            self.durations[name] = duration
+        else:
+            self.durations[name] = self.weight * duration + (1 - self.weight) * previous
+
+    def save(self):
+        partial = path('%s.partial' % self.filename)
+        partial.write_bytes(json.dumps({'durations': self.durations}, indent=2,
+            sort_keys=True) + '\n')
+        os.rename(partial, self.filename)
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return '%dh%02dm' % (seconds // 3600, (seconds % 3600) // 60)
+    elif seconds >= 60:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    else:
+        return '%ds' % seconds
@@ -1,3 +1,120 @@
-import lattice.tasks.component
-import lattice.tasks.profile
-import lattice.tasks.deb
+"""Lattice tasks, declared by name so that their modules are imported only when
+they are needed.
+
+Every task is declared below with its module and description, and importing this
+package registers a bare declaration of each, which is enough for bake to list
+it. A declaration resolves itself when it is instantiated: it imports the module
+of its task and hands back an instance of the task itself, so tasks run from the
+command line, through ``runtime.execute`` or through ``execute_task`` alike
+import only the modules they use. Importing a module registers its tasks under
+the names of their declarations; a declaration resolves to its task whichever of
+the two the registry ends up holding."""
+
+from importlib import import_module
+
+from bake import Task, TaskError
+
+TASKS = {
+    'lattice.benchmark.run': ('lattice.tasks.benchmark',
+        'benchmarks the lattice build pipeline'),
+    'lattice.benchmark.storage': ('lattice.tasks.benchmark',
+        'measures sustained registry write and read throughput on sqlite'),
+    'lattice.cache.verify': ('lattice.tasks.cache',
+        'verifies the artifacts in a cachedir against their recorded digests'),
+    'lattice.component.assemble': ('lattice.tasks.component',
+        'assembles a lattice-based component'),
+    'lattice.component.build': ('lattice.tasks.component',
+        'builds a lattice-based component'),
+    'lattice.deb.build': ('lattice.tasks.deb',
+        'builds a deb file of a built component'),
+    'lattice.deb.index': ('lattice.tasks.deb',
+        'updates the apt repository index of a directory of debs'),
+    'lattice.farm.coordinate': ('lattice.tasks.farm',
+        'coordinates a build of a lattice profile across lattice.farm.work workers'),
+    'lattice.farm.work': ('lattice.tasks.farm',
+        'builds components handed out by a lattice.farm.coordinate coordinator'),
+    'lattice.profile.assemble': ('lattice.tasks.profile',
+        'assembles a lattice profile'),
+    'lattice.profile.build': ('lattice.tasks.profile',
+        'builds a lattice profile'),
+    'lattice.profile.plan': ('lattice.tasks.profile',
+        'predicts which components a build of a lattice profile would rebuild'),
+    'lattice.snapshot.export': ('lattice.tasks.snapshot',
+        'exports the registry into a read-only snapshot file'),
+}
+
+class DeclarationMeta(type(Task)):
+    """Resolves the parameters of a declaration from the task it declares when
+    they are looked up, so that they can be checked before it is instantiated."""
+
+    def _get_parameters(cls):
+        if cls.__dict__.get('declared'):
+            task = load_task(cls.name)
+            if task is not None:
+                return task.parameters
+
+        for base in cls.__mro__:
+            if '_parameters' in base.__dict__:
+                return base.__dict__['_parameters']
+            elif 'parameters' in base.__dict__:
+                return base.__dict__['parameters']
+
+    def _set_parameters(cls, parameters):
+        type.__setattr__(cls, '_parameters', parameters)
+
+    parameters = property(_get_parameters, _set_parameters)
+
+class TaskDeclaration(Task):
+    """A task whose module has not been imported. Instantiating a declaration
+    imports the module and returns an instance of the task it declares."""
+
+    __metaclass__ = DeclarationMeta
+
+    def __new__(cls, *args, **params):
+        if cls.name in TASKS:
+            task = load_task(cls.name)
+            if task is not None:
+                return task(*args, **params)
+        return Task.__new__(cls)
+
+    def run(self, runtime):
+        raise TaskError('%s is not implemented by %s' % (self.name, TASKS[self.name][0]))
+
+def declare_tasks(names=None):
+    """Registers a declaration of each task in ``names``, or of every task."""
+
+    for name in sorted(TASKS if names is None else names):
+        module, description = TASKS[name]
+        declaration = DeclarationMeta('TaskDeclaration', (TaskDeclaration,), {'name': name,
+            'description': description, '__module__': module})
+        declaration.declared = True
+
+def execute_task(runtime, name, **params):
+    load_task(name)
+    return runtime.execute(name, **params)
+
+def load_task(name):
+    """Imports the module of the task ``name`` and returns the task, or ``None``
+    if it is not a lattice task."""
+
+    if name not in TASKS:
+        return None
+
+    module = import_module(TASKS[name][0])
+    for value in vars(module).itervalues():
+        if (isinstance(value, type) and issubclass(value, Task) and getattr(value, 'name',
+                None) == name and not issubclass(value, TaskDeclaration)):
+            return value
+
+def load_tasks(names=None):
+    """Imports the modules of the tasks in ``names``, or of every task."""
+
+    if names is None:
+        modules = set(module for module, description in TASKS.itervalues())
+    else:
+        modules = set(TASKS[name][0] for name in names if name in TASKS)
+
+    for module in sorted(modules):
+        import_module(module)
+
+declare_tasks()
@@ -0,0 +1,190 @@
+from multiprocessing import Process, Queue
+
+from bake import *
+from scheme import *
+
+from lattice.support import benchmark as fixtures
+from lattice.support.artifact import ArtifactStream, extract_artifact
+from lattice.support.repository import GitRepository
+from lattice.support.specification import Specification
+from lattice.support.versioning import VersionToken
+from lattice.tasks import TASKS, execute_task
+from lattice.util import topological_sort
+
+class RunBenchmarks(Task):
+    name = 'lattice.benchmark.run'
+    description = 'benchmarks the lattice build pipeline'
+    parameters = {
+        'baseline': Text(description='baseline file to compare results against'),
+        'components': Integer(minimum=1, default=200,
+            description='number of components in synthetic graphs and specifications'),
+        'files': Integer(minimum=1, default=500,
+            description='number of files in the synthetic artifact'),
+        'iterations': Integer(minimum=1, default=5),
+        'only': Sequence(Text(nonnull=True), description='benchmarks to run'),
+        'profile_components': Integer(minimum=1, default=10,
+            description='number of components in the synthetic profile build'),
+        'save_baseline': Boolean(default=False,
+            description='write the results to the baseline file'),
+        'seed': Integer(default=0),
+        'shape': Enumeration(' '.join(fixtures.SHAPES), default='layered'),
+        'tags': Integer(minimum=1, default=20,
+            description='number of tags in the synthetic repository'),
+        'tolerance': Float(minimum=0, default=0.25,
+            description='allowed slowdown relative to the baseline'),
+    }
+
+    def run(self, runtime):
+        self.workdir = fixtures.temporary_directory()
+        try:
+            results = self._run_suite(runtime)
+        finally:
+            self.workdir.rmtree_p()
+
+        baseline = self['baseline']
+        if not baseline:
+            return
+
+        if self['save_baseline']:
+            fixtures.save_baseline(baseline, results)
+            runtime.report('baseline written to %s' % baseline)
+            return
+
+        regressions = fixtures.compare_results(results, fixtures.load_baseline(baseline),
+            self['tolerance'])
+        if regressions:
+            for name, expected, current in regressions:
+                runtime.report('REGRESSION %s: %.4fs -> %.4fs (%+.0f%%)'
+                    % (name, expected, current, (current / expected - 1) * 100))
+            raise TaskError('%d benchmarks regressed' % len(regressions))
+
+    def _construct_suite(self, runtime):
+        graph = fixtures.generate_graph(self['components'], self['shape'], self['seed'])
+        suite = fixtures.BenchmarkSuite()
+
+        def sort_graph(state):
+            topological_sort(dict((name, set(deps)) for name, deps in graph.iteritems()))
+        suite.add('topological_sort', sort_graph)
+
+        versions = ['%d.%d.%d' % (i % 7, i % 13, i) for i in range(self['components'] * 10)]
+        def parse_versions(state):
+            sorted(VersionToken(version) for version in versions)
+        suite.add('version_token', parse_versions)
+
+        content = fixtures.generate_specification(self['components'])
+        def parse_specification(state):
+            Specification().parse(content)
+        suite.add('specification_parse', parse_specification)
+
+        repository = fixtures.generate_repository(self.workdir / 'repository', self['tags'])
+        def enumerate_components(state):
+            GitRepository(str(repository)).enumerate_components()
+        suite.add('enumerate_components', enumerate_components)
+
+        tree = fixtures.generate_tree(self.workdir / 'tree', self['files'], seed=self['seed'])
+        def setup_artifact():
+            directory = fixtures.temporary_directory()
+            for name in ('dist', 'cache', 'extracted'):
+                (directory / name).mkdir()
+            return directory
+        def cache_artifact(directory):
+            with ArtifactStream(directory / 'dist/a.tar.bz2', directory / 'cache/a.tar.bz2') as stream:
+                fixtures.write_tarball(tree, stream.path)
+            (directory / 'dist/a.tar.bz2').unlink()
+            extract_artifact(directory / 'cache/a.tar.bz2', directory / 'extracted',
+                [directory / 'dist/a.tar.bz2'])
+        suite.add('artifact_cache', cache_artifact, setup_artifact, _remove_directory)
+
+        profile_graph = fixtures.generate_graph(self['profile_components'], self['shape'],
+            self['seed'])
+        def setup_profile():
+            return fixtures.temporary_directory()
+        def build_profile(directory):
+            profile = fixtures.generate_profile(profile_graph, str(repository))
+            curdir = runtime.chdir(directory)
+            try:
+                execute_task(runtime, 'lattice.profile.build', specification=profile,
+                    path=str(directory / 'build'), distpath=directory / 'dist',
+                    cachedir=directory / 'cache')
+            finally:
+                runtime.chdir(curdir)
+        suite.add('profile_build', build_profile, setup_profile, _remove_directory)
+
+        # startup cost of the task entry points, each in a fresh interpreter; the
+        # bare interpreter is timed too, so that its share can be told apart
+        def start_interpreter(statement):
+            return lambda state: fixtures.run_interpreter(statement)
+        suite.add('import_interpreter', start_interpreter('pass'))
+        suite.add('import_task_listing', start_interpreter('import lattice.tasks'))
+
+        entry_points = {}
+        for name, (module, description) in sorted(TASKS.iteritems()):
+            entry_points.setdefault(module, name)
+        for module, name in sorted(entry_points.iteritems()):
+            suite.add('import_%s' % module.rsplit('.', 1)[-1],
+                start_interpreter('from lattice.tasks import load_task; load_task(%r)' % name))
+
+        return suite
+
+    def _run_suite(self, runtime):
+        def report(name, result):
+            runtime.report('%-24s min %.4fs  median %.4fs' % (name, result['minimum'],
+                result['median']))
+
+        suite = self._construct_suite(runtime)
+        return suite.run(self['iterations'], self['only'], report)
+
+class LoadTestStorage(Task):
+    name = 'lattice.benchmark.storage'
+    description = 'measures sustained registry write and read throughput on sqlite'
+    parameters = {
+        'builds': Integer(minimum=1, default=10, description='builds per component,'
+            ' all replaced by each write'),
+        'components': Integer(minimum=1, default=200),
+        'duration': Float(minimum=0, default=10.0, description='seconds to run for'),
+        'readers': Integer(minimum=0, default=4, description='number of reading processes'),
+        'writers': Integer(minimum=0, default=2, description='number of writing processes'),
+    }
+
+    def run(self, runtime):
+        workdir = fixtures.temporary_directory()
+        try:
+            url = 'sqlite:///%s' % (workdir / 'lattice.db')
+            fixtures.create_storage(url, self['components'], self['builds'])
+
+            results = Queue()
+            roles = ['write'] * self['writers'] + ['read'] * self['readers']
+            processes = [Process(target=fixtures.run_storage_worker, args=(url, role,
+                self['duration'], self['components'], self['builds'], results, seed))
+                for seed, role in enumerate(roles)]
+
+            for process in processes:
+                process.start()
+            reports = [results.get() for process in processes]
+            for process in processes:
+                process.join()
+        finally:
+            workdir.rmtree_p()
+
+        failures = 0
+        for role in ('write', 'read'):
+            selected = [r for r in reports if r['role'] == role]
+            if not selected:
+                continue
+
+            latencies = sorted(l for r in selected for l in r['latencies'])
+            completed = len(latencies)
+            failed = sum(r['failures'] for r in selected)
+            failures += failed
+
+            percentile = lambda p: latencies[min(int(completed * p), completed - 1)]
+            runtime.report('%-6s %4d workers  %8.1f ops/s  p50 %.4fs  p99 %.4fs  %d failed'
+                % (role + 's', len(selected), completed / self['duration'],
+                percentile(0.5) if completed else 0, percentile(0.99) if completed else 0,
+                failed))
+
+        if failures:
+            raise TaskError('%d operations failed' % failures)
+
+def _remove_directory(directory):
+    directory.rmtree_p()
@@ -0,0 +1,50 @@
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from bake import *
+from scheme import *
+
+from lattice.support.artifact import get_digest_path, verify_artifact
+
+class VerifyCache(Task):
+    name = 'lattice.cache.verify'
+    description = 'verifies the artifacts in a cachedir against their recorded digests'
+    parameters = {
+        'cachedir': Path(nonempty=True),
+        'remove': Boolean(default=False, description='remove artifacts which do not'
+            ' match their digests, so that they are rebuilt'),
+        'threads': Integer(minimum=1, description='number of artifacts to hash at once'
+            ' (defaults to the number of cpus)'),
+    }
+
+    def run(self, runtime):
+        artifacts = sorted(self['cachedir'].files('*.tar.bz2'))
+        if not artifacts:
+            runtime.report('no artifacts in %s' % self['cachedir'])
+            return
+
+        # hashlib releases the gil while hashing, so threads hash in parallel
+        pool = ThreadPool(self['threads'] or cpu_count())
+        try:
+            results = pool.map(verify_artifact, artifacts, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        corrupt = []
+        unhashed = 0
+        for artifact, result in zip(artifacts, results):
+            if result is None:
+                unhashed += 1
+                runtime.info('%s has no digest' % artifact.basename())
+            elif not result:
+                corrupt.append(artifact)
+                runtime.report('***** %s does not match its digest' % artifact.basename())
+                if self['remove']:
+                    artifact.remove_p()
+                    get_digest_path(artifact).remove_p()
+
+        runtime.report('verified %d artifacts: %d corrupt, %d without a digest'
+            % (len(artifacts), len(corrupt), unhashed))
+        if corrupt and not self['remove']:
+            raise TaskError('%d artifacts do not match their digests' % len(corrupt))
@@ -1,15 +1,65 @@
-import tarfile
+import os
 
 from bake import *
 from bake.filesystem import Collation
 from scheme import *
 
-from lattice.support.repository import Repository
+from lattice.support.artifact import (ArtifactError, ArtifactStream, extract_artifact,
+    get_digest_path, read_digest, remove_extracted)
+from lattice.support.ccache import CompilerCache, format_hit_rate
+from lattice.support.instrumentation import Instrumentation
+from lattice.support.logs import LogFile, stream_process
 from lattice.support.specification import Specification
-from lattice.util import uniqpath
+from lattice.tasks import execute_task
+from lattice.util import interpolate_env_vars, uniqpath
+
+def get_artifact_name(component, target='default'):
+    """Returns the filename of the artifact of ``component`` built for ``target``;
+    only artifacts of targets other than ``default`` carry the target."""
+
+    if target == 'default':
+        return '%(name)s-%(version)s.tar.bz2' % component
+    else:
+        return '%s-%s_%s.tar.bz2' % (component['name'], component['version'], target)
+
+def get_target_path(path, target, targets):
+    """Returns the build path of ``target`` when building ``targets`` at once. Each
+    target other than ``default`` gets a build path of its own, so that targets
+    never see one another's files."""
+
+    if len(targets) > 1 and target != 'default':
+        return '%s.%s' % (path, target)
+    else:
+        return path
+
+def must_build(component, built):
+    """Indicates whether ``component`` must be built because one of its
+    dependencies was built earlier in the same run."""
+
+    if not built:
+        return False
+
+    required = []
+    if 'dependencies' in component:
+        required.extend(component['dependencies'])
+    if 'ephemeral-dependencies' in component:
+        required.extend(component['ephemeral-dependencies'])
+    if not required:
+        return False
+
+    for dependency in required:
+        if dependency in built:
+            return True
+
+def normalize_targets(target):
+    if isinstance(target, basestring):
+        return [target]
+    else:
+        return list(target)
 
 class ComponentTask(Task):
     parameters = {
+        'compiler_cache': Path(nonnull=True, description='ccache directory to compile with'),
         'environ': Map(Text(nonnull=True), description='environment for the build'),
         'name': Text(nonempty=True),
         'path': Text(description='build path', nonempty=True),
@@ -47,6 +97,8 @@ class ComponentTask(Task):
             environ = {}
 
         environ['BUILDPATH'] = self['path']
+        if self['compiler_cache']:
+            environ.update(CompilerCache(self['compiler_cache']).get_environ(environ=environ))
         return environ
 
 class ComponentAssembler(object):
@@ -66,9 +118,13 @@ class ComponentAssembler(object):
         pass
 
 class StandardAssembler(ComponentAssembler):
+    def __init__(self, shallow=False, logdir=None):
+        self.logdir = logdir
+        self.shallow = shallow
+
     def build(self, runtime, name, path, target, environ, component):
         runtime.execute('lattice.component.build', name=name, path=path, target=target,
-            environ=environ, specification=component)
+            environ=environ, specification=component, logdir=self.logdir)
 
     def get_version(self, component):
         return self.repository.get_current_version()
@@ -77,13 +133,18 @@ class StandardAssembler(ComponentAssembler):
         heading = '%(name)s %(version)s' % component
         commit_log.append('%s\n%s\n' % (heading, '-' * len(heading)))
 
-        commits = self.repository.get_commit_log(starting_commit)
-        if commits:
-            commit_log.append(commits)
-            return True
+        if hasattr(commit_log, 'write'):
+            if self.repository.stream_commit_log(commit_log, starting_commit):
+                commit_log.write('\n')
+                return True
         else:
-            commit_log.append('no changes\n')
-            return False
+            commits = self.repository.get_commit_log(starting_commit)
+            if commits:
+                commit_log.append(commits)
+                return True
+
+        commit_log.append('no changes\n')
+        return False
 
     def populate_manifest(self, manifest, component):
         entry = {'name': component['name'], 'version': component['version']}
@@ -91,6 +152,8 @@ class StandardAssembler(ComponentAssembler):
         manifest.append(entry)
 
     def prepare_source(self, runtime, component, repodir):
+        from lattice.support.repository import Repository
+
         try:
             metadata = component['repository']
         except KeyError:
@@ -98,7 +161,7 @@ class StandardAssembler(ComponentAssembler):
 
         sourcepath = uniqpath(runtime.curdir, 'src')
         self.repository = Repository.instantiate(metadata['type'], str(sourcepath),
-            runtime=runtime, cachedir=repodir)
+            runtime=runtime, cachedir=repodir, shallow=self.shallow)
 
         self.repository.checkout(metadata)
         return sourcepath
@@ -107,49 +170,67 @@ class AssembleComponent(ComponentTask):
     name = 'lattice.component.assemble'
     description = 'assembles a lattice-based component'
     parameters = {
+        'artifact_store': Path(nonnull=True, description='deduplicating store to cache'
+            ' artifacts in, as chunks rather than whole tarballs'),
+        'artifact_upstream': Path(nonnull=True, description='shared store backing the'
+            ' artifact store'),
         'assembler': Field(hidden=True),
         'built': Field(hidden=True),
         'cachedir': Path(nonnull=True),
         'commit_log': Field(hidden=True),
         'distpath': Path(nonnull=True),
+        'instrumentation': Field(hidden=True),
+        'logdir': Path(nonnull=True, description='directory to write build logs to'),
         'manifest': Field(hidden=True),
         'post_tasks': Sequence(Text(nonnull=True)),
         'repodir': Path(nonnull=True),
         'revision': Text(nonnull=True),
+        'shallow': Boolean(default=False, description='clone only the revision being'
+            ' built, fetching history only as needed'),
         'starting_commit': Field(hidden=True),
         'tarfile': Boolean(default=False),
+        'target': Union((Text(nonnull=True), Sequence(Text(nonnull=True), min_length=1)),
+            nonnull=True, default='default', description='target, or list of targets,'
+            ' to build from a single checkout'),
         'url': Text(nonnull=True),
     }
 
     def run(self, runtime):
         assembler = self['assembler']
         if not assembler:
-            assembler = StandardAssembler()
+            assembler = StandardAssembler(self['shallow'], self['logdir'])
 
         component = self['specification']
-        environ = self.environ
+        targets = normalize_targets(self['target'])
+
+        measure = self._get_instrumentation().measure
+        name = component['name']
 
         distpath = (self['distpath'] or (runtime.curdir / 'dist')).abspath()
         distpath.makedirs_p()
 
-        curdir = assembler.prepare_source(runtime, component, self['repodir'])
+        with measure('prepare_source', name):
+            curdir = assembler.prepare_source(runtime, component, self['repodir'])
         if curdir:
             curdir = runtime.chdir(curdir)
 
-        version = assembler.get_version(component)
+        with measure('get_version', name):
+            version = assembler.get_version(component)
         if component['version'] == 'HEAD':
             component['version'] = version
 
         manifest = self['manifest']
         if manifest is not None:
+            mark = len(manifest)
             assembler.populate_manifest(manifest, component)
 
         commit_log = self['commit_log']
         has_commits = True
 
         if commit_log is not None:
-            has_commits = assembler.populate_commit_log(commit_log, component,
-                self['starting_commit'])
+            with measure('commit_log', name):
+                has_commits = assembler.populate_commit_log(commit_log, component,
+                    self['starting_commit'])
 
         built = self['built']
         if component.get('ephemeral'):
@@ -159,50 +240,113 @@ class AssembleComponent(ComponentTask):
                 runtime.chdir(curdir)
             return
 
-        building = self._must_build(component, built)
+        required = self._must_build(component, built)
 
         cachedir = self['cachedir']
         if cachedir:
             cachedir.makedirs_p()
             self['tarfile'] = True
-            if not building:
-                building = self._check_cachedir(cachedir, component, distpath)
-        else:
-            building = True
 
-        tarpath = distpath / self._get_component_tarfile(component)
-        if building:
-            self._run_build(runtime, assembler, component, tarpath)
-            if built is not None and not component.get('independent'):
-                built.append(component['name'])
+        store = self._get_artifact_store()
+        if store:
+            self['tarfile'] = True
 
-        if self['post_tasks']:
-            timestamp = self['timestamp']
-            for post_task in self['post_tasks']:
-                runtime.execute(post_task, environ=self['environ'], name=self['name'],
-                    path=self['path'], distpath=distpath, specification=component,
-                    target=self['target'], cachedir=cachedir, timestamp=timestamp)
+        rebuilt = False
+        digests = []
+        for target in self._get_targets(component, targets):
+            path = get_target_path(self['path'], target, targets)
+            tarpath = distpath / get_artifact_name(component, target)
+
+            building = required
+            if cachedir or store:
+                if not building:
+                    with measure('check_cachedir', name):
+                        building = self._check_cachedir(runtime, cachedir, tarpath, path,
+                            store)
+            else:
+                building = True
+
+            if building:
+                cachepath = None
+                if cachedir and not store and not component.get('nocache', False):
+                    cachepath = cachedir / tarpath.basename()
+                self._run_build(runtime, assembler, component, target, path, tarpath,
+                    cachepath)
+                if store and not component.get('nocache', False):
+                    with measure('store', name):
+                        summary = store.add(tarpath)
+                    runtime.info('stored %s: %d of %d chunks new (%d bytes)' % (
+                        tarpath.basename(), summary['new_chunks'], summary['chunks'],
+                        summary['new_bytes']))
+                rebuilt = True
+
+            if self['tarfile']:
+                digests.append(read_digest(tarpath))
+
+            if self['post_tasks']:
+                timestamp = self['timestamp']
+                for post_task in self['post_tasks']:
+                    with measure(post_task, name):
+                        execute_task(runtime, post_task, environ=self['environ'],
+                            name=self['name'], path=path, distpath=distpath,
+                            specification=component, target=target, cachedir=cachedir,
+                            timestamp=timestamp)
+
+        if rebuilt and built is not None and not component.get('independent'):
+            built.append(component['name'])
+
+        if manifest is not None and len(manifest) > mark and digests and all(digests):
+            manifest[mark]['digest'] = ','.join(digests)
 
         if curdir:
             runtime.chdir(curdir)
-        if cachedir and not component.get('nocache', False):
-            tarpath.copy2(cachedir)
 
-    def _check_cachedir(self, cachedir, component, distpath):
-        cached = cachedir / self._get_component_tarfile(component)
-        if cached.exists():
-            cached.copy2(distpath)
-        else:
+    def _check_cachedir(self, runtime, cachedir, tarpath, path, store=None):
+        name = tarpath.basename()
+        if store and store.has(name):
+            # chunks are checked as they are read; an artifact which cannot be
+            # restored in full, for whatever reason, is cleared out and rebuilt
+            try:
+                store.extract(name, path, tarpath)
+            except Exception, exception:
+                runtime.report('cannot restore %s from the artifact store (%s); rebuilding'
+                    % (name, exception))
+                try:
+                    store.remove_extracted(name, path)
+                except Exception:
+                    pass
+                return True
+            return
+
+        cached = cachedir / name if cachedir else None
+        if not (cached and cached.exists()):
             return True
 
-        openfile = tarfile.open(cached, 'r')
+        # the artifact is hashed as it is extracted; a corrupt one is cleared
+        # out of the build path again and rebuilt
         try:
-            openfile.extractall(str(self['path']))
-        finally:
-            openfile.close()
+            extract_artifact(cached, path, [tarpath])
+        except ArtifactError:
+            runtime.report('cached %s does not match its digest; rebuilding'
+                % cached.basename())
+            remove_extracted(cached, path)
+            cached.remove_p()
+            get_digest_path(cached).remove_p()
+            return True
 
-    def _get_component_tarfile(self, component):
-        return '%(name)s-%(version)s.tar.bz2' % component
+    def _get_artifact_store(self):
+        if not self['artifact_store']:
+            return None
+
+        from lattice.support.chunks import ChunkStore
+
+        upstream = None
+        if self['artifact_upstream']:
+            upstream = ChunkStore(self['artifact_upstream'])
+        return ChunkStore(self['artifact_store'], upstream)
+
+    def _get_instrumentation(self):
+        return self['instrumentation'] or Instrumentation(enabled=False)
 
     def _get_repository_metadata(self, component):
         if component:
@@ -220,36 +364,56 @@ class AssembleComponent(ComponentTask):
         else:
             raise TaskError('repository not specified')
 
+    def _get_targets(self, component, targets):
+        """Returns those of ``targets`` which ``component`` implements, or all of
+        them if it implements none, so that building fails as it always has."""
+
+        builds = component.get('builds') or {}
+        return [target for target in targets if target in builds] or targets
+
     def _must_build(self, component, built):
-        if not built:
-            return False
-
-        required = []
-        if 'dependencies' in component:
-            required.extend(component['dependencies'])
-        if 'ephemeral-dependencies' in component:
-            required.extend(component['ephemeral-dependencies'])
-        if not required:
-            return False
-
-        for dependency in required:
-            if dependency in built:
-                return True
+        return must_build(component, built)
 
-    def _run_build(self, runtime, assembler, component, tarpath):
-        path = self['path']
-        environ = self.environ
+    def _run_build(self, runtime, assembler, component, target, path, tarpath,
+            cachepath=None):
+
+        environ = dict(self.environ, BUILDPATH=path)
+        cache = None
+        if self['compiler_cache']:
+            cache = CompilerCache(self['compiler_cache'])
+            environ['CCACHE_BASEDIR'] = str(runtime.curdir)
 
-        original = Collation(path)
-        assembler.build(runtime, self['name'], path, self['target'], environ, component)
-        now = Collation(path).prune(original)
+        measure = self._get_instrumentation().measure
+        name = component['name']
+
+        with measure('scan', name):
+            original = Collation(path)
+        statistics = cache.get_statistics() if cache else None
+        with measure('build', name):
+            assembler.build(runtime, self['name'], path, target, environ, component)
+
+        if cache:
+            rate = format_hit_rate(statistics, cache.get_statistics())
+            if rate:
+                runtime.report('compiler cache for %s: %s' % (name, rate))
+
+        with measure('scan', name):
+            now = Collation(path).prune(original)
 
         if self['tarfile']:
-            now.tar(str(tarpath), {environ['BUILDPATH']: ''})
+            with measure('tar', name):
+                with ArtifactStream(tarpath, cachepath) as stream:
+                    now.tar(stream.path, {environ['BUILDPATH']: ''})
 
 class BuildComponent(ComponentTask):
     name = 'lattice.component.build'
     description = 'builds a lattice-based component'
+    parameters = {
+        'logdir': Path(nonnull=True, description='directory to write build logs to,'
+            ' instead of passing build output through'),
+    }
+
+    TAIL = 200
 
     def run(self, runtime):
         build = self.build
@@ -261,11 +425,56 @@ class BuildComponent(ComponentTask):
             self._run_task(runtime, build)
 
     def _run_command(self, runtime, build):
-        runtime.shell(build['command'], environ=self.environ, merge_output=True)
+        if self['logdir']:
+            self._run_logged(runtime, build['command'], True)
+        else:
+            runtime.shell(build['command'], environ=self.environ, merge_output=True)
+
+    def _run_logged(self, runtime, tokens, shell=False):
+        """Runs a build with its output streamed to a rotating log file in the
+        log directory, keeping only the end of it in memory to report failures."""
+
+        name = self.component['name']
+        if self['target'] != 'default':
+            name = '%s_%s' % (name, self['target'])
+
+        environ = dict(os.environ)
+        environ.update(self.environ)
+
+        logfile = LogFile(self['logdir'] / ('%s.log' % name), tail=self.TAIL)
+        runtime.info('writing build output to %s' % logfile.filename)
+        try:
+            returncode, written = stream_process(tokens, logfile.write, str(runtime.curdir),
+                environ, shell)
+        finally:
+            logfile.close()
+
+        if returncode != 0:
+            raise TaskError('build failed with exit code %d; the end of %s follows\n%s'
+                % (returncode, logfile.filename, logfile.get_tail()))
 
     def _run_script(self, runtime, build):
         script = uniqpath(runtime.curdir, 'script')
         script.write_bytes(build['script'])
 
-        runtime.shell(['bash', '-x', script], environ=self.environ, merge_output=True)
+        if self['logdir']:
+            self._run_logged(runtime, ['bash', '-x', str(script)])
+        else:
+            runtime.shell(['bash', '-x', script], environ=self.environ, merge_output=True)
         script.unlink()
+
+    def _run_task(self, runtime, build):
+        """Runs the task of a build in-process on ``runtime``. The task is given
+        the component's ``name``, build ``path``, ``target`` and ``environ``, as
+        post tasks are, along with the build's own parameters, interpolated from
+        its environment, which take precedence."""
+
+        environ = self.environ
+        parameters = {'name': self.component['name'], 'path': self['path'],
+            'target': self['target'], 'environ': environ}
+        for name, value in (build.get('parameters') or {}).iteritems():
+            if isinstance(value, basestring):
+                value = interpolate_env_vars(value, environ)
+            parameters[name] = value
+
+        execute_task(runtime, build['task'], **parameters)
@@ -2,7 +2,9 @@ from bake import *
 from bake.util import get_package_data
 from scheme import *
 
-from lattice.tasks.component import ComponentTask
+from lattice.support.artifact import ArtifactError, link_or_copy, read_digest
+from lattice.support.debian import DebianPackage, PackageIndex, PackagePool
+from lattice.tasks.component import ComponentTask, get_artifact_name
 from lattice.util import interpolate_env_vars
 
 class BuildDeb(ComponentTask):
@@ -27,12 +29,17 @@ class BuildDeb(ComponentTask):
 
         name = component['name']
         version = component['version']
-        self.tgzname = '%s-%s.tar.bz2' % (name, version)
+        self.tgzname = get_artifact_name(component, self['target'])
 
         prefix = self['prefix']
         if prefix:
             name = '%s-%s' % (prefix.strip('-'), name)
 
+        suffix = ''
+        if self['target'] != 'default':
+            suffix = '-%s' % self['target']
+            name += suffix
+
         if component.get('volatile'):
             timestamp = self['timestamp']
             if timestamp:
@@ -40,16 +47,12 @@ class BuildDeb(ComponentTask):
 
         self.pkgname = '%s-%s.deb' % (name, version)
 
-        self.workpath = runtime.curdir / ('build_%s_deb' % name)
-        self.workpath.makedirs_p()
-
-        controldir = self.workpath / 'DEBIAN'
-        controldir.mkdir_p()
-
         dependencies = component.get('dependencies')
         if dependencies:
             if prefix:
                 dependencies = ['%s-%s' % (prefix.strip('-'), d) for d in dependencies]
+            if suffix:
+                dependencies = [d + suffix for d in dependencies]
             dependencies = ', '.join(dependencies)
 
         template = get_package_data('lattice', 'templates/deb-control-file.tmpl')
@@ -60,14 +63,13 @@ class BuildDeb(ComponentTask):
             'component_maintainer_email': 'acolichia@storediq.com',
             'component_depends': dependencies or '',
             'component_description': 'Package generated by lattice.deb.build'}
-        
-        path('%s/control' % str(controldir)).write_bytes(controlfile)
 
         try:
             build = self.build
         except TaskError:
             build = {}
 
+        scripts = {}
         for file_token, script_token, script_name in self.SCRIPTS:
             script = None
             if file_token in build:
@@ -77,25 +79,38 @@ class BuildDeb(ComponentTask):
             elif script_token in build:
                 script = build[script_token]
             if script:
-                script = interpolate_env_vars(script, environ)
-                scriptfile = controldir / script_name
-                scriptfile.write_bytes(script)
-                scriptfile.chmod(0755)
-
-        curdir = runtime.chdir(self.workpath)
-        self._run_tar(runtime)
-
-        runtime.chdir(curdir)
-        self._run_dpkg(runtime)
-
-    def _run_tar(self, runtime):
-        shellargs = ['tar', '-xjf', str(self['distpath'] / self.tgzname)]
-        runtime.shell(shellargs, merge_output=True)
+                scripts[script_name] = interpolate_env_vars(script, environ)
 
-    def _run_dpkg(self, runtime):
+        package = DebianPackage(controlfile, scripts)
         pkgpath = self['distpath'] / self.pkgname
-        runtime.shell(['fakeroot', 'dpkg', '-b', str(self.workpath), str(pkgpath)], merge_output=True)
+        tarpath = self['distpath'] / self.tgzname
 
+        # the packages of a pool share an index of the cachedir, whose release
+        # file is written once the pool is done
         cachedir = self['cachedir']
-        if cachedir:
-            pkgpath.copy2(cachedir)
+        pool = PackagePool.current
+        if pool:
+            index = pool.index(cachedir) if cachedir else None
+            pool.submit(self._build_package, package, pkgpath, tarpath, index)
+        else:
+            index = PackageIndex(cachedir) if cachedir else None
+            self._build_package(package, pkgpath, tarpath, index)
+
+    def _build_package(self, package, pkgpath, tarpath, index):
+        try:
+            package.write(pkgpath, tarpath, read_digest(tarpath))
+        except ArtifactError, exception:
+            raise TaskError(str(exception))
+        if index:
+            index.add([link_or_copy(pkgpath, index.directory)])
+
+class IndexDebs(Task):
+    name = 'lattice.deb.index'
+    description = 'updates the apt repository index of a directory of debs'
+    parameters = {
+        'cachedir': Path(nonempty=True),
+    }
+
+    def run(self, runtime):
+        added, removed = PackageIndex(self['cachedir']).update()
+        runtime.report('indexed %d new debs, removed %d' % (added, removed))
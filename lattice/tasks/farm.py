@@ -0,0 +1,230 @@
+import os
+import socket
+import urllib2
+from datetime import datetime
+from time import sleep, time
+
+from bake import *
+from scheme import *
+
+from lattice.support.artifact import extract_artifact, link_or_copy
+from lattice.support.farm import BuildQueue, Coordinator, FarmClient, LeaseRenewal
+from lattice.support.logs import CommitLog
+from lattice.support.statistics import BuildStatistics
+from lattice.tasks.component import get_artifact_name, get_target_path, normalize_targets
+from lattice.tasks.profile import BuildProfile
+from lattice.util import uniqpath
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+class CoordinateFarm(BuildProfile):
+    name = 'lattice.farm.coordinate'
+    description = 'coordinates a build of a lattice profile across lattice.farm.work workers'
+    parameters = {
+        'host': Text(nonempty=True, default='0.0.0.0'),
+        'lease': Integer(minimum=1, default=300, description='seconds a worker may go'
+            ' without renewing its claim on a component before it is handed out again'),
+        'linger': Integer(minimum=0, default=5, description='seconds to keep serving'
+            ' once the build is over, so that workers learn of it'),
+        'port': Integer(minimum=0, default=8461),
+    }
+
+    def run(self, runtime):
+        profile = self._load_profile()
+        components = profile['components']
+
+        statistics = None
+        if self['statistics']:
+            statistics = BuildStatistics(self['statistics'])
+            estimates = statistics.estimate_all([c['name'] for c in components])
+            components = self._schedule_components(runtime, components, estimates)
+
+        timestamp = datetime.utcnow()
+        queue = BuildQueue(components, self['lease'], self._parse_last_manifest(),
+            timestamp.strftime(TIMESTAMP_FORMAT))
+
+        coordinator = Coordinator(queue, (self['host'], self['port']))
+        runtime.report('coordinating the build of %d components at %s'
+            % (len(components), coordinator.url))
+        coordinator.serve_until_finished(self['linger'])
+
+        manifest = []
+        commit_log = None
+        if self['dump_commit_log']:
+            commit_log = CommitLog(self['dump_commit_log'])
+
+        try:
+            for component in profile['components']:
+                result = queue.results.get(component['name'])
+                if not result or 'error' in result:
+                    continue
+
+                component['version'] = result['version']
+                manifest.extend(result['manifest'])
+                if commit_log is not None:
+                    for entry in result['commit_log']:
+                        commit_log.append(entry)
+                if statistics and result['built']:
+                    statistics.record(component['name'], result['duration'])
+        finally:
+            if commit_log is not None:
+                commit_log.close()
+
+        if statistics:
+            statistics.save()
+
+        failures = queue.failures
+        if failures:
+            for name, error in failures:
+                runtime.report('***** %s failed: %s' % (name, error))
+            if queue.unbuilt:
+                runtime.report('***** not built: %s' % ', '.join(queue.unbuilt))
+            raise TaskError('%d components failed' % len(failures))
+
+        if self['dump_manifest']:
+            self._dump_manifest(manifest, self['dump_manifest'])
+        if self['build_manifest_component']:
+            path(self['path']).makedirs_p()
+            self._build_manifest(runtime, profile, timestamp, manifest)
+
+class WorkFarm(Task):
+    name = 'lattice.farm.work'
+    description = 'builds components handed out by a lattice.farm.coordinate coordinator'
+    parameters = {
+        'cachedir': Path(nonnull=True),
+        'compiler_cache': Path(nonnull=True),
+        'coordinator': Text(nonempty=True, description='url of the coordinator'),
+        'distpath': Path(nonnull=True),
+        'environ': Map(Text(nonnull=True)),
+        'logdir': Path(nonnull=True),
+        'patience': Integer(minimum=0, default=60, description='seconds to keep trying'
+            ' to reach the coordinator'),
+        'path': Text(nonempty=True),
+        'poll': Float(minimum=0, default=2.0),
+        'post_tasks': Sequence(Text(nonnull=True), nonnull=True),
+        'shallow': Boolean(default=False),
+        'sharedir': Path(nonempty=True, description='directory shared by the coordinator'
+            ' and workers, through which artifacts are exchanged'),
+        'target': Union((Text(nonnull=True), Sequence(Text(nonnull=True), min_length=1)),
+            nonnull=True, default='default'),
+        'worker': Text(nonempty=True, description='name of this worker (defaults to the'
+            ' hostname and pid)'),
+    }
+
+    def run(self, runtime):
+        worker = self['worker'] or '%s-%d' % (socket.gethostname(), os.getpid())
+        client = FarmClient(self['coordinator'], worker)
+
+        targets = normalize_targets(self['target'])
+        self.buildpaths = dict((target, path(get_target_path(self['path'], target, targets)))
+            for target in targets)
+        for buildpath in self.buildpaths.itervalues():
+            buildpath.makedirs_p()
+
+        self['sharedir'].makedirs_p()
+        self.extracted = set()
+
+        completed = 0
+        while True:
+            response = self._claim(client)
+            if response['status'] == 'finished':
+                break
+            elif response['status'] != 'ready':
+                sleep(self['poll'])
+                continue
+
+            component = response['component']
+            name = component['name']
+            self._restore_dependencies(response['dependencies'])
+
+            runtime.linefeed(2)
+            runtime.report('***** building %s on %s' % (name, worker))
+
+            with LeaseRenewal(client, name, max(response['lease'] / 3.0, 1)) as renewal:
+                try:
+                    result = self._build_component(runtime, component, response, worker)
+                except Exception, exception:
+                    runtime.report('***** %s failed: %s' % (name, exception))
+                    client.fail(name, str(exception))
+                    continue
+
+            if renewal.lost:
+                runtime.report('***** lost the lease on %s; discarding it' % name)
+            elif client.complete(name, result).get('status') == 'ok':
+                completed += 1
+
+        runtime.report('%s completed %d components' % (worker, completed))
+
+    def _build_component(self, runtime, component, response, worker):
+        name = component['name']
+        workdir = uniqpath(runtime.curdir, '%s-' % name)
+        workdir.makedirs_p()
+
+        distpath = (self['distpath'] or (workdir / 'dist')).abspath()
+        timestamp = datetime.utcnow()
+        if response['timestamp']:
+            timestamp = datetime.strptime(response['timestamp'], TIMESTAMP_FORMAT)
+
+        built = list(response['built'])
+        manifest = []
+        commit_log = []
+
+        # the artifacts are how dependents on other workers get this component,
+        # so one is written whether or not there is a cachedir
+        before = time()
+        curdir = runtime.chdir(workdir)
+        try:
+            runtime.execute('lattice.component.assemble', environ=self['environ'],
+                distpath=distpath, name=name, path=self['path'], specification=component,
+                target=self['target'], cachedir=self['cachedir'],
+                post_tasks=self['post_tasks'], built=built, timestamp=timestamp,
+                manifest=manifest, commit_log=commit_log,
+                starting_commit=response['starting_commit'], logdir=self['logdir'],
+                shallow=self['shallow'], compiler_cache=self['compiler_cache'],
+                tarfile=True)
+        finally:
+            runtime.chdir(curdir)
+
+        builds = component.get('builds') or {}
+        artifacts = {}
+        for target in self.buildpaths:
+            artifact = distpath / get_artifact_name(component, target)
+            if artifact.exists():
+                link_or_copy(artifact, self['sharedir'])
+                artifacts[target] = str(artifact.basename())
+            elif target in builds and not component.get('ephemeral'):
+                raise TaskError('assembling %s produced no artifact for target %r'
+                    % (name, target))
+        self.extracted.update(artifacts.itervalues())
+
+        return {
+            'artifacts': artifacts,
+            'built': name in built,
+            'commit_log': commit_log,
+            'duration': time() - before,
+            'manifest': [dict((k, str(v)) for k, v in e.iteritems()) for e in manifest],
+            'version': str(component['version']),
+            'worker': worker,
+        }
+
+    def _claim(self, client):
+        deadline = time() + self['patience']
+        while True:
+            try:
+                return client.claim()
+            except (urllib2.URLError, socket.error), exception:
+                if time() > deadline:
+                    raise TaskError('cannot reach the coordinator at %s: %s'
+                        % (self['coordinator'], exception))
+                sleep(self['poll'] or 1)
+
+    def _restore_dependencies(self, dependencies):
+        """Extracts the artifacts of the dependencies of a component, built by
+        other workers, into the build path."""
+
+        for dependency in dependencies:
+            for target, artifact in sorted(dependency['artifacts'].iteritems()):
+                if artifact in self.extracted or target not in self.buildpaths:
+                    continue
+                extract_artifact(self['sharedir'] / artifact, self.buildpaths[target])
+                self.extracted.add(artifact)
@@ -1,8 +1,17 @@
 from datetime import datetime
+from time import time
 
 from bake import *
 from scheme import *
-from lattice.tasks.component import ComponentAssembler
+from lattice.support.artifact import (ArtifactError, extract_artifact, read_digest,
+    remove_extracted)
+from lattice.support.instrumentation import Instrumentation
+from lattice.support.journal import BuildJournal
+from lattice.support.logs import CommitLog
+from lattice.support.statistics import BuildStatistics, format_duration
+from lattice.tasks.component import (ComponentAssembler, get_artifact_name,
+    get_target_path, must_build, normalize_targets)
+from lattice.util import prioritize
 
 class AssembleProfile(Task):
     name = 'lattice.profile.assemble'
@@ -17,88 +26,194 @@ class BuildProfile(Task):
     name = 'lattice.profile.build'
     description = 'builds a lattice profile'
     parameters = {
+        'artifact_store': Path(nonnull=True, description='deduplicating store to cache'
+            ' artifacts in, as chunks rather than whole tarballs'),
+        'artifact_upstream': Path(nonnull=True, description='shared store backing the'
+            ' artifact store'),
         'cachedir': Path(nonnull=True),
         'build_manifest_component': Boolean(default=False),
+        'compiler_cache': Path(nonnull=True, description='ccache directory shared by the'
+            ' components of the profile'),
         'distpath': Path(nonnull=True),
         'dump_commit_log': Text(),
         'dump_manifest': Text(),
+        'dump_metrics': Text(description='file to write per-phase build metrics to'),
+        'dump_trace': Text(description='file to write a chrome trace of the build to'),
         'environ': Map(Text(nonnull=True)),
+        'journal': Boolean(default=False, description='write the artifact of every'
+            ' component, even without a cachedir, so that a failed build can be resumed'),
         'last_manifest': Text(),
+        'logdir': Path(nonnull=True, description='directory to write the build output of'
+            ' each component to, instead of passing it through'),
         'override_version': Text(),
+        'package_workers': Integer(minimum=1, description='number of packages written'
+            ' concurrently by lattice.deb.build (defaults to the number of cpus)'),
         'path': Text(nonempty=True),
         'post_tasks': Sequence(Text(nonnull=True), nonnull=True),
         'profile': Path(nonnull=True),
+        'profile_id': Text(nonempty=True, description='id of the profile to fetch from'
+            ' the registry'),
+        'registry': Text(nonempty=True, description='url of a lattice registry to fetch'
+            ' the profile from, instead of reading a profile file'),
+        'resume': Boolean(default=False, description='resume a failed build, skipping'
+            ' the components it completed'),
+        'shallow': Boolean(default=False, description='clone only the revisions being'
+            ' built, fetching history only as needed'),
+        'snapshot': Path(nonnull=True, description='registry snapshot to read the'
+            ' profile from, instead of the registry itself'),
         'specification': Field(hidden=True),
-        'target': Text(nonnull=True, default='default'),
+        'statistics': Text(description='file of historical build durations, used to'
+            ' build the critical path first and estimate completion'),
+        'target': Union((Text(nonnull=True), Sequence(Text(nonnull=True), min_length=1)),
+            nonnull=True, default='default', description='target, or list of targets,'
+            ' to build from a single checkout of each component'),
     }
 
     def run(self, runtime):
-        profile = self['specification']
-        if not profile:
-            if self['profile']:
-                content = Format.read(str(self['profile']))
-                if 'profile' in content:
-                    profile = content['profile']
-                else:
-                    raise TaskError('nope')
-            else:
-                raise TaskError('nope')
+        from lattice.support.debian import PackagePool
 
-        if self['override_version']:
-            profile['version'] = self['override_version']
+        profile = self._load_profile()
 
         buildpath = path(self['path'])
-        buildpath.mkdir()
+        buildpaths = self._get_build_paths()
+        journal = BuildJournal(buildpath / BuildJournal.FILENAME)
+
+        checkpoints = {}
+        if self['resume'] and buildpath.exists():
+            checkpoints = self._restore_checkpoints(runtime, buildpaths, journal)
+        else:
+            for targetpath in set([buildpath] + buildpaths.values()):
+                targetpath.mkdir()
 
         timestamp = datetime.utcnow()
-        last_manifest = self._parse_last_manifest()
+        if checkpoints:
+            timestamp = min(datetime.strptime(c['timestamp'], '%Y-%m-%dT%H:%M:%S.%f')
+                for c in checkpoints.itervalues())
+
+        last_versions = self._read_last_manifest()
+        last_manifest = dict((name, hash) for name, (version, hash)
+            in last_versions.iteritems())
 
         commit_log = None
         if self['dump_commit_log']:
-            commit_log = []
+            commit_log = CommitLog(self['dump_commit_log'], max([0] + [c['commit_log'][1]
+                for c in checkpoints.itervalues() if c['commit_log']]))
 
         manifest = None
         if self['build_manifest_component'] or self['dump_manifest']:
             manifest = []
 
+        instrumentation = Instrumentation(enabled=bool(self['dump_metrics']
+            or self['dump_trace']))
+
+        components = profile['components']
+        statistics = estimates = None
+
+        if self['statistics']:
+            statistics = BuildStatistics(self['statistics'])
+            estimates = statistics.estimate_all([c['name'] for c in components])
+            components = self._schedule_components(runtime, components, estimates)
+
         built = []
-        for component in profile['components']:
-            starting_commit = last_manifest.get(component['name'])
-            self._build_component(runtime, component, built, timestamp, manifest,
-                commit_log, starting_commit)
+        estimated = spent = 0.0
+
+        pool = PackagePool(self['package_workers'])
+        pending = []
+
+        try:
+            with pool:
+                for i, component in enumerate(components):
+                    pool.check()
+                    name = component['name']
+                    if name in checkpoints:
+                        self._skip_component(runtime, component, checkpoints[name], built,
+                            manifest)
+                        continue
+
+                    # the eta counts only the components expected to be built,
+                    # scaled by how the builds so far compared with their estimates
+                    progress = None
+                    if statistics:
+                        remaining = [c for c in components[i:] if c['name'] not in checkpoints
+                            and not self._is_expected_cached(c, built, last_versions)]
+                        progress = self._format_progress(remaining, estimates, spent,
+                            estimated, i, len(components))
+
+                    marks = (len(built), len(manifest or ()),
+                        commit_log.tell() if commit_log is not None else 0)
+                    starting_commit = last_manifest.get(name)
+                    before = time()
+                    start = pool.mark()
+                    with instrumentation.measure('assemble', name):
+                        self._build_component(runtime, component, built, timestamp, manifest,
+                            commit_log, starting_commit, instrumentation, progress)
+
+                    pending.append((start, pool.mark(), self._construct_checkpoint(runtime,
+                        component, built, manifest, commit_log, marks, timestamp)))
+                    self._record_checkpoints(journal, pool, pending)
+
+                    # cached and ephemeral components say nothing of how long
+                    # a build takes
+                    if statistics and name in built[marks[0]:]:
+                        estimated += estimates[name]
+                        spent += time() - before
+                        statistics.record(name, time() - before)
+                        statistics.save()
+
+                if self['build_manifest_component']:
+                    self._build_manifest(runtime, profile, timestamp, manifest, instrumentation)
+        finally:
+            self._record_checkpoints(journal, pool, pending)
+            if self['dump_metrics']:
+                instrumentation.dump(self['dump_metrics'], profile=profile.get('name'),
+                    version=profile.get('version'), timestamp=timestamp.isoformat())
+            if self['dump_trace']:
+                instrumentation.dump_trace(self['dump_trace'])
+            if commit_log is not None:
+                commit_log.close()
 
-        if self['build_manifest_component']:
-            self._build_manifest(runtime, profile, timestamp, manifest)
         if self['dump_manifest']:
             self._dump_manifest(manifest, self['dump_manifest'])
-        if self['dump_commit_log']:
-            self._dump_commit_log(commit_log, self['dump_commit_log'])
 
     def _build_component(self, runtime, component, built, timestamp, manifest,
-            commit_log, starting_commit):
+            commit_log, starting_commit, instrumentation=None, progress=None):
 
-        target = self['target']
-        if (('builds' not in component or target not in component['builds'])
-                and not component.get('ephemeral')):
-            runtime.info('ignoring %s (does not implement target %r)'
-                % (component['name'], target))
+        targets = normalize_targets(self['target'])
+        builds = component.get('builds') or {}
+        if not component.get('ephemeral'):
+            for target in targets:
+                if target not in builds:
+                    runtime.info('ignoring %s (does not implement target %r)'
+                        % (component['name'], target))
 
         buildpath = runtime.curdir / component['name']
-        buildpath.mkdir()
+        if self['resume']:
+            buildpath.makedirs_p()
+        else:
+            buildpath.mkdir()
 
         runtime.linefeed(2)
-        runtime.report('***** building %s' % component['name'])
+        if progress:
+            runtime.report('***** building %s (%s)' % (component['name'], progress))
+        else:
+            runtime.report('***** building %s' % component['name'])
 
+        # the journal can only resume from components with artifacts, so builds
+        # which may be resumed write them whether or not there is a cachedir
         curdir = runtime.chdir(buildpath)
         runtime.execute('lattice.component.assemble', environ=self['environ'],
             distpath=self['distpath'], name=component['name'], path=self['path'],
             specification=component, target=self['target'], cachedir=self['cachedir'],
             post_tasks=self['post_tasks'], built=built, timestamp=timestamp,
-            manifest=manifest, commit_log=commit_log, starting_commit=starting_commit)
+            manifest=manifest, commit_log=commit_log, starting_commit=starting_commit,
+            instrumentation=instrumentation, logdir=self['logdir'], shallow=self['shallow'],
+            compiler_cache=self['compiler_cache'], artifact_store=self['artifact_store'],
+            artifact_upstream=self['artifact_upstream'],
+            tarfile=bool(self['journal'] or self['resume']))
 
         runtime.chdir(curdir)
 
-    def _build_manifest(self, runtime, profile, timestamp, manifest):
+    def _build_manifest(self, runtime, profile, timestamp, manifest, instrumentation=None):
         assembler = ManifestComponentAssembler(profile, manifest, timestamp)
         name = '%s-manifest' % profile['name']
 
@@ -108,21 +223,119 @@ class BuildProfile(Task):
         runtime.execute('lattice.component.assemble', environ=self['environ'],
             distpath=self['distpath'], name=name, path=self['path'], specification=component,
             target=self['target'], cachedir=self['cachedir'], post_tasks=self['post_tasks'],
-            built=None, timestamp=timestamp, assembler=assembler)
-
-    def _dump_commit_log(self, commit_log, filename):
-        filename = path(filename)
-        filename.write_bytes('\n'.join(commit_log) + '\n')
+            built=None, timestamp=timestamp, assembler=assembler,
+            instrumentation=instrumentation)
+
+    def _construct_checkpoint(self, runtime, component, built, manifest, commit_log,
+            marks, timestamp):
+
+        name = component['name']
+        checkpoint = {
+            'name': name,
+            'version': str(component['version']),
+            'ephemeral': bool(component.get('ephemeral')),
+            'built': name in built[marks[0]:],
+            'manifest': manifest[marks[1]:] if manifest is not None else [],
+            'commit_log': [marks[2], commit_log.tell()] if commit_log is not None else [],
+            'timestamp': timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+        }
+
+        distpath = (self['distpath'] or (runtime.curdir / name / 'dist')).abspath()
+        checkpoint['artifacts'] = artifacts = []
+        for target in normalize_targets(self['target']):
+            artifact = distpath / get_artifact_name(component, target)
+            if artifact.exists():
+                artifacts.append({'target': target, 'artifact': str(artifact),
+                    'size': artifact.getsize(), 'digest': read_digest(artifact)})
+        return checkpoint
 
     def _dump_manifest(self, manifest, filename):
         output = []
         for component in manifest:
-            output.append('%(name)s:%(version)s:%(hash)s' % component)
+            line = '%(name)s:%(version)s:%(hash)s' % component
+            if component.get('digest'):
+                line += ':%s' % component['digest']
+            output.append(line)
 
         filename = path(filename)
         filename.write_bytes('\n'.join(output) + '\n')
 
+    def _format_progress(self, remaining, estimates, spent, estimated, index, total):
+        eta = sum(estimates[component['name']] for component in remaining)
+        if estimated > 0:
+            eta *= spent / estimated
+        return '%d/%d, eta %s' % (index + 1, total, format_duration(eta))
+
+    def _get_build_paths(self):
+        targets = normalize_targets(self['target'])
+        return dict((target, path(get_target_path(self['path'], target, targets)))
+            for target in targets)
+
+    def _load_profile(self):
+        profile = self['specification']
+        if not profile:
+            if self['profile']:
+                content = Format.read(str(self['profile']))
+                if 'profile' in content:
+                    profile = content['profile']
+                else:
+                    raise TaskError('nope')
+            elif self['snapshot'] and self['profile_id']:
+                profile = self._read_snapshot()
+            elif self['registry'] and self['profile_id']:
+                from lattice.support.registry import RegistryError, fetch_profile
+                try:
+                    profile = fetch_profile(self['registry'], self['profile_id'])
+                except RegistryError, exception:
+                    raise TaskError(str(exception))
+            else:
+                raise TaskError('nope')
+
+        if self['override_version']:
+            profile['version'] = self['override_version']
+        return profile
+
+    def _is_cached(self, artifact):
+        from lattice.support.chunks import ChunkStore
+
+        if self['artifact_store']:
+            upstream = None
+            if self['artifact_upstream']:
+                upstream = ChunkStore(self['artifact_upstream'])
+            if ChunkStore(self['artifact_store'], upstream).has(artifact):
+                return True
+        return bool(self['cachedir']) and (self['cachedir'] / artifact).exists()
+
+    def _is_expected_cached(self, component, built, last_versions):
+        """Predicts whether assembling ``component`` will build nothing: it is
+        ephemeral, implements none of the targets, or has the artifacts of the
+        version it had in the last manifest cached while none of its
+        dependencies was rebuilt."""
+
+        builds = component.get('builds') or {}
+        targets = [t for t in normalize_targets(self['target']) if t in builds]
+        if component.get('ephemeral') or not targets:
+            return True
+
+        last = last_versions.get(component['name'])
+        if not (last and (self['cachedir'] or self['artifact_store'])):
+            return False
+        if component.get('nocache') or must_build(component, built):
+            return False
+
+        version = component['version']
+        if version == 'HEAD':
+            version = last[0]
+        return all(self._is_cached(get_artifact_name(dict(component, version=version),
+            target)) for target in targets)
+
     def _parse_last_manifest(self):
+        last_manifest = {}
+        for name, (version, hash) in self._read_last_manifest().iteritems():
+            last_manifest[name] = hash
+        return last_manifest
+
+    def _read_last_manifest(self):
         filename = self['last_manifest']
         if not filename:
             return {}
@@ -133,10 +346,217 @@ class BuildProfile(Task):
 
         last_manifest = {}
         for line in filename.bytes().strip().split('\n'):
-            name, version, hash = line.split(':')
-            last_manifest[name] = hash
+            # manifests written before artifacts were hashed lack the digest
+            name, version, hash = line.split(':')[:3]
+            last_manifest[name] = (version, hash)
         return last_manifest
 
+    def _read_snapshot(self):
+        from lattice.support.snapshot import Snapshot, SnapshotError
+
+        try:
+            with Snapshot(self['snapshot']) as snapshot:
+                profile = snapshot.get_profile(self['profile_id'])
+        except (EnvironmentError, SnapshotError), exception:
+            raise TaskError('cannot read snapshot %s: %s' % (self['snapshot'], exception))
+
+        if not profile:
+            raise TaskError('snapshot %s has no profile %s' % (self['snapshot'],
+                self['profile_id']))
+        return profile
+
+    def _record_checkpoints(self, journal, pool, pending):
+        """Journals the components in ``pending``, in order, once the packages
+        they submitted to ``pool`` have been written, so that a resumed build
+        never skips a component whose deb was lost with the build."""
+
+        while pending:
+            start, end, checkpoint = pending[0]
+            if not pool.succeeded(start, end):
+                break
+            journal.record(checkpoint)
+            pending.pop(0)
+
+    def _restore_checkpoints(self, runtime, buildpaths, journal):
+        """Rebuilds the build paths of an interrupted build from the artifacts of
+        its completed components, which discards whatever a failed component left
+        behind. Restoring stops at the first component whose artifacts are missing
+        or have changed; it and everything after it is built again."""
+
+        entries = journal.load()
+        for entry in entries:
+            if not (entry.get('artifacts') or entry['ephemeral']):
+                raise TaskError('cannot resume: %s was journaled without an artifact to'
+                    ' restore it from; build with journal or a cachedir to be able to'
+                    ' resume' % entry['name'])
+
+        for targetpath in set([path(self['path'])] + buildpaths.values()):
+            if targetpath.exists():
+                targetpath.rmtree()
+            targetpath.mkdir()
+
+        checkpoints = []
+        for entry in entries:
+            artifacts = entry.get('artifacts') or []
+            if not all(self._verify_artifact(artifact, buildpaths) for artifact in artifacts):
+                runtime.report('artifact of %s is missing or has changed; resuming'
+                    ' from there' % entry['name'])
+                break
+
+            if not self._restore_artifacts(artifacts, buildpaths):
+                runtime.report('artifact of %s does not match its digest; resuming'
+                    ' from there' % entry['name'])
+                break
+            checkpoints.append(entry)
+
+        journal.rewrite(checkpoints)
+        return dict((entry['name'], entry) for entry in checkpoints)
+
+    def _restore_artifacts(self, artifacts, buildpaths):
+        """Extracts ``artifacts``, checking each against the digest journaled with
+        it as it is read. On a mismatch, whatever was extracted is removed."""
+
+        extracted = []
+        for artifact in artifacts:
+            source, buildpath = path(artifact['artifact']), buildpaths[artifact['target']]
+            extracted.append((source, buildpath))
+            try:
+                extract_artifact(source, buildpath, digest=artifact.get('digest'))
+            except ArtifactError:
+                for source, buildpath in extracted:
+                    remove_extracted(source, buildpath)
+                return False
+        return True
+
+    def _schedule_components(self, runtime, components, estimates):
+        graph = {}
+        for component in components:
+            dependencies = set(component.get('dependencies') or [])
+            dependencies.update(component.get('ephemeral-dependencies') or [])
+            graph[component['name']] = dependencies
+
+        try:
+            order, critical_path = prioritize(graph, estimates,
+                [component['name'] for component in components])
+        except ValueError, exception:
+            raise TaskError(str(exception))
+
+        if critical_path:
+            runtime.report('critical path (%s): %s' % (
+                format_duration(sum(estimates[name] for name in critical_path)),
+                ' -> '.join(critical_path)))
+
+        components = dict((component['name'], component) for component in components)
+        return [components[name] for name in order]
+
+    def _skip_component(self, runtime, component, checkpoint, built, manifest):
+        runtime.report('***** skipping %s (completed by a previous run)' % component['name'])
+        component['version'] = checkpoint['version']
+
+        if checkpoint['built']:
+            built.append(component['name'])
+        if manifest is not None:
+            manifest.extend(checkpoint['manifest'])
+
+    def _verify_artifact(self, artifact, buildpaths):
+        """Checks ``artifact`` cheaply, by its size and the digest in its sidecar;
+        its content is checked against the journaled digest when it is extracted."""
+
+        filename = path(artifact['artifact'])
+        if not (artifact['target'] in buildpaths and filename.exists()
+                and filename.getsize() == artifact['size']):
+            return False
+        return not artifact.get('digest') or read_digest(filename) in (None, artifact['digest'])
+
+class PlanProfile(BuildProfile):
+    name = 'lattice.profile.plan'
+    description = 'predicts which components a build of a lattice profile would rebuild'
+
+    def run(self, runtime):
+        profile = self._load_profile()
+        last_manifest = self._read_last_manifest()
+
+        components = profile['components']
+        estimates = {}
+        if self['statistics']:
+            estimates = BuildStatistics(self['statistics']).estimate_all(
+                [component['name'] for component in components])
+
+        built = set()
+        rows = []
+        for component in components:
+            status, version, reason = self._plan_component(runtime, component, built,
+                last_manifest.get(component['name']))
+            rows.append((component['name'], version or '?', status, reason,
+                estimates.get(component['name']) if status == 'rebuild' else None))
+
+        width = max([len(row[0]) for row in rows] + [9])
+        runtime.report('%-*s  %-20s  %-8s  %-8s  %s' % (width, 'component', 'version',
+            'status', 'estimate', 'reason'))
+        for name, version, status, reason, estimate in rows:
+            runtime.report('%-*s  %-20s  %-8s  %-8s  %s' % (width, name, version, status,
+                format_duration(estimate) if estimate is not None else '', reason))
+
+        counts = {}
+        for row in rows:
+            counts[row[2]] = counts.get(row[2], 0) + 1
+
+        summary = ', '.join('%d %s' % (counts[s], s) for s in sorted(counts))
+        if estimates:
+            cost = sum(row[4] for row in rows if row[4] is not None)
+            summary += '; estimated cost %s' % format_duration(cost)
+        runtime.report(summary)
+
+    def _plan_component(self, runtime, component, built, last):
+        """Predicts what assembling ``component`` would do, mirroring
+        ``AssembleComponent.run`` but resolving revisions remotely instead of
+        checking anything out. Returns the status, version and a reason."""
+
+        from lattice.support.repository import Repository
+
+        name = component['name']
+        targets = normalize_targets(self['target'])
+        builds = component.get('builds') or {}
+        if not (component.get('ephemeral') or [t for t in targets if t in builds]):
+            return 'skipped', None, 'does not implement target %s' % ', '.join(
+                repr(target) for target in targets)
+
+        metadata = component.get('repository')
+        if not metadata:
+            return 'unknown', None, 'invalid repository metadata'
+
+        repository = Repository.instantiate(metadata['type'], '.', runtime=runtime)
+        hash, version = repository.resolve(metadata)
+        if not hash:
+            return 'unknown', None, 'cannot resolve revision'
+
+        if component['version'] != 'HEAD':
+            version = component['version']
+        elif not version and last and last[1] == hash:
+            version = last[0]
+
+        has_commits = not (last and last[1] == hash)
+        if component.get('ephemeral'):
+            if has_commits and not component.get('independent'):
+                built.add(name)
+            return 'ephemeral', version, 'has new commits' if has_commits else 'unchanged'
+
+        if must_build(component, built):
+            reason = 'a dependency is rebuilt'
+        elif not (self['cachedir'] or self['artifact_store']):
+            reason = 'no cachedir'
+        elif not version:
+            reason = 'new commits since the last manifest'
+        elif not all(self._is_cached(get_artifact_name(dict(component, version=version),
+                target)) for target in targets if target in builds):
+            reason = 'not in the cachedir'
+        else:
+            return 'cached', version, 'in the cachedir'
+
+        if not component.get('independent'):
+            built.add(name)
+        return 'rebuild', version, reason
+
 class ManifestComponentAssembler(ComponentAssembler):
     def __init__(self, profile, manifest, timestamp):
         self.manifest = manifest
@@ -0,0 +1,137 @@
+from bake import *
+from scheme import *
+
+from lattice.support.snapshot import SnapshotError, read_snapshot, write_snapshot
+
+BATCH_SIZE = 500
+
+class ExportSnapshot(Task):
+    name = 'lattice.snapshot.export'
+    description = 'exports the registry into a read-only snapshot file'
+    parameters = {
+        'database': Text(nonempty=True, description='sqlalchemy url of the registry'
+            ' database'),
+        'full': Boolean(default=False, description='export everything, rather than'
+            ' refreshing an existing snapshot from the change sequence'),
+        'path': Path(nonempty=True, description='snapshot file to write'),
+    }
+
+    def run(self, runtime):
+        from sqlalchemy import create_engine
+
+        engine = create_engine(self['database'])
+        connection = engine.connect()
+        try:
+            with connection.begin():
+                self._export(runtime, connection)
+        finally:
+            connection.close()
+            engine.dispose()
+
+    def _export(self, runtime, connection):
+        seq = connection.execute('SELECT max(seq) FROM change').scalar() or 0
+
+        snapshot = None
+        if self['path'].exists() and not self['full']:
+            try:
+                snapshot = read_snapshot(self['path'])
+            except SnapshotError, exception:
+                runtime.report('%s; exporting everything' % exception)
+
+        if snapshot:
+            components, profiles, since = snapshot
+            if since == seq:
+                runtime.report('snapshot is current at change %d' % seq)
+                return
+
+            changed = {'component': set(), 'profile': set()}
+            for resource, subject in connection.execute('SELECT resource, subject'
+                    ' FROM change WHERE seq > %d' % since):
+                changed[resource].add(subject)
+
+            ids = sorted(changed['component'])
+            for id in ids:
+                components.pop(id, None)
+            components.update(self._load_components(connection, ids))
+
+            ids = sorted(changed['profile'])
+            for id in ids:
+                profiles.pop(id, None)
+            profiles.update(self._load_profiles(connection, ids))
+
+            runtime.report('refreshing snapshot from change %d to %d: %d components and'
+                ' %d profiles changed' % (since, seq, len(changed['component']),
+                len(changed['profile'])))
+        else:
+            components = self._load_components(connection)
+            profiles = self._load_profiles(connection)
+            runtime.report('exporting %d components and %d profiles at change %d'
+                % (len(components), len(profiles), seq))
+
+        write_snapshot(self['path'], components, profiles, seq)
+
+    def _load_components(self, connection, ids=None):
+        components = {}
+        for rows in self._select(connection, 'SELECT id, name, version, status, description'
+                ' FROM component', 'id', ids):
+            for id, name, version, status, description in rows:
+                components[id] = {'name': name, 'version': version, 'status': status,
+                    'builds': {}, 'dependencies': []}
+                if description:
+                    components[id]['description'] = description
+
+        for rows in self._select(connection, 'SELECT * FROM component_repository',
+                'component_id', ids):
+            for row in rows:
+                repository = dict((k, v) for k, v in row.items()
+                    if v is not None and k not in ('id', 'component_id'))
+                if row['component_id'] in components:
+                    components[row['component_id']]['repository'] = repository
+
+        for rows in self._select(connection, 'SELECT * FROM component_build',
+                'component_id', ids):
+            for row in rows:
+                build = dict((k, v) for k, v in row.items()
+                    if v is not None and k not in ('id', 'component_id', 'name'))
+                if row['component_id'] in components:
+                    components[row['component_id']]['builds'][row['name']] = build
+
+        for rows in self._select(connection, 'SELECT component_id, dependency_id'
+                ' FROM component_dependency', 'component_id', ids):
+            for component_id, dependency_id in rows:
+                if component_id in components:
+                    components[component_id]['dependencies'].append(dependency_id)
+
+        return components
+
+    def _load_profiles(self, connection, ids=None):
+        profiles = {}
+        for rows in self._select(connection, 'SELECT id, product_id, version FROM profile',
+                'id', ids):
+            for id, product_id, version in rows:
+                profiles[id] = {'product_id': product_id, 'version': version,
+                    'components': []}
+
+        for rows in self._select(connection, 'SELECT profile_id, component_id'
+                ' FROM profile_component', 'profile_id', ids):
+            for profile_id, component_id in rows:
+                if profile_id in profiles:
+                    profiles[profile_id]['components'].append(component_id)
+
+        return profiles
+
+    def _select(self, connection, sql, column, ids):
+        """Yields the rows of ``sql``, restricted to those whose ``column`` is in
+        ``ids`` if it isn't ``None``, a batch of ids at a time."""
+
+        from sqlalchemy import text
+
+        if ids is None:
+            yield connection.execute(text(sql)).fetchall()
+            return
+
+        for i in range(0, len(ids), BATCH_SIZE):
+            batch = dict(('id%d' % j, id) for j, id in enumerate(ids[i:i + BATCH_SIZE]))
+            statement = text('%s WHERE %s IN (%s)' % (sql, column,
+                ', '.join(':%s' % name for name in sorted(batch))))
+            yield connection.execute(statement, **batch).fetchall()
@@ -1,3 +1,4 @@
+import heapq
 import re
 from uuid import uuid4
 
@@ -8,6 +9,22 @@ ENV_VAR_EXPR = re.compile(r'[$][{]([a-zA-Z]+)[}]')
 def interpolate_env_vars(content, environ):
     return ENV_VAR_EXPR.sub(lambda m: environ.get(m.group(1)), content)
 
+def _find_cycle(edges, dependents, unsorted):
+    """Returns a cycle among ``unsorted``, the nodes a topological sort left out,
+    as a list of nodes each depending on the next and ending where it starts.
+    Every such node has a dependent among them, so following dependents from
+    any of them must come back to a node already seen."""
+
+    node = min(unsorted)
+    seen = []
+    while node not in seen:
+        seen.append(node)
+        node = min(d for d in dependents[node] if d in unsorted)
+
+    cycle = seen[seen.index(node):] + [node]
+    cycle.reverse()
+    return cycle
+
 def topological_sort(graph):
     queue = []
     edges = graph.values()
@@ -41,3 +58,55 @@ def uniqpath(root, prefix=''):
         candidate = root / ('%s%s' % (prefix, str(uuid4()).replace('-', '')[:8]))
         if not candidate.exists():
             return candidate
+
+def prioritize(graph, weights, sequence=None):
+    """Orders the nodes of ``graph``, a map of node to the set of nodes it depends
+    on, so that every node follows its dependencies and, whenever several nodes
+    are ready, the node heading the longest remaining path through ``weights``
+    comes first; ties keep the order of ``sequence``. Returns the order and the
+    critical path, the heaviest chain of dependent nodes. Raises ``ValueError``
+    naming a cycle if the dependencies have one."""
+
+    edges = dict((node, set(e for e in graph[node] if e in graph)) for node in graph)
+    dependents = dict((node, set()) for node in graph)
+    for node, dependencies in edges.iteritems():
+        for dependency in dependencies:
+            dependents[dependency].add(node)
+
+    ordered = topological_sort(dict((n, set(e)) for n, e in edges.iteritems()))
+    if len(ordered) < len(edges):
+        cycle = _find_cycle(edges, dependents, set(edges) - set(ordered))
+        raise ValueError('dependency cycle: %s' % ' -> '.join(cycle))
+
+    priorities, successors = {}, {}
+    for node in reversed(ordered):
+        successor = None
+        for dependent in dependents[node]:
+            if successor is None or priorities[dependent] > priorities[successor]:
+                successor = dependent
+        successors[node] = successor
+        priorities[node] = weights.get(node, 0) + (priorities[successor] if successor else 0)
+
+    index = dict((node, i) for i, node in enumerate(sequence or sorted(graph)))
+    remaining = dict((node, len(dependencies)) for node, dependencies in edges.iteritems())
+
+    queue = [(-priorities[n], index.get(n), n) for n, count in remaining.iteritems() if count == 0]
+    heapq.heapify(queue)
+
+    order = []
+    while queue:
+        node = heapq.heappop(queue)[2]
+        order.append(node)
+        for dependent in dependents[node]:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                heapq.heappush(queue, (-priorities[dependent], index.get(dependent), dependent))
+
+    critical_path = []
+    if order:
+        node = max(order, key=lambda n: (priorities[n], -index.get(n, 0)))
+        while node is not None:
+            critical_path.append(node)
+            node = successors[node]
+
+    return order, critical_path
@@ -0,0 +1,110 @@
+"""Runs a build farm on one machine: a coordinator on localhost and several
+``lattice.farm.work`` processes exchanging artifacts through a shared directory.
+
+The workers are started with the ``bake`` command, or whatever ``LATTICE_BAKE``
+names, and the test is skipped when neither is available."""
+
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime
+from distutils.spawn import find_executable
+
+from bake.path import path
+
+from lattice.support import benchmark as fixtures
+from lattice.support.farm import BuildQueue, Coordinator, FarmClient
+from lattice.tasks.farm import TIMESTAMP_FORMAT
+
+BAKE = os.environ.get('LATTICE_BAKE') or find_executable('bake')
+LEASE = 2
+WORKERS = 3
+
+class FarmTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = path(tempfile.mkdtemp(prefix='lattice-farm'))
+        self.logfile = self.directory / 'builds.log'
+        self.sharedir = self.directory / 'share'
+
+        repository = fixtures.generate_repository(self.directory / 'repository', 1)
+        self.graph = fixtures.generate_graph(6, 'layered')
+        self.profile = fixtures.generate_profile(self.graph, str(repository))
+
+        # each build fails unless the files of its dependencies, built on any
+        # worker, were restored into its build path, and logs when it ran
+        for component in self.profile['components']:
+            name = component['name']
+            checks = ''.join('test -f "$BUILDPATH/%s/file" && ' % d for d in self.graph[name])
+            component['builds']['default']['command'] = (
+                'start=$(date +%%s.%%N) && %smkdir -p "$BUILDPATH/%s"'
+                ' && echo %s > "$BUILDPATH/%s/file"'
+                ' && echo "%s $start $(date +%%s.%%N)" >> %s'
+                % (checks, name, name, name, name, self.logfile))
+
+    def tearDown(self):
+        self.directory.rmtree_p()
+
+    @unittest.skipUnless(BAKE, 'bake is not installed')
+    def test_farm(self):
+        queue = BuildQueue(self.profile['components'], LEASE,
+            timestamp=datetime.utcnow().strftime(TIMESTAMP_FORMAT))
+        coordinator = Coordinator(queue, ('127.0.0.1', 0))
+        thread = threading.Thread(target=coordinator.serve_until_finished, args=(3, 0.1))
+        thread.daemon = True
+        thread.start()
+
+        # a worker which claims the first component and then disappears, so
+        # that its lease has to expire before anything else can be built
+        ghost = FarmClient(coordinator.url, 'ghost')
+        claimed = ghost.claim()
+        self.assertEqual(claimed['status'], 'ready')
+        abandoned = claimed['component']['name']
+        started = time.time()
+
+        workers = [self._start_worker(coordinator.url, i) for i in range(WORKERS)]
+        try:
+            self.assertTrue(queue.finished.wait(180), 'the farm did not finish')
+
+            # the abandoned component has since been built by another worker
+            self.assertEqual(ghost.complete(abandoned, {})['status'], 'lost')
+            for worker in workers:
+                self.assertEqual(worker.wait(), 0)
+        finally:
+            for worker in workers:
+                if worker.poll() is None:
+                    worker.kill()
+        thread.join(10)
+
+        self.assertEqual(queue.failures, [])
+        self.assertEqual(sorted(queue.results), sorted(self.graph))
+
+        # the abandoned component went to a real worker, after its lease expired
+        self.assertNotEqual(queue.results[abandoned]['worker'], 'ghost')
+
+        runs = {}
+        for line in self.logfile.bytes().strip().split('\n'):
+            name, start, end = line.split()
+            runs[name] = (float(start), float(end))
+
+        self.assertEqual(sorted(runs), sorted(self.graph))
+        self.assertTrue(runs[abandoned][0] >= started + LEASE)
+        for name, dependencies in self.graph.iteritems():
+            for dependency in dependencies:
+                self.assertTrue(runs[name][0] >= runs[dependency][1],
+                    '%s started before its dependency %s finished' % (name, dependency))
+
+        self.assertTrue(len(set(r['worker'] for r in queue.results.itervalues())) > 1)
+
+    def _start_worker(self, url, index):
+        workdir = self.directory / ('worker%d' % index)
+        workdir.makedirs_p()
+        return subprocess.Popen([BAKE, '-m', 'lattice.tasks', 'lattice.farm.work',
+            'coordinator=%s' % url, 'path=%s' % (workdir / 'build'),
+            'sharedir=%s' % self.sharedir, 'worker=worker%d' % index, 'poll=0.2',
+            'patience=30'], cwd=str(workdir))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+"""Checks that shallow clones of git components get the same versions as full
+clones, whatever the shape of the upstream history."""
+
+import subprocess
+import tempfile
+import unittest
+
+from bake.path import path
+
+from lattice.support.repository import GitRepository
+
+class ShallowVersionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = path(tempfile.mkdtemp(prefix='lattice-repository'))
+        self.upstream = self.directory / 'upstream'
+        self.upstream.makedirs_p()
+
+        self._git('init', '-q')
+        self._git('config', 'user.email', 'test@lattice')
+        self._git('config', 'user.name', 'test')
+        self._git('checkout', '-q', '-b', 'master')
+
+    def tearDown(self):
+        self.directory.rmtree_p()
+
+    def test_untagged_with_branches(self):
+        self._commit('first')
+        self._git('checkout', '-q', '-b', 'feature')
+        self._commit('feature one')
+        self._commit('feature two')
+        self._git('checkout', '-q', 'master')
+        self._commit('second')
+
+        self._assert_same_version('0.0.0+4')
+
+    def test_tagged_with_merges(self):
+        self._commit('first')
+        self._git('tag', 'v1.0.0')
+        self._git('checkout', '-q', '-b', 'side')
+        for i in range(3):
+            self._commit('side %d' % i, 'side')
+        self._git('tag', 'v1.1.0')
+        self._git('checkout', '-q', 'master')
+        for i in range(20):
+            self._commit('master %d' % i)
+        self._git('merge', '-q', '--no-ff', '-m', 'merge side', 'side')
+        self._commit('last')
+
+        self._assert_same_version('1.1.0+22')
+
+    def test_tagged_beyond_initial_depth(self):
+        self._commit('first')
+        self._git('tag', 'v2.0.0')
+        for i in range(40):
+            self._commit('change %d' % i)
+
+        self._assert_same_version('2.0.0+40')
+
+    def _assert_same_version(self, expected=None):
+        full = self._get_version(False)
+        if expected:
+            self.assertEqual(full, expected)
+        self.assertEqual(self._get_version(True), full)
+
+    def _commit(self, message, filename='file'):
+        (self.upstream / filename).write_bytes(message)
+        self._git('add', filename)
+        self._git('commit', '-q', '-m', message)
+
+    def _get_version(self, shallow):
+        root = self.directory / ('shallow' if shallow else 'full')
+        repository = GitRepository(str(root), shallow=shallow)
+        repository.checkout({'url': 'file://%s' % self.upstream})
+        return repository.get_current_version()
+
+    def _git(self, *tokens):
+        subprocess.check_call(['git'] + list(tokens), cwd=str(self.upstream),
+            stdout=open('/dev/null', 'w'))
+
+if __name__ == '__main__':
+    unittest.main()